@@ -0,0 +1,115 @@
+"""Microbenchmark: per-request overhead of the CORS middleware.
+
+Compares the pure-ASGI DynamicCORSMiddleware against the @app.middleware('http') function it replaced
+(reproduced below), on an app with a single trivial route. Requests are sent by calling the ASGI app
+directly, so no time is spent on networking or HTTP parsing.
+
+Run from the repository root (so the .env file is found), e.g.:
+
+    PYTHONPATH=src poetry run python benchmarks/cors_middleware.py --requests 20000
+"""
+
+import argparse
+import asyncio
+import re
+import time
+
+from fastapi import FastAPI, Request, Response
+
+from engine.cors import DynamicCORSMiddleware
+from engine.main import NOWCAST_EXPOSED_HEADERS
+
+ORIGINS = {
+    'no origin': None,
+    'production': 'https://www.edinburghcrowds.co.uk',
+    'vercel preview': 'https://edicrowds-frontend-abc123-tristan-goss-projects.vercel.app',
+    'other': 'https://otherdomain.com',
+}
+
+
+def is_vercel_preview_deployment(url: str) -> bool:
+    return bool(re.fullmatch(r'https://edicrowds-frontend-[a-z0-9\-]+-tristan-goss-projects\.vercel\.app', url))
+
+
+async def old_cors_middleware(request: Request, call_next):
+    origin = request.headers.get('origin')
+    response = await call_next(request)
+    if origin and (
+        origin
+        in {
+            'https://www.edinburghcrowds.co.uk',
+            'http://localhost:5173',
+        }
+        or is_vercel_preview_deployment(origin)
+    ):
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers['Access-Control-Allow-Methods'] = '*'
+        response.headers['Access-Control-Allow-Headers'] = '*'
+        response.headers['Access-Control-Expose-Headers'] = NOWCAST_EXPOSED_HEADERS
+    return response
+
+
+def make_app(cors: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/ping')
+    async def ping() -> Response:
+        return Response(content=b'{}', media_type='application/json')
+
+    if cors == 'old':
+        app.middleware('http')(old_cors_middleware)
+    elif cors == 'new':
+        app.add_middleware(DynamicCORSMiddleware, expose_headers=NOWCAST_EXPOSED_HEADERS, max_age_s=600)
+    return app
+
+
+async def time_requests(app: FastAPI, origin: str | None, n_requests: int) -> float:
+    """Return the mean time per request in microseconds."""
+    headers = [(b'host', b'benchmark')]
+    if origin is not None:
+        headers.append((b'origin', origin.encode()))
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': '/ping',
+        'raw_path': b'/ping',
+        'root_path': '',
+        'query_string': b'',
+        'headers': headers,
+        'client': ('127.0.0.1', 12345),
+        'server': ('benchmark', 80),
+    }
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        pass
+
+    # warm up, including building the middleware stack
+    for _ in range(100):
+        await app(dict(scope), receive, send)
+
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / n_requests * 1e6
+
+
+async def run(n_requests: int) -> None:
+    apps = {cors: make_app(cors) for cors in ('none', 'old', 'new')}
+    print(f'{"origin":<16}{"no CORS (us)":>14}{"old (us)":>12}{"new (us)":>12}')
+    for label, origin in ORIGINS.items():
+        timings = [await time_requests(apps[cors], origin, n_requests) for cors in ('none', 'old', 'new')]
+        print(f'{label:<16}' + ''.join(f'{t:>{w}.1f}' for t, w in zip(timings, (14, 12, 12), strict=True)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000, help='number of requests per app and origin')
+    args = parser.parse_args()
+    asyncio.run(run(args.requests))
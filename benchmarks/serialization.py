@@ -0,0 +1,61 @@
+"""Microbenchmark: encoding and decoding nowcasts with each serializer, against the json module.
+
+Uses the mock nowcast (1,539 OAs) and a synthetic nowcast with 50,000 OAs, with densities rounded to
+5 d.p. like real nowcasts. Times are the best of several repeats, so as to leave out noise from the rest
+of the system; size is the number of bytes written to the cache.
+
+Run from the repository root (so the .env file is found), e.g.:
+
+    PYTHONPATH=src poetry run python benchmarks/serialization.py --repeats 20
+"""
+
+import argparse
+import json
+import random
+import time
+from importlib.resources import files
+from typing import Any, Callable
+
+from engine.serialization import SERIALIZERS, Serializer
+
+SYNTHETIC_OAS = 50_000
+
+STDLIB_JSON = Serializer('json (stdlib)', lambda data: json.dumps(data).encode('utf-8'), json.loads)
+
+
+def synthetic_nowcast(n_oas: int) -> dict:
+    rng = random.Random(0)
+    return {f'S{code:08d}': round(rng.expovariate(50), 5) for code in range(n_oas)}
+
+
+def best_time_ms(func: Callable[[], Any], repeats: int) -> float:
+    """Return the shortest time taken by any of several calls, in milliseconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1e3
+
+
+def run(repeats: int) -> None:
+    nowcasts = {
+        'mock nowcast': json.loads((files('engine') / 'mock_nowcast.json').read_text()),
+        f'{SYNTHETIC_OAS // 1000}k-OA nowcast': synthetic_nowcast(SYNTHETIC_OAS),
+    }
+    for label, nowcast in nowcasts.items():
+        print(f'{label} ({len(nowcast)} entries)')
+        print(f'  {"format":<16}{"encode (ms)":>12}{"decode (ms)":>12}{"size (kB)":>11}')
+        for serializer in (STDLIB_JSON, *SERIALIZERS.values()):
+            raw = serializer.dumps(nowcast)
+            assert serializer.loads(raw) == nowcast
+            encode_ms = best_time_ms(lambda s=serializer: s.dumps(nowcast), repeats)
+            decode_ms = best_time_ms(lambda s=serializer, r=raw: s.loads(r), repeats)
+            print(f'  {serializer.suffix:<16}{encode_ms:>12.3f}{decode_ms:>12.3f}{len(raw) / 1e3:>11.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=20, help='number of times to encode and decode each nowcast')
+    args = parser.parse_args()
+    run(args.repeats)
@@ -0,0 +1,98 @@
+"""Load test: hold thousands of idle /nowcast/events connections, then publish a new nowcast to all of them.
+
+The engine is served by uvicorn inside this process, with the subscribers connecting to it over
+loopback TCP, so the memory reported per connection is an upper bound (it includes the client side too).
+
+Run from the repository root (so the .env file is found), e.g.:
+
+    PYTHONPATH=src poetry run python benchmarks/sse_idle_connections.py --connections 2000
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import time
+from datetime import datetime
+from importlib.resources import files
+from typing import Tuple
+
+import uvicorn
+
+from engine import main
+
+BATCH_SIZE = 200
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+async def read_event(reader: asyncio.StreamReader) -> None:
+    received = b''
+    while b'event: nowcast' not in received:
+        chunk = await reader.read(4096)
+        if not chunk:
+            raise ConnectionError('Connection closed before an event arrived')
+        received += chunk
+
+
+async def subscribe(port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /nowcast/events HTTP/1.1\r\nHost: benchmark\r\n\r\n')
+    await writer.drain()
+    # the current version is sent as soon as a client subscribes
+    await read_event(reader)
+    # the writer must be kept, as the connection is closed when it is garbage collected
+    return reader, writer
+
+
+async def run(n_connections: int) -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    assert hard > 2 * n_connections + 100, f'Need a higher open file limit than {hard} for this many connections'
+
+    with (files('engine') / 'mock_nowcast.json').open('r', encoding='utf-8') as f:
+        nowcast = json.load(f)
+    main.publish_nowcast_snapshot(nowcast, datetime.now())
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=0, lifespan='off', log_level='warning'))
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    baseline_mb = rss_mb()
+    connections = []
+    for _ in range(0, n_connections, BATCH_SIZE):
+        batch_size = min(BATCH_SIZE, n_connections - len(connections))
+        connections += await asyncio.gather(*[subscribe(port) for _ in range(batch_size)])
+    held_mb = rss_mb()
+    print(f'{main.NOWCAST_EVENTS.subscribers} subscribers connected')
+    print(
+        f'RSS {baseline_mb:.1f} MB -> {held_mb:.1f} MB ({(held_mb - baseline_mb) * 1024 / n_connections:.1f} kB each)'
+    )
+
+    nowcast = {k: v * 1.01 if isinstance(v, float) else v for k, v in nowcast.items()}
+    start = time.perf_counter()
+    main.publish_nowcast_snapshot(nowcast, datetime.now())
+    publish_s = time.perf_counter() - start
+    await asyncio.gather(*[read_event(reader) for reader, _ in connections])
+    delivered_s = time.perf_counter() - start
+    print(f'publish (incl. serializing the nowcast) took {publish_s * 1000:.1f} ms')
+    print(f'new version delivered to all {n_connections} subscribers after {delivered_s * 1000:.1f} ms')
+
+    for _, writer in connections:
+        writer.close()
+    server.should_exit = True
+    await serve
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=2000)
+    asyncio.run(run(parser.parse_args().connections))
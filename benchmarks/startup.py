@@ -0,0 +1,79 @@
+"""Benchmark: how long the engine takes to import, and to serve its first nowcast after being started.
+
+Import time is measured in fresh interpreters, so nothing is already imported or cached in-process.
+Time to first response is measured from spawning uvicorn until GET /nowcast returns 200, with the mock
+nowcast already written to the file cache in CACHE_ROOT (as it would be after a restart).
+
+Run from the repository root (so the .env file is found), e.g.:
+
+    PYTHONPATH=src poetry run python benchmarks/startup.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from http import HTTPStatus
+from importlib.resources import files
+
+from engine.simple_cache import SimpleCache
+
+IMPORT_MAIN = 'import time; start = time.perf_counter(); import engine.main; print(time.perf_counter() - start)'
+POLL_INTERVAL_S = 0.01
+STARTUP_TIMEOUT_S = 60
+
+
+def time_import() -> float:
+    """Return the time taken to import engine.main in a fresh interpreter, in seconds."""
+    result = subprocess.run([sys.executable, '-c', IMPORT_MAIN], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+
+def time_first_response(port: int) -> float:
+    """Return the time from spawning uvicorn until /nowcast is served, in seconds."""
+    url = f'http://127.0.0.1:{port}/nowcast'
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'engine.main:app', '--port', str(port), '--log-level', 'warning'],
+        env={**os.environ, 'WEB_CONCURRENCY': '1'},
+    )
+    try:
+        while time.perf_counter() - start < STARTUP_TIMEOUT_S:
+            try:
+                with urllib.request.urlopen(url) as response:
+                    if response.status == HTTPStatus.OK:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(POLL_INTERVAL_S)
+        raise TimeoutError(f'{url} was not served within {STARTUP_TIMEOUT_S}s')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run(n_runs: int, port: int) -> None:
+    import_times = [time_import() for _ in range(n_runs)]
+
+    # fresh from the cache file, as the engine finds it after a restart
+    cache = SimpleCache('nowcast', max_age_s=3600)
+    cache.clear()
+    cache.write(json.loads((files('engine') / 'mock_nowcast.json').read_text()))
+    response_times = [time_first_response(port) for _ in range(n_runs)]
+
+    print(f'{"":<26}{"median (s)":>12}{"min (s)":>10}{"max (s)":>10}')
+    for label, times in (('import engine.main', import_times), ('first /nowcast response', response_times)):
+        print(f'{label:<26}{statistics.median(times):>12.3f}{min(times):>10.3f}{max(times):>10.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='number of imports and server starts to time')
+    parser.add_argument('--port', type=int, default=8765, help='port to start the engine on')
+    args = parser.parse_args()
+    run(args.runs, args.port)
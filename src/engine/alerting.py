@@ -1,24 +1,193 @@
+import asyncio
 import logging
 import smtplib
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from email.message import EmailMessage
-from smtplib import SMTPResponseException
+from smtplib import SMTPResponseException, SMTPServerDisconnected
+from typing import Dict, List, Optional
 
+from engine import config
 from engine.config import SECRETS
 
 log = logging.getLogger(__name__)
 
+ALERT_SUBJECT = 'Edinburgh Crowds Alert'
+ALERT_FROM = 'info@edinburghcrowds.co.uk'
 
-def alert_via_email(alert: str, destination_email: str = SECRETS['GMAIL_ALERT_EMAIL']) -> None:
-    msg = EmailMessage()
-    msg['Subject'] = 'Edinburgh Crowds Alert'
-    msg['From'] = 'info@edinburghcrowds.co.uk'
-    msg['To'] = destination_email
-    msg.set_content(alert)
 
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-            smtp.login(SECRETS['GMAIL_ALERT_EMAIL'], SECRETS['GMAIL_ALERT_APP_PASSWORD'])
-            smtp.send_message(msg)
+@dataclass(frozen=True)
+class SMTPServer:
+    host: str
+    port: int
+    use_ssl: bool
+    username: str
+    password: str
+
+    def connect(self) -> smtplib.SMTP:
+        """Open a logged-in connection."""
+        smtp = smtplib.SMTP_SSL(self.host, self.port) if self.use_ssl else smtplib.SMTP(self.host, self.port)
+        try:
+            smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+
+@dataclass
+class CoalescedAlert:
+    first_raised_at: datetime
+    last_raised_at: datetime
+    count: int = 1
+    suppressed: int = 0  # repeats held back since it was last emailed
+
+
+class AlertDispatcher:
+    """Send alerts by email from a background task, so raising one never blocks the event loop.
+
+    Alerts wait in a bounded queue (new ones are dropped, with a warning, if it is full). Once an alert
+    arrives, everything raised within the next digest window is sent with it as one email, with repeats
+    of the same alert counted rather than listed, so at most one email is sent per window however often
+    something fails. An alert identical to one emailed less than repeat_cooldown_s before isn't sent again
+    (so a scheduled refresh failing every time it runs doesn't send an email every time), but is counted and
+    mentioned when it is next emailed, after the cooldown; an alert that couldn't be delivered isn't held back.
+    The SMTP connection is kept open between emails, and reopened if the server has closed it in the meantime.
+    """
+
+    def __init__(
+        self,
+        server: SMTPServer,
+        destination_email: str,
+        digest_window_s: float,
+        repeat_cooldown_s: float,
+        max_queued: int,
+    ):
+        self.server = server
+        self.destination_email = destination_email
+        self.digest_window_s = digest_window_s
+        self.repeat_cooldown = timedelta(seconds=repeat_cooldown_s)
+        self.queue: asyncio.Queue = asyncio.Queue(max_queued)
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._last_emailed: Dict[str, datetime] = {}  # when each alert emailed was last raised
+        self._suppressed: Dict[str, int] = {}
+
+    def alert(self, alert: str) -> None:
+        """Queue an alert to be emailed with the next digest."""
+        try:
+            self.queue.put_nowait((alert, datetime.now()))
+        except asyncio.QueueFull:
+            log.warning(f'Alert queue is full, dropping alert: {alert}')
+
+    async def run(self) -> None:
+        """Send a digest of the alerts raised in each window, forever.
+
+        Alerts collected when this is cancelled are still sent.
+        """
+        try:
+            while True:
+                digest: Dict[str, CoalescedAlert] = {}
+                while not digest:
+                    self._add_to_digest(digest, *await self.queue.get())
+                try:
+                    async with asyncio.timeout(self.digest_window_s):
+                        while True:
+                            self._add_to_digest(digest, *await self.queue.get())
+                except TimeoutError:
+                    pass
+                finally:
+                    # also on shutdown, so that alerts raised just before it aren't lost
+                    while not self.queue.empty():
+                        self._add_to_digest(digest, *self.queue.get_nowait())
+                    if digest:
+                        delivered = await asyncio.shield(asyncio.to_thread(self._send, self.digest_message(digest)))
+                        # an alert that couldn't be delivered is sent again if it is raised again
+                        if delivered:
+                            self._last_emailed.update((alert, c.last_raised_at) for alert, c in digest.items())
+                        self._forget_cooled_down(datetime.now())
+        finally:
+            await asyncio.to_thread(self._disconnect)
+
+    def _forget_cooled_down(self, now: datetime) -> None:
+        # alerts often include error messages, so there is no telling how many distinct ones there will be
+        self._last_emailed = {
+            alert: last_emailed
+            for alert, last_emailed in self._last_emailed.items()
+            if now - last_emailed < self.repeat_cooldown
+        }
+        self._suppressed = {alert: n for alert, n in self._suppressed.items() if alert in self._last_emailed}
+
+    def _add_to_digest(self, digest: Dict[str, CoalescedAlert], alert: str, raised_at: datetime) -> None:
+        coalesced = digest.get(alert)
+        if coalesced is None:
+            last_emailed = self._last_emailed.get(alert)
+            if last_emailed is not None and raised_at - last_emailed < self.repeat_cooldown:
+                self._suppressed[alert] = self._suppressed.get(alert, 0) + 1
+                return
+            digest[alert] = CoalescedAlert(raised_at, raised_at, suppressed=self._suppressed.pop(alert, 0))
+        else:
+            coalesced.count += 1
+            coalesced.last_raised_at = raised_at
+
+    def digest_message(self, digest: Dict[str, CoalescedAlert]) -> EmailMessage:
+        """Write one email listing every alert in a digest, in the order they were first raised."""
+        lines: List[str] = []
+        for alert, coalesced in digest.items():
+            when = coalesced.first_raised_at.isoformat(timespec='seconds')
+            if coalesced.count > 1:
+                when += f' (and {coalesced.count - 1} more times, until {coalesced.last_raised_at:%H:%M:%S})'
+            if coalesced.suppressed:
+                when += f' (also raised {coalesced.suppressed} times since it was last emailed)'
+            lines.append(f'{when}: {alert}')
+        total = sum(coalesced.count for coalesced in digest.values())
+
+        msg = EmailMessage()
+        msg['Subject'] = ALERT_SUBJECT if total == 1 else f'{ALERT_SUBJECT} ({total} alerts)'
+        msg['From'] = ALERT_FROM
+        msg['To'] = self.destination_email
+        msg.set_content('\n\n'.join(lines))
+        return msg
+
+    def _send(self, msg: EmailMessage) -> bool:
+        """Send an email, returning whether it was delivered."""
+        try:
+            try:
+                if self._smtp is None:
+                    self._smtp = self.server.connect()
+                self._smtp.send_message(msg)
+            except (SMTPServerDisconnected, ConnectionError):
+                log.debug('SMTP connection was closed, reconnecting')
+                self._disconnect()
+                self._smtp = self.server.connect()
+                self._smtp.send_message(msg)
             log.info(f'Sent email alert to {msg["To"]}')
-    except SMTPResponseException as e:
-        log.error(f'Email was not delivered; SMTP error: {e.smtp_code} - {e.smtp_error.decode(errors="ignore")}')
+            return True
+        except SMTPResponseException as e:
+            log.error(f'Email was not delivered; SMTP error: {e.smtp_code} - {e.smtp_error.decode(errors="ignore")}')
+        except (smtplib.SMTPException, OSError) as e:
+            log.error(f'Email was not delivered; {e}')
+            self._disconnect()
+        return False
+
+    def _disconnect(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+
+ALERTS = AlertDispatcher(
+    SMTPServer(
+        config.ALERT_SMTP_HOST,
+        config.ALERT_SMTP_PORT,
+        config.ALERT_SMTP_SSL,
+        SECRETS['GMAIL_ALERT_EMAIL'],
+        SECRETS['GMAIL_ALERT_APP_PASSWORD'],
+    ),
+    SECRETS['GMAIL_ALERT_EMAIL'],
+    config.ALERT_DIGEST_WINDOW_S,
+    config.ALERT_REPEAT_COOLDOWN_S,
+    config.ALERT_QUEUE_SIZE,
+)
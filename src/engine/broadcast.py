@@ -0,0 +1,51 @@
+import asyncio
+import logging
+from typing import Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """Fan the latest message out to any number of waiting subscribers.
+
+    Only the most recent message is kept, pre-encoded, and shared by every subscriber;
+    subscribers just remember the sequence number of the last message they saw. Publishing
+    therefore costs the same however many subscribers there are: it swaps the message and sets
+    a single event that they are all waiting on. Subscribers that fall behind skip straight to
+    the latest message, which is all they need when messages announce new versions.
+    """
+
+    def __init__(self):
+        self._message: Optional[bytes] = None
+        self._sequence = 0
+        self._published: Optional[asyncio.Event] = None
+        self.subscribers = 0
+
+    @property
+    def sequence(self) -> int:
+        """The sequence number of the latest message (0 if nothing has been published)."""
+        return self._sequence
+
+    def publish(self, message: bytes) -> None:
+        """Make a message the latest one and wake all waiting subscribers."""
+        self._message = message
+        self._sequence += 1
+        if self._published is not None:
+            self._published.set()
+            self._published = None
+        log.debug(f'Broadcast message {self._sequence} to {self.subscribers} subscribers')
+
+    async def wait_for_message(self, after_sequence: int, timeout_s: float) -> Tuple[int, Optional[bytes]]:
+        """Wait for a message newer than after_sequence.
+
+        Returns the latest sequence number and message, or (after_sequence, None) if nothing new
+        was published within the timeout.
+        """
+        if self._sequence <= after_sequence:
+            if self._published is None:
+                self._published = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._published.wait(), timeout_s)
+            except asyncio.TimeoutError:
+                return after_sequence, None
+        return self._sequence, self._message
@@ -1,6 +1,7 @@
 """Single point of configuration."""
 
 import logging
+from urllib.parse import quote
 
 from dotenv import dotenv_values
 
@@ -12,22 +13,100 @@ for var_name in ['GMAIL_ALERT_EMAIL', 'GMAIL_ALERT_APP_PASSWORD']:
         raise RuntimeError(f'Environment variable {var_name} is missing from the .env file.')
 
 CACHE_ROOT = '/tmp/engine_cache'  # note must be mounted as docker volume so that cached scrapes persist over restarts
+SIMPLE_CACHE_MEMORY_BYTES = 64 * 2**20  # Cached data is also kept in memory, up to about this much JSON
+# Caches holding a value per key (e.g. per sensor) can share one SQLite database, with expired values
+# evicted from it this often
+CACHE_SQLITE_PATH = f'{CACHE_ROOT}/cache.sqlite3'
+CACHE_SQLITE_EVICT_INTERVAL_S = 60 * 60
+
+# Alerts are emailed (to GMAIL_ALERT_EMAIL) in digests of everything raised within a window of the first,
+# so at most one email is sent per window. Repeats of an alert emailed within the cooldown (which is longer than
+# the hourly refresh cadence, so a refresh failing every hour sends one email a day) aren't emailed again.
+# Alerts raised while this many are waiting to be sent are dropped.
+ALERT_SMTP_HOST = 'smtp.gmail.com'
+ALERT_SMTP_PORT = 465
+ALERT_SMTP_SSL = True
+ALERT_DIGEST_WINDOW_S = 5 * 60
+ALERT_REPEAT_COOLDOWN_S = 24 * 60 * 60
+ALERT_QUEUE_SIZE = 100
 
 NOWCAST_CACHE_TIMEOUT_S = 60 * 60  # Return the cached nowcast unless it's more than 60 minutes old.
-NOWCAST_CACHE_AUTO_REFRESH_INTERVAL_S = (
-    55 * 60
-)  # refresh the cached nowcast every 55 minutes (so cache is still available even while it is being refreshed)
+# Past NOWCAST_CACHE_TIMEOUT_S the nowcast is stale: it is still served (flagged as such) while a refresh runs
+# in the background, until it is older than this. A week covers the weekend break in autorefreshing.
+NOWCAST_CACHE_HARD_TIMEOUT_S = 7 * 24 * 60 * 60
+NOWCAST_VERSIONS_KEPT = 24  # Clients holding one of this many recent nowcasts can be sent a delta rather than all of it
+NOWCAST_EVENTS_HEARTBEAT_S = 30  # Must be shorter than nginx's proxy_read_timeout (60s by default)
+NOWCAST_DELTA_EPSILON = 1e-5  # Density changes smaller than this are left out of deltas (nowcasts have 5 d.p.)
+# Past nowcasts kept for /nowcast/history, at about 6 kB each. With hourly refreshes during working hours
+# this is roughly two years.
+NOWCAST_HISTORY_ROWS = 6000
+# With several uvicorn workers, one (elected using a lock file in CACHE_ROOT) refreshes the nowcast and shares it
+# with the others, which check for new versions this often
+WORKER_POLL_INTERVAL_S = 1
+# Each worker shares its metrics (summed over every worker at /metrics) this often. Those not shared again
+# within the max age are taken to be from a worker that has exited (e.g. before the container restarted).
+METRICS_SHARE_INTERVAL_S = 10
+METRICS_SHARED_MAX_AGE_S = 6 * METRICS_SHARE_INTERVAL_S
+WORKER_REFRESH_TIMEOUT_S = 5 * 60  # How long a worker with no nowcast at all waits for the refresher to make one
 # Four settings here that prevent the cache from autorefreshing except during UK working hours,
 # to reduce load on the scraped websites
 NOWCAST_CACHE_AUTO_REFRESH_FIRST_HOUR = 8
 NOWCAST_CACHE_AUTO_REFRESH_LAST_HOUR = 18
 NOWCAST_CACHE_AUTO_REFRESH_FIRST_WEEKDAY = 0
 NOWCAST_CACHE_AUTO_REFRESH_LAST_WEEKDAY = 4
+# Each source is refreshed once per cache timeout, in slots aligned to Monday 00:00 UK time (so hourly sources
+# are refreshed at the same minute past each hour), shifted by an offset and a jitter drawn at startup.
+# The refresh scheduler also checks for caches renewed by user requests at least this often.
+REFRESH_TIMEZONE = 'Europe/London'
+REFRESH_SCHEDULER_MAX_SLEEP_S = 60
+EE_REFRESH_OFFSET_S = 8 * 60 * 60  # Monday morning, as working hours start
+EE_REFRESH_JITTER_S = 2 * 60
+ETD_REFRESH_OFFSET_S = 60  # Just after the hour, which poll_edintraveldata scrapes the measurements of
+ETD_REFRESH_JITTER_S = 2 * 60
+NOWCAST_REFRESH_OFFSET_S = 5 * 60  # Once the sources have been refreshed
+NOWCAST_REFRESH_JITTER_S = 0
+
+# Origins allowed to call the API, along with vercel preview deployments of the frontend
+CORS_ALLOWED_ORIGINS = frozenset({'https://www.edinburghcrowds.co.uk', 'http://localhost:5173'})
+CORS_MAX_AGE_S = 24 * 60 * 60  # How long browsers may cache a preflight response (Chrome caps this at 2 hours)
+CORS_ORIGIN_CACHE_SIZE = 256  # Number of distinct origins whose allowed/denied decision is remembered
+
+# Where to load OA geometries from at startup: a PostGIS URI, or the path of a GeoPackage stand-in
+# (containing an edinburgh_oas layer, e.g. exported using ogr2ogr). If POSTGIS_PASSWORD is missing from the
+# .env file, there is none, and spatial queries and density tiles are disabled.
+OA_GEOMETRY_SOURCE = (
+    f'postgresql+psycopg://admin:{quote(SECRETS["POSTGIS_PASSWORD"], safe="")}@postgis:5432/geodb?connect_timeout=10'
+    if SECRETS.get('POSTGIS_PASSWORD')
+    else None
+)
+# Zoom levels of the density vector tiles served at /tiles/{z}/{x}/{y}.pbf
+DENSITY_TILES_MIN_ZOOM = 10
+DENSITY_TILES_MAX_ZOOM = 16
 
 AVERAGE_WALKING_SPEED_MPS = 1.3  # For conversion of pex flux measurements to ped density
 
-PLAYWRIGHT_POLL_JITTER_S = 2  # jitter requests when submitting many
+# Pages rendered by the server are fetched over plain HTTP where possible, over at most this many connections,
+# each reused for the pages that follow until it has been idle this long
+HTTP_MAX_CONNECTIONS = 4
+HTTP_KEEPALIVE_EXPIRY_S = 60
+HTTP_TIMEOUT_S = 10
+
+# Scrapers fetch at most this many pages at once, and make at most this many requests per second to each site
+# (in bursts of up to this many). Pages that time out are retried, after a backoff doubling from this long
+# each time, until they have been tried this many times or the deadline for all a scrape's pages passes.
+SCRAPE_MAX_CONCURRENT = 4
+SCRAPE_REQUESTS_PER_HOST_PER_S = 1
+SCRAPE_BURST_PER_HOST = 2
+SCRAPE_MAX_ATTEMPTS = 3
+SCRAPE_BACKOFF_S = 2
+SCRAPE_DEADLINE_S = 90
+
 PLAYWRIGHT_LOAD_TIMEOUT_S = 20  # give up waiting for the page to load if it takes longer than this
+# One headless Chromium is kept running between scrapes, with at most this many pages open at once. It is
+# relaunched after opening this many pages, or if it uses more than this much memory (the box has 2 GB).
+PLAYWRIGHT_MAX_PAGES = 4
+PLAYWRIGHT_PAGES_PER_BROWSER = 200
+PLAYWRIGHT_MAX_BROWSER_RSS_BYTES = 768 * 2**20
 PLAYWRIGHT_USER_AGENTS = [
     # Chrome on Windows
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
@@ -53,13 +132,30 @@ PLAYWRIGHT_VIEWPORTS = [
 PLAYWRIGHT_LOCALES = ['en-US', 'en-GB']
 
 ETD_PAGE_LOAD_INDICATOR_SELECTOR = '#gridTable'
+# Only the report page and the scripts that render its table are loaded; images, fonts, styles and
+# anything from other hosts (e.g. analytics) are blocked
+ETD_ALLOWED_RESOURCE_TYPES = frozenset({'document', 'script', 'xhr', 'fetch'})
+ETD_ALLOWED_URL_PATTERNS = (r'^https://edintraveldata\.drakewell\.com/',)
+# The report pages are rendered by the server, so are fetched over plain HTTP, only falling back to the browser
+# if that doesn't return the report table
+ETD_FETCH_OVER_HTTP_FIRST = True
 ETD_CACHE_TIMEOUT_S = 60 * 60  # The site offers real-time measurements, but we only poll it once an hour
+ETD_CACHE_HARD_TIMEOUT_S = 24 * 60 * 60  # Fall back to stale measurements up to this old if a scrape fails
+# Each scrape returns a sensor's hourly measurements for a whole (past) day, which are kept so that every
+# hour's refresh that day can read its measurement without scraping the site again
+ETD_DAY_TABLE_CACHE_TIMEOUT_S = 24 * 60 * 60
 ETD_MAX_PAX_PER_HOUR = 10e3
 
 EE_PAGE_LOAD_INDICATOR_SELECTOR = '.visualizer-chart-loaded'
+# Only the stats page, its scripts (including Google Charts, which the charts are drawn with) and the data
+# they fetch are loaded, plus the chart images we extract measurements from
+EE_ALLOWED_RESOURCE_TYPES = frozenset({'document', 'script', 'xhr', 'fetch'})
+EE_FETCH_OVER_HTTP_FIRST = False  # The charts are drawn by scripts, so need the browser
+EE_ALLOWED_URL_PATTERNS = (r'^https://www\.essentialedinburgh\.co\.uk/', r'^https://www\.gstatic\.com/charts/')
 EE_FALLBACK_PRINCES_FOOTFALL_PAX_PER_WEEK = 310_000  # For when scraping fails
 EE_FALLBACK_ROSE_FOOTFALL_PAX_PER_WEEK = 70_000  # For when scraping fails
 EE_CACHE_TIMEOUT_S = 7 * 24 * 60 * 60  # The site only provides a weekly measurement
+EE_CACHE_HARD_TIMEOUT_S = 4 * 7 * 24 * 60 * 60  # Fall back to stale measurements up to this old if a scrape fails
 EE_PIXELS_FROM_BOTTOM_COVERING_AXES = 100
 EE_PIXELS_FROM_TOP_COVERING_TITLE = 50
 EE_PIXELS_FROM_LEFT_COVERING_AXES = 60
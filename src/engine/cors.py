@@ -0,0 +1,111 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from engine import config
+
+log = logging.getLogger(__name__)
+
+Headers = List[Tuple[bytes, bytes]]
+
+VERCEL_PREVIEW_PATTERN = re.compile(r'https://edicrowds-frontend-[a-z0-9\-]+-tristan-goss-projects\.vercel\.app')
+
+
+def is_vercel_preview_deployment(url: str) -> bool:
+    return VERCEL_PREVIEW_PATTERN.fullmatch(url) is not None
+
+
+# Origins come straight from request headers, so the cache must be bounded
+@lru_cache(maxsize=config.CORS_ORIGIN_CACHE_SIZE)
+def is_allowed_origin(origin: str) -> bool:
+    """Allow a local Vite dev server, the production build, or a vercel preview deployment."""
+    return origin in config.CORS_ALLOWED_ORIGINS or is_vercel_preview_deployment(origin)
+
+
+def _header(headers: Iterable[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+def _add_vary_origin(headers: Headers) -> None:
+    """Add Origin to the response's Vary header, as the CORS headers depend on it."""
+    for i, (key, value) in enumerate(headers):
+        if key.lower() == b'vary':
+            headers[i] = (key, value + b', Origin')
+            return
+    headers.append((b'vary', b'Origin'))
+
+
+class DynamicCORSMiddleware:
+    """Custom CORS middleware to support vercel preview deployments.
+
+    Written as plain ASGI, so that requests aren't wrapped in BaseHTTPMiddleware's extra task and streams
+    (which also means streaming responses, such as /nowcast/events, pass straight through).
+    Whether an origin is allowed is only worked out once per origin. Preflight requests from allowed
+    origins are answered here, with a Max-Age so that browsers don't repeat them before every request.
+    """
+
+    def __init__(self, app: ASGIApp, expose_headers: str, max_age_s: int):
+        self.app = app
+        self.expose_headers = expose_headers.encode('latin-1')
+        self.max_age = str(max_age_s).encode('latin-1')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Answer preflights from allowed origins, and add CORS headers to their other responses."""
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = scope['headers']
+        origin = _header(request_headers, b'origin')
+        if origin is None or not is_allowed_origin(origin.decode('latin-1')):
+            await self.app(scope, receive, send)
+            return
+
+        requested_method = _header(request_headers, b'access-control-request-method')
+        if scope['method'] == 'OPTIONS' and requested_method is not None:
+            await self.preflight(
+                origin, requested_method, _header(request_headers, b'access-control-request-headers'), send
+            )
+            return
+
+        async def send_with_cors_headers(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.extend(
+                    [
+                        (b'access-control-allow-origin', origin),
+                        (b'access-control-allow-credentials', b'true'),
+                        (b'access-control-expose-headers', self.expose_headers),
+                    ]
+                )
+                _add_vary_origin(headers)
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors_headers)
+
+    async def preflight(
+        self, origin: bytes, requested_method: bytes, requested_headers: Optional[bytes], send: Send
+    ) -> None:
+        """Allow whatever was asked for, which is what the old wildcards did.
+
+        Wildcards aren't honoured on credentialed requests anyway, so the request is echoed back instead.
+        """
+        headers = [
+            (b'access-control-allow-origin', origin),
+            (b'access-control-allow-credentials', b'true'),
+            (b'access-control-allow-methods', requested_method),
+            (b'access-control-max-age', self.max_age),
+            (b'vary', b'Origin'),
+            (b'content-length', b'0'),
+        ]
+        if requested_headers is not None:
+            headers.append((b'access-control-allow-headers', requested_headers))
+        await send({'type': 'http.response.start', 'status': 204, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from engine.config import CACHE_ROOT
+from engine.snapshot import OAIndex
+
+log = logging.getLogger(__name__)
+
+
+class NowcastHistory:
+    """An append-only store of past nowcasts, as a ring buffer of memory-mapped files.
+
+    Each nowcast is one float32 row, with a column per OA in the order of its OAIndex, so a row is
+    written in one go and reading one OA's history touches only the pages holding its rows.
+    A parallel float64 file holds each row's timestamp (in epoch seconds). Nothing is loaded into memory
+    beyond the pages being read. Once max_rows nowcasts are held, the oldest are overwritten.
+
+    A JSON sidecar ({name}.meta, so that it isn't mistaken for a cache file by a SimpleCache whose name
+    prefixes it) holds the OA codes and where the ring buffer starts; it is rewritten (atomically)
+    after each row is appended, so a crash mid-append just loses that row. If the set of OAs
+    changes, the history is started afresh, as old rows would no longer line up with the columns.
+    """
+
+    def __init__(self, name: str, max_rows: int, cache_root: str = CACHE_ROOT):
+        self.name = name
+        self.max_rows = max_rows
+        self.root = Path(cache_root)
+        os.makedirs(self.root, exist_ok=True)
+        self.meta_path = self.root / f'{name}.meta'
+        legacy_meta_path = self.root / f'{name}.json'
+        if legacy_meta_path.exists() and not self.meta_path.exists():
+            os.replace(legacy_meta_path, self.meta_path)
+        self.values_path = self.root / f'{name}.f32'
+        self.timestamps_path = self.root / f'{name}.f64'
+
+        assert self.max_rows > 0
+
+        self.index: Optional[OAIndex] = None
+        self._columns: Dict[str, int] = {}
+        self._next_row = 0
+        self._count = 0
+        self._meta_mtime_ns: Optional[int] = None
+        self._load_meta()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _load_meta(self) -> None:
+        try:
+            self._meta_mtime_ns = self.meta_path.stat().st_mtime_ns
+            with self.meta_path.open('r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        if meta['max_rows'] != self.max_rows:
+            log.warning(f'{self.name} was created with {meta["max_rows"]} rows, not {self.max_rows}, starting afresh')
+            self.clear()
+            return
+        self._set_index(OAIndex.from_codes(meta['codes']))
+        self._next_row = meta['next_row']
+        self._count = meta['count']
+
+    def _reload_meta_if_changed(self) -> None:
+        # another process (the refresher worker, or the one that was before us) may have appended since we last looked
+        try:
+            if self.meta_path.stat().st_mtime_ns != self._meta_mtime_ns:
+                self._load_meta()
+        except FileNotFoundError:
+            # or cleared it
+            self._forget()
+
+    def _forget(self) -> None:
+        self.index = None
+        self._columns = {}
+        self._next_row = 0
+        self._count = 0
+        self._meta_mtime_ns = None
+
+    def _write_meta(self) -> None:
+        tmp_path = self.meta_path.with_suffix('.meta.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(
+                {
+                    'codes': list(self.index.codes),
+                    'max_rows': self.max_rows,
+                    'next_row': self._next_row,
+                    'count': self._count,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.meta_path)
+        self._meta_mtime_ns = self.meta_path.stat().st_mtime_ns
+
+    def _set_index(self, index: OAIndex) -> None:
+        self.index = index
+        self._columns = {code: i for i, code in enumerate(index.codes)}
+
+    def _open(self, mode: str) -> Tuple[np.memmap, np.memmap]:
+        values = np.memmap(self.values_path, dtype='<f4', mode=mode, shape=(self.max_rows, len(self.index.codes)))
+        timestamps = np.memmap(self.timestamps_path, dtype='<f8', mode=mode, shape=(self.max_rows,))
+        return values, timestamps
+
+    def clear(self) -> None:
+        """Delete the whole history."""
+        for path in (self.meta_path, self.values_path, self.timestamps_path):
+            path.unlink(missing_ok=True)
+        self._forget()
+        log.debug(f'{self.name} cleared.')
+
+    def append(self, densities: Mapping[str, float], created_at: datetime) -> None:
+        """Add a nowcast's per-OA densities to the history.
+
+        Nowcasts no newer than the latest one held
+        are ignored, so the same nowcast can't be recorded twice (e.g. when reloaded after a restart).
+        """
+        self._reload_meta_if_changed()
+        index = OAIndex.from_codes(densities.keys())
+        if self.index is not None and index.id != self.index.id:
+            log.warning(f'The set of OAs has changed, so {self.name} is starting afresh')
+            self.clear()
+        if self.index is not None and not (self.values_path.exists() and self.timestamps_path.exists()):
+            log.warning(f'{self.name} is missing its rows, so is starting afresh')
+            self.clear()
+        if self.index is None:
+            self._set_index(index)
+            mode = 'w+'
+        else:
+            mode = 'r+'
+
+        values, timestamps = self._open(mode)
+        timestamp = created_at.timestamp()
+        if self._count and timestamp <= timestamps[(self._next_row - 1) % self.max_rows]:
+            log.debug(f'{self.name} already holds a nowcast from {created_at}, not appending it')
+            return
+        if mode == 'w+':
+            values[:] = np.nan
+
+        values[self._next_row] = [densities[code] for code in self.index.codes]
+        timestamps[self._next_row] = timestamp
+        values.flush()
+        timestamps.flush()
+
+        self._next_row = (self._next_row + 1) % self.max_rows
+        self._count = min(self._count + 1, self.max_rows)
+        self._write_meta()
+        log.debug(f'Appended nowcast from {created_at} to {self.name} ({self._count} held)')
+
+    def series(
+        self, code: str, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Optional[Tuple[List[datetime], List[Optional[float]]]]:
+        """Return the timestamps and densities of one OA between start and end (inclusive), oldest first.
+
+        Returns None if the OA isn't in the history.
+        """
+        self._reload_meta_if_changed()
+        column = self._columns.get(code)
+        if column is None:
+            return None
+        if self._count == 0:
+            return [], []
+
+        values, timestamps = self._open('r')
+        # rows in time order: the ring buffer starts at the oldest row once it has wrapped around
+        first_row = self._next_row if self._count == self.max_rows else 0
+        rows = (first_row + np.arange(self._count)) % self.max_rows
+        ordered_timestamps = timestamps[rows]
+        lo = 0 if start is None else np.searchsorted(ordered_timestamps, start.timestamp(), side='left')
+        hi = self._count if end is None else np.searchsorted(ordered_timestamps, end.timestamp(), side='right')
+        rows = rows[lo:hi]
+
+        densities = values[rows, column]
+        return (
+            [datetime.fromtimestamp(t) for t in ordered_timestamps[lo:hi]],
+            # str() gives the shortest repr that round-trips as float32, i.e. the density as it was given
+            [None if np.isnan(d) else float(str(d)) for d in densities],
+        )
@@ -0,0 +1,312 @@
+"""Caches holding many values per name (e.g. one per sensor, date or URL), each with its own timeout.
+
+A KeyedCache stores its values, serialized, in a CacheBackend, shared by any number of caches, each
+using its own namespace within it. FileCacheBackend, the default, keeps a file per value in CACHE_ROOT,
+like SimpleCache. SQLiteCacheBackend keeps them all in one SQLite database (in WAL mode, so that reads in
+one worker aren't blocked by writes in another), with the expiry of each indexed so that evicting
+expired values doesn't scan everything.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+from engine.config import CACHE_ROOT, CACHE_SQLITE_EVICT_INTERVAL_S, CACHE_SQLITE_PATH
+from engine.metrics import CACHE_READS
+from engine.serialization import JSON, SERIALIZERS, Serializer
+from engine.simple_cache import CacheEntry
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StoredValue:
+    raw: bytes
+    suffix: str  # of the serializer that wrote it
+    written_at: datetime
+    expires_at: datetime
+
+
+class CacheBackend(ABC):
+    """Where KeyedCaches store their values, each under a (namespace, key) and until it expires."""
+
+    name: str  # as used to label cache reads
+
+    @abstractmethod
+    def get_many(self, namespace: str, keys: Iterable[str], now: datetime) -> Dict[str, StoredValue]:
+        """Return those of the values under the given keys that haven't expired by now."""
+
+    @abstractmethod
+    def put_many(self, namespace: str, values: Mapping[str, StoredValue]) -> None:
+        """Store values, replacing any already under the same keys."""
+
+    @abstractmethod
+    def evict(self, now: datetime) -> int:
+        """Delete every value that has expired by now, in any namespace, returning how many were."""
+
+    @abstractmethod
+    def clear(self, namespace: str) -> None:
+        """Delete every value in a namespace."""
+
+
+class FileCacheBackend(CacheBackend):
+    """A file per value, in a directory per namespace, each replaced atomically when written.
+
+    Each file starts with a line of JSON saying which key it holds, in what format and until when,
+    followed by the value as serialized. File names are hashes of the keys, so keys may be anything
+    (e.g. URLs). Eviction has to open every file to find when it expires, so this suits caches holding
+    tens of values rather than thousands.
+    """
+
+    name = 'file'
+    FILE_SUFFIX = '.value'
+
+    def __init__(self, cache_root: str = CACHE_ROOT):
+        self.cache_root = Path(cache_root)
+
+    def _path(self, namespace: str, key: str) -> Path:
+        return self.cache_root / namespace / f'{hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]}{self.FILE_SUFFIX}'
+
+    @staticmethod
+    def _read(path: Path, header_only: bool = False) -> Optional[StoredValue]:
+        try:
+            with open(path, 'rb') as fh:
+                header = json.loads(fh.readline())
+                raw = b'' if header_only else fh.read()
+        except FileNotFoundError:
+            return None
+        return StoredValue(
+            raw,
+            header['suffix'],
+            datetime.fromisoformat(header['written_at']),
+            datetime.fromisoformat(header['expires_at']),
+        )
+
+    def get_many(self, namespace: str, keys: Iterable[str], now: datetime) -> Dict[str, StoredValue]:
+        """Return those of the values under the given keys that haven't expired by now."""
+        found = {}
+        for key in keys:
+            stored = self._read(self._path(namespace, key))
+            if stored is not None and stored.expires_at > now:
+                found[key] = stored
+        return found
+
+    def put_many(self, namespace: str, values: Mapping[str, StoredValue]) -> None:
+        """Store values, replacing any already under the same keys."""
+        os.makedirs(self.cache_root / namespace, exist_ok=True)
+        for key, stored in values.items():
+            header = {
+                'key': key,
+                'suffix': stored.suffix,
+                'written_at': stored.written_at.isoformat(),
+                'expires_at': stored.expires_at.isoformat(),
+            }
+            path = self._path(namespace, key)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    fh.write(json.dumps(header).encode('utf-8') + b'\n')
+                    fh.write(stored.raw)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+
+    def evict(self, now: datetime) -> int:
+        """Delete every value that has expired by now, in any namespace, returning how many were."""
+        evicted = 0
+        for path in self.cache_root.glob(f'*/*{self.FILE_SUFFIX}'):
+            stored = self._read(path, header_only=True)
+            if stored is not None and stored.expires_at <= now:
+                path.unlink(missing_ok=True)
+                evicted += 1
+        return evicted
+
+    def clear(self, namespace: str) -> None:
+        """Delete every value in a namespace."""
+        for path in (self.cache_root / namespace).glob(f'*{self.FILE_SUFFIX}'):
+            path.unlink(missing_ok=True)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Every value in one SQLite database, with an index on when each expires.
+
+    The database is in WAL mode, so any number of workers can read it while one writes. Each process
+    opens its own connection when it first uses the database, shared by its threads under a lock.
+    Expired values are evicted every evict_interval_s, when values are next written.
+    """
+
+    name = 'sqlite'
+    # SQLite allows at most 999 parameters per statement in older versions, so look up keys in batches
+    MAX_KEYS_PER_QUERY = 500
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS cache_values ('
+        'namespace TEXT NOT NULL, key TEXT NOT NULL, written_at REAL NOT NULL, expires_at REAL NOT NULL, '
+        'suffix TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS cache_values_expires_at ON cache_values (expires_at)',
+    )
+
+    def __init__(self, path: Path, evict_interval_s: float, busy_timeout_s: float = 5):
+        self.path = Path(path)
+        self.evict_interval_s = evict_interval_s
+        self.busy_timeout_s = busy_timeout_s
+        self._connection: Optional[sqlite3.Connection] = None
+        self._connected_pid: Optional[int] = None
+        self._last_evicted = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections mustn't be carried across a fork
+        if self._connection is None or self._connected_pid != os.getpid():
+            os.makedirs(self.path.parent, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=self.busy_timeout_s, isolation_level=None, check_same_thread=False
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self._connection, self._connected_pid = connection, os.getpid()
+        return self._connection
+
+    def get_many(self, namespace: str, keys: Iterable[str], now: datetime) -> Dict[str, StoredValue]:
+        """Return those of the values under the given keys that haven't expired by now."""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(keys), self.MAX_KEYS_PER_QUERY):
+                batch = keys[start : start + self.MAX_KEYS_PER_QUERY]
+                rows = connection.execute(
+                    'SELECT key, written_at, expires_at, suffix, data FROM cache_values '
+                    f'WHERE namespace = ? AND expires_at > ? AND key IN ({", ".join("?" * len(batch))})',
+                    (namespace, now.timestamp(), *batch),
+                )
+                for key, written_at, expires_at, suffix, data in rows:
+                    found[key] = StoredValue(
+                        data, suffix, datetime.fromtimestamp(written_at), datetime.fromtimestamp(expires_at)
+                    )
+        return found
+
+    def put_many(self, namespace: str, values: Mapping[str, StoredValue]) -> None:
+        """Store values, replacing any already under the same keys, in one transaction."""
+        rows = [
+            (namespace, key, stored.written_at.timestamp(), stored.expires_at.timestamp(), stored.suffix, stored.raw)
+            for key, stored in values.items()
+        ]
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.executemany('INSERT OR REPLACE INTO cache_values VALUES (?, ?, ?, ?, ?, ?)', rows)
+        if time.monotonic() - self._last_evicted >= self.evict_interval_s:
+            self.evict(datetime.now())
+
+    def evict(self, now: datetime) -> int:
+        """Delete every value that has expired by now, in any namespace, returning how many were."""
+        with self._lock:
+            self._last_evicted = time.monotonic()
+            evicted = self._connect().execute('DELETE FROM cache_values WHERE expires_at <= ?', (now.timestamp(),))
+            log.debug(f'Evicted {evicted.rowcount} expired values from {self.path}')
+            return evicted.rowcount
+
+    def clear(self, namespace: str) -> None:
+        """Delete every value in a namespace."""
+        with self._lock:
+            self._connect().execute('DELETE FROM cache_values WHERE namespace = ?', (namespace,))
+
+    def close(self) -> None:
+        """Close this process's connection, if open."""
+        with self._lock:
+            if self._connection is not None and self._connected_pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+# shared by every KeyedCache that chooses SQLite, so they all use one connection per process
+SQLITE_BACKEND = SQLiteCacheBackend(Path(CACHE_SQLITE_PATH), CACHE_SQLITE_EVICT_INTERVAL_S)
+
+
+class KeyedCache:
+    """A cache holding a value per key, each with a timeout, in a backend that persists between restarts.
+
+    Like SimpleCache, values have a soft timeout (max_age_s), after which they are stale, and a hard
+    timeout (hard_max_age_s), after which they are gone. Stale values are only returned by get_entries(),
+    so that callers can choose to use them while a refresh happens elsewhere.
+
+    Values are written using the given serializer, but values written using any serializer can be read.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_age_s: float,
+        backend: Optional[CacheBackend] = None,
+        hard_max_age_s: Optional[float] = None,
+        serializer: Serializer = JSON,
+    ):
+        self.name = name
+        self.serializer = serializer
+        self.max_age_s = max_age_s
+        self.hard_max_age_s = max_age_s if hard_max_age_s is None else hard_max_age_s
+        self.backend = FileCacheBackend() if backend is None else backend
+
+        assert self.max_age_s >= 0
+        assert self.hard_max_age_s >= self.max_age_s
+
+    def get(self, key: str) -> Any:
+        """Return the current value under a key, or None if there isn't one."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Return the current values under any of the given keys."""
+        return {key: entry.data for key, entry in self.get_entries(keys).items() if not entry.is_stale}
+
+    def get_entries(self, keys: Iterable[str]) -> Dict[str, CacheEntry]:
+        """Return the values under any of the given keys, including stale ones, with when they were written."""
+        keys = list(keys)
+        now = datetime.now()
+        entries = {}
+        for key, stored in self.backend.get_many(self.name, keys, now).items():
+            is_stale = (now - stored.written_at).total_seconds() > self.max_age_s
+            data = SERIALIZERS[stored.suffix].loads(stored.raw)
+            entries[key] = CacheEntry(data=data, written_at=stored.written_at, is_stale=is_stale)
+        n_stale = sum(entry.is_stale for entry in entries.values())
+        for result, count in (('hit', len(entries) - n_stale), ('stale', n_stale), ('miss', len(keys) - len(entries))):
+            if count:
+                CACHE_READS.labels(self.name, result, self.backend.name).inc(count)
+        return entries
+
+    def put(self, key: str, data: Any) -> None:
+        """Cache a value under a key."""
+        self.put_many({key: data})
+
+    def put_many(self, values: Mapping[str, Any]) -> None:
+        """Cache values under their keys, all written at once."""
+        written_at = datetime.now()
+        expires_at = written_at + timedelta(seconds=self.hard_max_age_s)
+        self.backend.put_many(
+            self.name,
+            {
+                key: StoredValue(self.serializer.dumps(data), self.serializer.suffix, written_at, expires_at)
+                for key, data in values.items()
+            },
+        )
+        log.debug(f'{len(values)} values added to {self.name} cache.')
+
+    def clear(self) -> None:
+        """Clear the cache."""
+        self.backend.clear(self.name)
+        log.debug(f'{self.name} cache cleared.')
@@ -1,18 +1,38 @@
 import asyncio
 import json
 import logging
-import re
+import math
+import time
 from contextlib import asynccontextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 from importlib.resources import files
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Literal, Optional, Tuple
 from zoneinfo import ZoneInfo
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
 from engine import config
-from engine.alerting import alert_via_email
-from engine.sensors import poll_all_sensors
+from engine.alerting import ALERTS
+from engine.broadcast import Broadcaster
+from engine.cors import DynamicCORSMiddleware
+from engine.history import NowcastHistory
+from engine.metrics import REGISTRY, MetricsMiddleware
+from engine.scheduler import RefreshScheduler, RefreshSlots, RefreshWindow
+from engine.serialization import dumps_json
 from engine.simple_cache import SimpleCache
+from engine.single_flight import SingleFlight
+from engine.snapshot import UINT16_MISSING, NowcastSnapshot, oa_densities
+from engine.versions import NowcastVersions
+from engine.workers import LeaderLock, SharedMetrics, SharedSnapshotFile, SharedTilesFile
+from scrapers.browser_pool import BROWSER_POOL
+from scrapers.http_client import HTTP_CLIENT
+
+# Geometry handling pulls in geopandas and shapely, so it is only imported once the lifespan has started
+if TYPE_CHECKING:
+    from engine.spatial import OASpatialIndex
+    from engine.tiles import DensityTiles
 
 try:
     from trade_secrets.model import generate_nowcast
@@ -21,7 +41,35 @@ try:
 except ImportError:
     TRADE_SECRETS_AVAILABLE = False
 
-NOWCAST_CACHE = SimpleCache('nowcast', config.NOWCAST_CACHE_TIMEOUT_S)
+NOWCAST_CACHE = SimpleCache(
+    'nowcast', config.NOWCAST_CACHE_TIMEOUT_S, hard_max_age_s=config.NOWCAST_CACHE_HARD_TIMEOUT_S
+)
+# The nowcast currently being served (the latest version) and a few before it, pre-serialized
+# so that requests don't need to touch the cache files.
+NOWCAST_VERSIONS = NowcastVersions(config.NOWCAST_VERSIONS_KEPT)
+# Every nowcast generated, for /nowcast/history
+NOWCAST_HISTORY = NowcastHistory('nowcast_history', config.NOWCAST_HISTORY_ROWS)
+# Announces each new nowcast version to clients subscribed to /nowcast/events
+NOWCAST_EVENTS = Broadcaster()
+# Announces, within a follower, each nowcast loaded from the refresher, including the same version generated
+# again (which isn't a new version, so isn't announced to clients), for followers waiting on a refresh
+SHARED_NOWCAST_LOADS = Broadcaster()
+# Concurrent refreshes (e.g. a burst of requests against a cold cache) share one in-flight refresh
+NOWCAST_REFRESHES = SingleFlight()
+# OA geometries for spatial queries, loaded at startup (None if they couldn't be loaded)
+OA_SPATIAL_INDEX: Optional['OASpatialIndex'] = None
+# Density vector tiles of the same OAs (None if they couldn't be loaded), re-rendered after each new nowcast
+DENSITY_TILES: Optional['DensityTiles'] = None
+TILE_RENDERS = SingleFlight()
+# Which worker process refreshes the nowcast, and how it shares the nowcast and tiles with the others
+REFRESHER_LOCK = LeaderLock(Path(config.CACHE_ROOT) / 'refresher.lock')
+SHARED_SNAPSHOT = SharedSnapshotFile(Path(config.CACHE_ROOT) / 'nowcast.snapshot')
+SHARED_TILES = SharedTilesFile(Path(config.CACHE_ROOT) / 'density.tiles')
+SHARED_METRICS = SharedMetrics(Path(config.CACHE_ROOT) / 'metrics', config.METRICS_SHARED_MAX_AGE_S)
+# When the refresher will next refresh each source, for /refresh/schedule
+REFRESH_SCHEDULE_PATH = Path(config.CACHE_ROOT) / 'refresh_schedule.json'
+# Set by the lifespan in workers that lose the election; without a lifespan (e.g. in tests) we refresh ourselves
+IS_FOLLOWER = False
 
 logging.basicConfig(
     level=config.LOGGING_LEVEL,
@@ -31,7 +79,42 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 
+async def poll_all_sensors():
+    """Poll every sensor.
+
+    The scrapers (and with them pandas, geopandas, OpenCV, BeautifulSoup and Playwright) are only
+    imported the first time this runs, which keeps startup quick for workers that only serve nowcasts.
+    """
+    from engine.sensors import poll_all_sensors as poll
+
+    return await poll()
+
+
 async def refresh_cached_nowcast() -> dict:
+    """Generate, cache and publish a new nowcast.
+
+    Callers arriving while a refresh is already running share its result
+    rather than polling the sensors (and launching browsers) again.
+    Follower workers don't poll the sensors at all, but wait for the refresher.
+    """
+    return await NOWCAST_REFRESHES.do('nowcast', _refresh_nowcast_fn())
+
+
+def _refresh_nowcast_fn():
+    return _wait_for_refresher if IS_FOLLOWER else _generate_and_cache_nowcast
+
+
+async def _wait_for_refresher() -> dict:
+    """Ask the refresher worker for a new nowcast, and wait until it has been shared."""
+    sequence = SHARED_NOWCAST_LOADS.sequence
+    SHARED_SNAPSHOT.request_refresh()
+    _, message = await SHARED_NOWCAST_LOADS.wait_for_message(sequence, config.WORKER_REFRESH_TIMEOUT_S)
+    if message is None:
+        raise TimeoutError(f'The refresher did not share a new nowcast within {config.WORKER_REFRESH_TIMEOUT_S}s')
+    return dict(NOWCAST_VERSIONS.latest.nowcast)
+
+
+async def _generate_and_cache_nowcast() -> dict:
     if TRADE_SECRETS_AVAILABLE:
         nowcast = generate_nowcast(await poll_all_sensors())
     else:
@@ -40,94 +123,461 @@ async def refresh_cached_nowcast() -> dict:
         with data_path.open('r', encoding='utf-8') as f:
             nowcast = json.load(f)
 
+    created_at = datetime.now()
     NOWCAST_CACHE.write(nowcast)
+    SHARED_SNAPSHOT.write(publish_nowcast_snapshot(nowcast, created_at))
+    # after publishing, so that failing to record the nowcast (e.g. with the disk full) can't stop it being served
+    try:
+        NOWCAST_HISTORY.append(oa_densities(nowcast), created_at)
+    except Exception as e:
+        log.error(f'Could not add the nowcast from {created_at} to its history: {e}')
     return nowcast
 
 
-async def nowcast_cache_autorefresh_iteration(now: datetime):
-    if (
-        config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_HOUR <= now.hour <= config.NOWCAST_CACHE_AUTO_REFRESH_LAST_HOUR
-        and config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_WEEKDAY
-        <= now.weekday()
-        <= config.NOWCAST_CACHE_AUTO_REFRESH_LAST_WEEKDAY
-    ):
-        log.info('Autorefreshing cache...')
-        try:
+def publish_nowcast_snapshot(nowcast: dict, created_at: datetime) -> NowcastSnapshot:
+    """Serialize a nowcast once and make it the one served to users."""
+    snapshot = NowcastSnapshot.from_nowcast(nowcast, created_at)
+    publish_snapshot(snapshot)
+    log.debug(
+        f'Published nowcast version {snapshot.version} ({len(snapshot.raw)} bytes raw, '
+        f'{len(snapshot.gzip)} gzip, {len(snapshot.brotli)} brotli)'
+    )
+    return snapshot
+
+
+def publish_snapshot(snapshot: NowcastSnapshot) -> None:
+    """Make a snapshot the one served to users, announcing it if it is a new version."""
+    previous = NOWCAST_VERSIONS.latest
+    NOWCAST_VERSIONS.add(snapshot)
+    if previous is None or previous.version != snapshot.version:
+        NOWCAST_EVENTS.publish(nowcast_version_event(snapshot))
+        # followers load the tiles the refresher renders instead
+        if DENSITY_TILES is not None and not IS_FOLLOWER:
+            TILE_RENDERS.start('tiles', render_density_tiles)
+
+
+async def render_density_tiles() -> None:
+    """Pre-render and share the density tiles for the latest nowcast, again if a newer one arrives meanwhile."""
+    tiles = DENSITY_TILES
+    snapshot = NOWCAST_VERSIONS.latest
+    while snapshot is not None and snapshot.version != tiles.rendered_version:
+        rendered = await asyncio.to_thread(tiles.render_all, snapshot)
+        await asyncio.to_thread(SHARED_TILES.write, snapshot.version, rendered)
+        snapshot = NOWCAST_VERSIONS.latest
+
+
+def load_shared_tiles() -> None:
+    """Serve the density tiles shared by the refresher, if it has shared some for another version than ours."""
+    if DENSITY_TILES is None:
+        return
+    shared = SHARED_TILES.read_if_changed(DENSITY_TILES.rendered_version)
+    if shared is not None:
+        version, rendered = shared
+        DENSITY_TILES.use_rendered(version, rendered)
+        log.info(f'Loaded {len(rendered)} density tiles for nowcast version {version} shared by the refresher')
+
+
+def nowcast_version_event(snapshot: NowcastSnapshot) -> bytes:
+    """Encode the server-sent event announcing a new nowcast version."""
+    data = json.dumps({'version': snapshot.version, 'created_at': snapshot.created_at.isoformat()})
+    return f'event: nowcast\nid: {snapshot.version}\ndata: {data}\n\n'.encode('utf-8')
+
+
+async def current_nowcast_snapshot() -> NowcastSnapshot:
+    """Return the snapshot to serve.
+
+    Falls back to the file cache (e.g. after a restart), and only waits for a fresh nowcast
+    if neither holds one younger than the hard timeout. Stale snapshots are served as they are,
+    while a single refresh runs in the background.
+    """
+    snapshot = NOWCAST_VERSIONS.latest
+    if snapshot is None or snapshot.age_s() > config.NOWCAST_CACHE_HARD_TIMEOUT_S:
+        entry = NOWCAST_CACHE.read_entry()
+        if entry is None:
+            # we need to generate a fresh nowcast for this user
             await refresh_cached_nowcast()
-        except BaseException as e:
-            log.error(f'Cache autorefresh failed with error {e}')
-            alert_via_email(f'Cache autorefresh failed with error {e}')
-        log.info('Cache autorefresh complete.')
-    else:
-        log.debug(
-            'Cache autorefresh watchdog triggered, but did not autorefresh cache '
-            f'as the hour is {now.hour} and the day of the week is {now.weekday()}'
+            return NOWCAST_VERSIONS.latest
+        snapshot = publish_nowcast_snapshot(entry.data, entry.written_at)
+
+    if snapshot.age_s() > config.NOWCAST_CACHE_TIMEOUT_S:
+        log.info('Serving stale nowcast while it is refreshed in the background.')
+        NOWCAST_REFRESHES.start('nowcast', _refresh_nowcast_fn())
+    return snapshot
+
+
+def nowcast_expires_at() -> Optional[datetime]:
+    """Return when the nowcast being served becomes stale, or None if there isn't one."""
+    latest = NOWCAST_VERSIONS.latest
+    if latest is None:
+        return None
+    return latest.created_at + timedelta(seconds=config.NOWCAST_CACHE_TIMEOUT_S)
+
+
+def build_refresh_scheduler() -> RefreshScheduler:
+    """Schedule refreshes of each source during UK working hours, and of the nowcast once they are done.
+
+    Working hours prevent us hammering the sites too much while keeping the site fast.
+    """
+    scheduler = RefreshScheduler(
+        REFRESH_SCHEDULE_PATH, ZoneInfo(config.REFRESH_TIMEZONE), config.REFRESH_SCHEDULER_MAX_SLEEP_S
+    )
+    window = RefreshWindow(
+        first_hour=config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_HOUR,
+        last_hour=config.NOWCAST_CACHE_AUTO_REFRESH_LAST_HOUR,
+        first_weekday=config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_WEEKDAY,
+        last_weekday=config.NOWCAST_CACHE_AUTO_REFRESH_LAST_WEEKDAY,
+    )
+    # the mock nowcast doesn't use the sensors, so there's no need to scrape them without the trade secrets
+    if TRADE_SECRETS_AVAILABLE:
+        from engine.sensors import refresh_edintraveldata, refresh_essential_edinburgh
+        from scrapers.edintraveldata import ETD_CACHE
+        from scrapers.essential_edinburgh import EE_CACHE
+
+        scheduler.register(
+            'essential_edinburgh',
+            refresh_essential_edinburgh,
+            EE_CACHE.expires_at,
+            RefreshSlots(config.EE_CACHE_TIMEOUT_S, config.EE_REFRESH_OFFSET_S, config.EE_REFRESH_JITTER_S, window),
+        )
+        scheduler.register(
+            'edintraveldata',
+            refresh_edintraveldata,
+            ETD_CACHE.expires_at,
+            RefreshSlots(config.ETD_CACHE_TIMEOUT_S, config.ETD_REFRESH_OFFSET_S, config.ETD_REFRESH_JITTER_S, window),
         )
+    scheduler.register(
+        'nowcast',
+        refresh_cached_nowcast,
+        nowcast_expires_at,
+        RefreshSlots(
+            config.NOWCAST_CACHE_TIMEOUT_S, config.NOWCAST_REFRESH_OFFSET_S, config.NOWCAST_REFRESH_JITTER_S, window
+        ),
+    )
+    return scheduler
+
+
+def load_shared_snapshot() -> None:
+    """Serve the nowcast shared by the refresher, if it has shared one we haven't seen that is newer than ours."""
+    latest = NOWCAST_VERSIONS.latest
+    shared = SHARED_SNAPSHOT.read_if_changed(latest)
+    if shared is not None and (latest is None or shared.created_at > latest.created_at):
+        log.info(f'Loaded nowcast version {shared.version} created at {shared.created_at} shared by the refresher')
+        publish_snapshot(shared)
+        SHARED_NOWCAST_LOADS.publish(shared.version.encode('ascii'))
+
+
+async def coordinate_workers():
+    """Take part in electing the refresher worker, and keep up with the nowcasts it shares.
+
+    Whichever worker holds REFRESHER_LOCK runs the refresh scheduler, answers other workers'
+    requests for a refresh and renders the density tiles. The others keep trying to take the lock, so
+    that one takes over if the refresher dies. With a single worker, it is always the refresher.
+    Every worker also shares its metrics every METRICS_SHARE_INTERVAL_S.
+    """
+    global IS_FOLLOWER
+    IS_FOLLOWER = True
+    scheduler = None
+    metrics_shared_at = -math.inf
+    try:
+        while True:
+            if scheduler is None and REFRESHER_LOCK.try_acquire():
+                log.info('This worker is the refresher')
+                IS_FOLLOWER = False
+                scheduler = asyncio.create_task(build_refresh_scheduler().run())
+                if DENSITY_TILES is not None:
+                    # in case we took over before the previous refresher rendered the latest tiles
+                    TILE_RENDERS.start('tiles', render_density_tiles)
+            load_shared_snapshot()
+            if IS_FOLLOWER:
+                load_shared_tiles()
+            if time.monotonic() >= metrics_shared_at + config.METRICS_SHARE_INTERVAL_S:
+                SHARED_METRICS.write(REGISTRY.dump())
+                metrics_shared_at = time.monotonic()
+            if not IS_FOLLOWER and SHARED_SNAPSHOT.refresh_requested():
+                log.info('Refreshing the nowcast as another worker asked for it')
+                NOWCAST_REFRESHES.start('nowcast', _generate_and_cache_nowcast)
+            await asyncio.sleep(config.WORKER_POLL_INTERVAL_S)
+    finally:
+        if scheduler is not None:
+            scheduler.cancel()
+            try:
+                await scheduler
+            except asyncio.CancelledError:
+                log.debug('Refresh scheduler shutdown')
+        REFRESHER_LOCK.release()
+        IS_FOLLOWER = False
+
+
+def warm_nowcast_snapshot() -> None:
+    """Load the latest nowcast into memory, if there is one, so that the first requests don't have to."""
+    load_shared_snapshot()
+    if NOWCAST_VERSIONS.latest is None:
+        entry = NOWCAST_CACHE.read_entry()
+        if entry is not None:
+            publish_nowcast_snapshot(entry.data, entry.written_at)
+
+
+def _load_oa_geometries() -> Tuple['OASpatialIndex', 'DensityTiles']:
+    from engine.spatial import OASpatialIndex
+    from engine.tiles import DensityTiles
+
+    index = OASpatialIndex.from_source(config.OA_GEOMETRY_SOURCE)
+    return index, DensityTiles(index, config.DENSITY_TILES_MIN_ZOOM, config.DENSITY_TILES_MAX_ZOOM)
 
 
-async def nowcast_cache_autorefresh():
-    log.debug('Cache autorefresh watchdog started')
-    while True:
-        await asyncio.sleep(config.NOWCAST_CACHE_AUTO_REFRESH_INTERVAL_S)
-        uk_time = datetime.now(ZoneInfo('Europe/London'))
-        await nowcast_cache_autorefresh_iteration(uk_time)
+async def load_oa_geometries() -> None:
+    """Load the OA geometries used to answer spatial queries and render density tiles.
+
+    Spatial queries and tiles are unavailable (503) until this has finished.
+    """
+    global OA_SPATIAL_INDEX, DENSITY_TILES
+    if config.OA_GEOMETRY_SOURCE is None:
+        log.warning('POSTGIS_PASSWORD is missing from the .env file, spatial queries are disabled')
+        return
+    try:
+        OA_SPATIAL_INDEX, DENSITY_TILES = await asyncio.to_thread(_load_oa_geometries)
+    except Exception as e:
+        log.warning(f'Could not load OA geometries, spatial queries are disabled: {e}')
+        return
+    if IS_FOLLOWER:
+        load_shared_tiles()
+    elif NOWCAST_VERSIONS.latest is not None:
+        TILE_RENDERS.start('tiles', render_density_tiles)
 
 
 @asynccontextmanager
 async def lifespan_manager(_: FastAPI):
-    """Create an async task that automatically refreshes the cache.
+    """Create an async task that refreshes the nowcast and its sources on schedule.
+
+    Each is refreshed just before its cache expires, but only between 0800 and 1800 UK time
+    (see build_refresh_scheduler). With several workers, only one of them does this (see coordinate_workers).
 
-    The cache is refreshed every NOWCAST_CACHE_TIMEOUT_S, but only between 0800 and 1800 UK time.
-    This prevents us hammering the sites too much while keeping the site fast.
+    The latest nowcast is loaded before we start accepting requests, but the OA geometries are
+    loaded in the background, as only spatial queries and tiles need them. Alerts are emailed
+    in the background too. The browser and HTTP client used for scraping are kept open until shutdown.
     """
-    watchdog = asyncio.create_task(nowcast_cache_autorefresh())
+    warm_nowcast_snapshot()
+    alerts = asyncio.create_task(ALERTS.run())
+    geometries = asyncio.create_task(load_oa_geometries())
+    coordinator = asyncio.create_task(coordinate_workers())
     try:
         yield
     finally:
-        watchdog.cancel()
+        geometries.cancel()
+        coordinator.cancel()
         try:
-            await watchdog
+            await coordinator
         except asyncio.CancelledError:
-            log.debug('Cache autorefresh watchdog shutdown')
+            log.debug('Worker coordination shutdown')
+        await BROWSER_POOL.close()
+        await HTTP_CLIENT.close()
+        # after the coordinator, so that any alerts raised as it stops are sent
+        alerts.cancel()
+        try:
+            await alerts
+        except asyncio.CancelledError:
+            log.debug('Alert dispatcher shutdown')
 
 
 app = FastAPI(lifespan=lifespan_manager)
 
+# Custom response headers that the frontend needs to be able to read
+NOWCAST_EXPOSED_HEADERS = (
+    'X-Nowcast-Version, X-Nowcast-Age, X-Nowcast-Stale, X-Nowcast-Index, X-Nowcast-Dtype, X-Nowcast-Scale'
+)
+
 
-def is_vercel_preview_deployment(url: str) -> bool:
-    return bool(re.fullmatch(r'https://edicrowds-frontend-[a-z0-9\-]+-tristan-goss-projects\.vercel\.app', url))
+app.add_middleware(DynamicCORSMiddleware, expose_headers=NOWCAST_EXPOSED_HEADERS, max_age_s=config.CORS_MAX_AGE_S)
+# added last so that it is outermost, and times everything else
+app.add_middleware(MetricsMiddleware)
 
 
-@app.middleware('http')
-async def dynamic_cors_middleware(request: Request, call_next):
-    """Custom CORS Middleware to support vercel preview deployments.
+def nowcast_freshness_headers(snapshot: NowcastSnapshot) -> Dict[str, str]:
+    """Headers reporting which nowcast this is, how old it is and whether it is stale (i.e. being refreshed)."""
+    age_s = snapshot.age_s()
+    return {
+        'X-Nowcast-Version': snapshot.version,
+        'X-Nowcast-Age': str(int(age_s)),
+        'X-Nowcast-Stale': 'true' if age_s > config.NOWCAST_CACHE_TIMEOUT_S else 'false',
+    }
 
-    Allows access if it's a local Vite dev server,
-    the production build, or a vercel preview URL.
-    """
-    origin = request.headers.get('origin')
-    response = await call_next(request)
-    if origin and (
-        origin
-        in {
-            'https://www.edinburghcrowds.co.uk',
-            'http://localhost:5173',
-        }
-        or is_vercel_preview_deployment(origin)
-    ):
-        response.headers['Access-Control-Allow-Origin'] = origin
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
-        response.headers['Access-Control-Allow-Methods'] = '*'
-        response.headers['Access-Control-Allow-Headers'] = '*'
-    return response
+
+def parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    """Parse a "min_lon,min_lat,max_lon,max_lat" bounding box."""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox.split(','))
+    except ValueError:
+        min_lon = min_lat = max_lon = max_lat = float('nan')
+    if not (min_lon <= max_lon and min_lat <= max_lat):
+        raise HTTPException(status_code=400, detail='bbox must be min_lon,min_lat,max_lon,max_lat')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def require_spatial_index() -> 'OASpatialIndex':
+    if OA_SPATIAL_INDEX is None:
+        raise HTTPException(status_code=503, detail='OA geometries are not available')
+    return OA_SPATIAL_INDEX
 
 
 @app.get('/nowcast')
-async def get_nowcast() -> dict:
-    """Return the current nowcast, generating it if needed."""
-    nowcast = NOWCAST_CACHE.read()
-    if nowcast is None:
-        # we need to generate a fresh nowcast for this user
-        nowcast = await refresh_cached_nowcast()
+async def get_nowcast(request: Request, bbox: Optional[str] = None) -> Response:
+    """Return the current nowcast, generating it if needed.
 
-    return nowcast
+    The body is sent exactly as it was serialized and compressed when the nowcast was produced.
+    If a bbox (min_lon,min_lat,max_lon,max_lat) is given, only the OAs intersecting it are returned.
+    """
+    snapshot = await current_nowcast_snapshot()
+    if bbox is not None:
+        codes = require_spatial_index().codes_in_bbox(*parse_bbox(bbox))
+        densities = oa_densities(snapshot.nowcast)
+        metadata = {key: value for key, value in snapshot.nowcast.items() if key not in densities}
+        subset = {**metadata, **{code: densities[code] for code in codes if code in densities}}
+        return Response(
+            content=dumps_json(subset), media_type='application/json', headers=nowcast_freshness_headers(snapshot)
+        )
+    body, encoding = snapshot.encoded(request.headers.get('accept-encoding'))
+    headers = {'Vary': 'Accept-Encoding', **nowcast_freshness_headers(snapshot)}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+@app.get('/nowcast/at')
+async def get_nowcast_at(lat: float, lon: float) -> Response:
+    """Return the density of the OA containing a point, along with its code and (lon, lat) centroid."""
+    oa = require_spatial_index().oa_at(lat, lon)
+    if oa is None:
+        raise HTTPException(status_code=404, detail='No OA contains this point')
+    code, centroid = oa
+    snapshot = await current_nowcast_snapshot()
+    body = {'code': code, 'density': snapshot.nowcast.get(code), 'centroid': list(centroid)}
+    return Response(
+        content=dumps_json(body), media_type='application/json', headers=nowcast_freshness_headers(snapshot)
+    )
+
+
+@app.get('/nowcast.bin')
+async def get_nowcast_binary(dtype: Literal['float32', 'uint16'] = 'float32') -> Response:
+    """Return the current nowcast as a bare little-endian array, in the OA order given by /nowcast/index.
+
+    uint16 values must be multiplied by the X-Nowcast-Scale header to recover densities, except those equal to the
+    X-Nowcast-Missing header, which (like NaN in float32) mean an OA has no density.
+    The X-Nowcast-Index header identifies the index the array is ordered by.
+    """
+    snapshot = await current_nowcast_snapshot()
+    headers = {**nowcast_freshness_headers(snapshot), 'X-Nowcast-Index': snapshot.index.id, 'X-Nowcast-Dtype': dtype}
+    if dtype == 'uint16':
+        body = snapshot.uint16
+        headers['X-Nowcast-Scale'] = repr(snapshot.uint16_scale)
+        headers['X-Nowcast-Missing'] = str(UINT16_MISSING)
+    else:
+        body = snapshot.float32
+    return Response(content=body, media_type='application/octet-stream', headers=headers)
+
+
+@app.get('/nowcast/index')
+async def get_nowcast_index(request: Request) -> Response:
+    """Return the OA order used by /nowcast.bin.
+
+    The index only changes if the set of OAs does, so clients may keep it and revalidate using its ETag.
+    """
+    snapshot = await current_nowcast_snapshot()
+    headers = {'ETag': f'"{snapshot.index.id}"', 'Cache-Control': 'no-cache'}
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.index.json, media_type='application/json', headers=headers)
+
+
+@app.get('/nowcast/delta')
+async def get_nowcast_delta(since: str) -> Response:
+    """Return only the entries of the current nowcast that have changed since a previous version.
+
+    The body holds the current version, the OAs whose density changed by more than NOWCAST_DELTA_EPSILON,
+    and any entries that were removed. If the previous version is too old (or unknown),
+    the full nowcast is sent instead, flagged with "full": true.
+    """
+    snapshot = await current_nowcast_snapshot()
+    body = NOWCAST_VERSIONS.delta_since(since, config.NOWCAST_DELTA_EPSILON)
+    return Response(content=body, media_type='application/json', headers=nowcast_freshness_headers(snapshot))
+
+
+@app.get('/nowcast/history')
+async def get_nowcast_history(
+    oa: str, start: Optional[datetime] = Query(None, alias='from'), end: Optional[datetime] = Query(None, alias='to')
+) -> dict:
+    """Return the density of one OA in every nowcast generated between from and to (both optional, inclusive)."""
+    series = NOWCAST_HISTORY.series(oa, start, end)
+    if series is None:
+        raise HTTPException(status_code=404, detail=f'No history for OA {oa}')
+    timestamps, densities = series
+    return {'oa': oa, 'timestamps': [t.isoformat() for t in timestamps], 'densities': densities}
+
+
+@app.get('/tiles/{z}/{x}/{y}.pbf')
+async def get_density_tile(request: Request, z: int, x: int, y: int) -> Response:
+    """Return a vector tile of the OAs, each carrying its current density (with the OA code_uint as its id).
+
+    Tiles with no OAs in them are 204 No Content. The ETag is the nowcast version, so clients can revalidate.
+    """
+    if DENSITY_TILES is None:
+        raise HTTPException(status_code=503, detail='OA geometries are not available')
+    if not DENSITY_TILES.covers(z, x, y):
+        raise HTTPException(
+            status_code=404,
+            detail=f'Tiles are only served at zooms {DENSITY_TILES.min_zoom} to {DENSITY_TILES.max_zoom}',
+        )
+    snapshot = await current_nowcast_snapshot()
+    headers = {'ETag': f'"{snapshot.version}"', 'Cache-Control': 'no-cache', **nowcast_freshness_headers(snapshot)}
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    tile = DENSITY_TILES.get(z, x, y, snapshot)
+    if not tile:
+        return Response(status_code=204, headers=headers)
+    return Response(content=tile, media_type='application/vnd.mapbox-vector-tile', headers=headers)
+
+
+@app.get('/refresh/schedule')
+async def get_refresh_schedule() -> Response:
+    """Return when the nowcast and each of its sources expire and will next be refreshed, and how each last went."""
+    try:
+        body = REFRESH_SCHEDULE_PATH.read_bytes()
+    except FileNotFoundError:
+        raise HTTPException(status_code=503, detail='No worker has started refreshing yet') from None
+    return Response(content=body, media_type='application/json')
+
+
+@app.get('/metrics')
+async def get_metrics() -> Response:
+    """Return request latencies, cache hit rates, scraping times and autorefresh outcomes, for Prometheus.
+
+    These are summed over every worker, as last shared by the others (see coordinate_workers).
+    """
+    others = await asyncio.to_thread(SHARED_METRICS.read_others)
+    return Response(content=REGISTRY.render(others), media_type='text/plain; version=0.0.4')
+
+
+async def nowcast_event_stream():
+    NOWCAST_EVENTS.subscribers += 1
+    try:
+        # starting from 0 means new subscribers are told the current version straight away
+        sequence = 0
+        while True:
+            sequence, message = await NOWCAST_EVENTS.wait_for_message(sequence, config.NOWCAST_EVENTS_HEARTBEAT_S)
+            # the heartbeat comment stops idle connections being timed out by nginx
+            yield b': heartbeat\n\n' if message is None else message
+    finally:
+        NOWCAST_EVENTS.subscribers -= 1
+
+
+@app.get('/nowcast/events')
+async def get_nowcast_events() -> StreamingResponse:
+    """Stream a server-sent event whenever a new nowcast version is published.
+
+    Each event carries only the new version id and when it was created;
+    clients can then fetch /nowcast/delta?since=<the version they hold>.
+    """
+    return StreamingResponse(
+        nowcast_event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
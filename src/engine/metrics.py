@@ -0,0 +1,306 @@
+"""Counters and histograms, served in the Prometheus text format at /metrics.
+
+Recording a value is meant to be cheap enough not to show up in the timings being recorded:
+each combination of label values gets its own child the first time it is used, after which
+recording is a dictionary lookup and a few in-place additions, without any locks. Nearly everything
+is recorded from the event loop; updates from worker threads rely on the GIL, and in the unlikely
+event of two threads updating the same child at once an observation could be lost, which is fine
+for monitoring.
+
+Each worker process records its own values. Workers share them by dumping them (see SharedMetrics in
+engine.workers), and /metrics renders the sum of every live worker's values, as counts and histograms add up.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import orjson
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Suitable for anything from a cache lookup to a page load
+DEFAULT_BUCKETS_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25)
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    if not label_names:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in label_values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(label_names, escaped, strict=True)) + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the count."""
+        self.value += amount
+
+    def state(self) -> List[Any]:
+        """Return the count, for dumping."""
+        return [self.value]
+
+    def add_state(self, value: float) -> None:
+        """Add a dumped count to this one."""
+        self.value += value
+
+
+class HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # one count per bucket plus +Inf, not cumulative (they are only summed when rendered)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record a value."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def state(self) -> List[Any]:
+        """Return the bucket counts and sum, for dumping."""
+        return [list(self.counts), self.sum]
+
+    def add_state(self, counts: List[int], total: float) -> None:
+        """Add dumped bucket counts and sum to these (ignored if the buckets have since changed)."""
+        if len(counts) == len(self.counts):
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.sum += total
+
+    @contextmanager
+    def time(self, clock: Callable[[], float] = time.perf_counter) -> Iterator[None]:
+        """Record how long a block takes, by the given clock (e.g. time.thread_time for CPU time)."""
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(clock() - start)
+
+
+class _Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *label_values: str):
+        """Return the child for a combination of label values, creating it the first time."""
+        child = self._children.get(label_values)
+        if child is None:
+            assert len(label_values) == len(self.label_names), f'{self.name} takes labels {self.label_names}'
+            child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """Return a child for a new combination of label values, with nothing recorded yet."""
+
+    @abstractmethod
+    def _samples(self, children: Dict[Tuple[str, ...], Any]) -> Iterator[str]:
+        """Render the samples of each child, as lines of the Prometheus text format."""
+
+    def state(self) -> List[List[Any]]:
+        """Return the label values and state of each child, for dumping."""
+        return [[list(label_values), *child.state()] for label_values, child in list(self._children.items())]
+
+    def render(self, other_states: Iterable[List[List[Any]]] = ()) -> str:
+        """Render the metric in the Prometheus text format, summed with other (e.g. other workers') dumped states."""
+        children = {}
+        for state in (self.state(), *other_states):
+            for label_values, *child_state in state:
+                child = children.get(tuple(label_values))
+                if child is None:
+                    child = children[tuple(label_values)] = self._new_child()
+                child.add_state(*child_state)
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}', *self._samples(children)]
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the count of a counter without labels."""
+        self.labels().inc(amount)
+
+    def _samples(self, children: Dict[Tuple[str, ...], CounterChild]) -> Iterator[str]:
+        for label_values, child in children.items():
+            yield f'{self.name}{_format_labels(self.label_names, label_values)} {_format_value(child.value)}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS_S,
+    ):
+        super().__init__(name, description, label_names)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.bounds)
+
+    def observe(self, value: float) -> None:
+        """Record a value in a histogram without labels."""
+        self.labels().observe(value)
+
+    def time(self, clock: Callable[[], float] = time.perf_counter):
+        """Time a block in a histogram without labels."""
+        return self.labels().time(clock)
+
+    def _samples(self, children: Dict[Tuple[str, ...], HistogramChild]) -> Iterator[str]:
+        for label_values, child in children.items():
+            counts = child.counts
+            cumulative = 0
+            for bound, count in zip([*self.bounds, float('inf')], counts, strict=True):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                labels = _format_labels((*self.label_names, 'le'), (*label_values, le))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.label_names, label_values)
+            yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def counter(self, name: str, description: str, label_names: Sequence[str] = ()) -> Counter:
+        """Create and register a counter."""
+        return self._register(Counter(name, description, label_names))
+
+    def histogram(
+        self, name: str, description: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS_S
+    ) -> Histogram:
+        """Create and register a histogram."""
+        return self._register(Histogram(name, description, label_names, buckets))
+
+    def _register(self, metric: _Metric) -> _Metric:
+        assert all(m.name != metric.name for m in self.metrics), f'{metric.name} is already registered'
+        self.metrics.append(metric)
+        return metric
+
+    def dump(self) -> bytes:
+        """Encode every metric's values, to be summed with those of other workers by render()."""
+        return orjson.dumps({metric.name: metric.state() for metric in self.metrics})
+
+    def render(self, other_dumps: Iterable[bytes] = ()) -> str:
+        """Render every metric in the Prometheus text format, summed with those in other dumps."""
+        others = [orjson.loads(dump) for dump in other_dumps]
+        return ''.join(metric.render([other.get(metric.name, []) for other in others]) for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    'edicrowds_http_request_duration_seconds',
+    'Time taken to respond to requests, until the response body was sent.',
+    ('method', 'route', 'status'),
+)
+CACHE_READS = REGISTRY.counter(
+    'edicrowds_cache_reads_total',
+    'Reads of each cache, by whether they hit, missed or found stale data, and where they were read from.',
+    ('cache', 'result', 'tier'),
+)
+PAGE_LOAD_DURATION = REGISTRY.histogram(
+    'edicrowds_playwright_page_load_seconds',
+    'Time taken for scraped pages to load until the element showing they have rendered appears, '
+    'by site and whether they loaded or timed out.',
+    ('site', 'outcome'),
+    buckets=(0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60),
+)
+PAGE_BYTES = REGISTRY.histogram(
+    'edicrowds_playwright_page_bytes',
+    'Bytes transferred (response headers and bodies) loading each scraped page, by site.',
+    ('site',),
+    buckets=(1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7),
+)
+BLOCKED_REQUESTS = REGISTRY.counter(
+    'edicrowds_playwright_blocked_requests_total',
+    'Requests made by scraped pages that were blocked, by site and resource type.',
+    ('site', 'resource_type'),
+)
+PAGE_FETCHES = REGISTRY.counter(
+    'edicrowds_scraper_page_fetches_total',
+    'Pages fetched by scrapers, by site and whether they were fetched over plain HTTP or in the browser.',
+    ('site', 'path'),
+)
+SCRAPE_ATTEMPTS = REGISTRY.counter(
+    'edicrowds_scraper_page_attempts_total',
+    'Attempts at fetching pages by scrapers, by host and whether they succeeded, failed (and may be retried), '
+    'or were cut short by the deadline for the scrape.',
+    ('host', 'outcome'),
+)
+BROWSER_LAUNCHES = REGISTRY.counter(
+    'edicrowds_playwright_browser_launches_total',
+    'Launches of the headless browser used for scraping, by why it was (re)launched.',
+    ('reason',),
+)
+EXTRACT_LINES_CPU = REGISTRY.histogram(
+    'edicrowds_extract_lines_cpu_seconds', 'CPU time spent extracting lines from Essential Edinburgh graphs.'
+)
+SENSOR_MERGE_DURATION = REGISTRY.histogram(
+    'edicrowds_poll_all_sensors_merge_seconds', 'Time spent tabulating and merging sensor measurements.'
+)
+AUTOREFRESHES = REGISTRY.counter(
+    'edicrowds_scheduled_refreshes_total',
+    'Scheduled refreshes of each source (and the nowcast), by whether they refreshed or failed.',
+    ('source', 'outcome'),
+)
+
+
+# Methods recorded as they are; any other method a client sends is recorded as 'other', so that clients can't
+# create an unbounded number of series
+HTTP_METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+
+
+class MetricsMiddleware:
+    """Record the latency of every request, labelled by route template (so /tiles/{z}/{x}/{y}.pbf is one route)."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Time the request, recording it once the response has finished (or failed)."""
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_note_status(message: Message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_note_status)
+        finally:
+            # the router adds the matched route to the scope
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            method = scope['method'] if scope['method'] in HTTP_METHODS else 'other'
+            HTTP_REQUEST_DURATION.labels(method, route, str(status)).observe(time.perf_counter() - start)
@@ -0,0 +1,159 @@
+"""Just enough of the Mapbox Vector Tile format (v2.1) to encode a layer of polygons.
+
+See https://github.com/mapbox/vector-tile-spec/tree/master/2.1 for the protobuf schema.
+Features are encoded in two parts, so that the geometry of a feature can be cached while its
+attributes change: protobuf allows a message's fields to be written in any order, so a feature is just
+its (cached) id, type and geometry fields followed by its tags.
+"""
+
+import struct
+from typing import Iterable, List, Sequence, Tuple
+
+import numpy as np
+import shapely
+
+# Protobuf wire types
+VARINT = 0
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+# Each varint byte carries 7 bits, with the top bit set on all but the last
+VARINT_PAYLOAD = 0x7F
+VARINT_CONTINUES = 0x80
+
+POLYGON = 3
+MVT_VERSION = 2
+MIN_RING_POINTS = 3
+
+
+def varint(value: int) -> bytes:
+    """Encode a non-negative integer as a protobuf varint."""
+    out = bytearray()
+    while value > VARINT_PAYLOAD:
+        out.append((value & VARINT_PAYLOAD) | VARINT_CONTINUES)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value: int) -> int:
+    """Map a signed integer to an unsigned one, so that small magnitudes stay small."""
+    return (value << 1) ^ (value >> 31)
+
+
+def field_key(field: int, wire_type: int) -> bytes:
+    return varint((field << 3) | wire_type)
+
+
+def varint_field(field: int, value: int) -> bytes:
+    return field_key(field, VARINT) + varint(value)
+
+
+def bytes_field(field: int, value: bytes) -> bytes:
+    return field_key(field, LENGTH_DELIMITED) + varint(len(value)) + value
+
+
+def packed_field(field: int, values: Iterable[int]) -> bytes:
+    return bytes_field(field, b''.join(varint(v) for v in values))
+
+
+def command(command_id: int, count: int) -> int:
+    return (command_id & 0x7) | (count << 3)
+
+
+def _ring_points(ring: shapely.LinearRing) -> np.ndarray:
+    """Round a ring to integer tile coordinates, dropping repeated points and the closing point."""
+    points = np.rint(shapely.get_coordinates(ring)).astype(np.int64)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    points = points[keep]
+    if len(points) > 1 and np.array_equal(points[0], points[-1]):
+        points = points[:-1]
+    return points
+
+
+def _signed_area(points: np.ndarray) -> int:
+    """Twice the signed area of a ring, positive if it winds clockwise on screen (y down)."""
+    x, y = points[:, 0], points[:, 1]
+    return int(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y))
+
+
+def polygon_commands(geometry: shapely.Geometry) -> List[int]:
+    """Encode the polygons in a geometry (in integer tile coordinates) as MVT geometry commands.
+
+    Exterior rings are wound to have a positive area and interior rings a negative one, as the spec requires.
+    Rings that collapse to nothing once rounded are dropped, along with the holes of dropped exteriors.
+    """
+    commands = []
+    cursor = (0, 0)
+    for polygon in shapely.get_parts(geometry):
+        if not isinstance(polygon, shapely.Polygon) or polygon.is_empty:
+            continue
+        for i, ring in enumerate([polygon.exterior, *polygon.interiors]):
+            points = _ring_points(ring)
+            area = _signed_area(points) if len(points) >= MIN_RING_POINTS else 0
+            if area == 0:
+                if i == 0:
+                    break
+                continue
+            if (area > 0) != (i == 0):
+                points = points[::-1]
+            deltas = np.diff(points, axis=0, prepend=[cursor])
+            cursor = tuple(points[-1])
+            commands.append(command(MOVE_TO, 1))
+            commands.extend(zigzag(int(d)) for d in deltas[0])
+            commands.append(command(LINE_TO, len(points) - 1))
+            commands.extend(zigzag(int(d)) for d in deltas[1:].ravel())
+            commands.append(command(CLOSE_PATH, 1))
+    return commands
+
+
+def polygon_feature_geometry(feature_id: int, geometry: shapely.Geometry) -> bytes:
+    """Encode a feature's id, type and geometry fields, or return b'' if nothing of the geometry is left."""
+    commands = polygon_commands(geometry)
+    if not commands:
+        return b''
+    return varint_field(1, feature_id) + varint_field(3, POLYGON) + packed_field(4, commands)
+
+
+def feature(geometry_fields: bytes, tags: Sequence[int]) -> bytes:
+    """Complete a feature by adding its tags (alternating key and value indices) to its geometry fields."""
+    body = geometry_fields + packed_field(2, tags) if tags else geometry_fields
+    return bytes_field(2, body)
+
+
+def float_value(value: float) -> bytes:
+    return bytes_field(4, field_key(2, FIXED32) + struct.pack('<f', value))
+
+
+def layer(name: str, features: Sequence[bytes], keys: Sequence[str], values: Sequence[bytes], extent: int) -> bytes:
+    """Encode a complete layer (as a tile field) from encoded features and values."""
+    body = b''.join(
+        [
+            varint_field(15, MVT_VERSION),
+            bytes_field(1, name.encode('utf-8')),
+            *features,
+            *(bytes_field(3, key.encode('utf-8')) for key in keys),
+            *values,
+            varint_field(5, extent),
+        ]
+    )
+    return bytes_field(3, body)
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Return a tile's bounds in world coordinates (web mercator scaled to [0, 1], y down)."""
+    size = 1 / (1 << z)
+    return x * size, y * size, (x + 1) * size, (y + 1) * size
+
+
+def lon_lat_to_world(coords: np.ndarray) -> np.ndarray:
+    """Project (lon, lat) coordinates to world coordinates (web mercator scaled to [0, 1], y down)."""
+    lon = coords[:, 0]
+    lat = np.radians(np.clip(coords[:, 1], -85.0511, 85.0511))
+    return np.column_stack([(lon + 180) / 360, (1 - np.arcsinh(np.tan(lat)) / np.pi) / 2])
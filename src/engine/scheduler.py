@@ -0,0 +1,205 @@
+"""Refreshing each data source on its own schedule, before its cached data expires.
+
+Each source is refreshed every cadence, at fixed slots aligned to Monday 00:00 local time (so hourly
+sources are refreshed at the same minute past every hour, and weekly ones at the same time every week).
+Slots are shifted by an offset into the cadence, plus a jitter drawn once when the source is registered,
+so that refreshes don't drift but also don't all hit the scraped sites on the same second.
+
+A source whose cache holds nothing, or whose cache will expire before its next slot (e.g. as it was
+last written at an odd time), is refreshed straight away or as it expires instead. Slots outside a
+source's working-hours window are skipped.
+
+Only the refresher worker runs the scheduler, so its status is written to a file that any worker can serve.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+from zoneinfo import ZoneInfo
+
+from engine.alerting import ALERTS
+from engine.metrics import AUTOREFRESHES
+
+log = logging.getLogger(__name__)
+
+WEEK = timedelta(days=7)
+
+
+@dataclass(frozen=True, kw_only=True)
+class RefreshWindow:
+    """Working hours (inclusive, local time) outside of which a source isn't refreshed."""
+
+    first_hour: int
+    last_hour: int
+    first_weekday: int
+    last_weekday: int
+
+    def contains(self, dt: datetime) -> bool:
+        """Return whether a (local) time falls within working hours."""
+        return self.first_hour <= dt.hour <= self.last_hour and self.first_weekday <= dt.weekday() <= self.last_weekday
+
+
+@dataclass(frozen=True)
+class RefreshSlots:
+    """Every cadence_s, offset_s plus up to jitter_s into the cadence, skipping any outside the window."""
+
+    cadence_s: float
+    offset_s: float = 0
+    jitter_s: float = 0
+    window: Optional[RefreshWindow] = None
+
+
+@dataclass(kw_only=True)
+class ScheduledRefresh:
+    name: str
+    refresh: Callable[[], Awaitable]
+    # When the source's cached data expires (naive local system time), or None if nothing is cached
+    expires_at: Callable[[], Optional[datetime]]
+    cadence: timedelta
+    offset: timedelta
+    window: Optional[RefreshWindow]
+    next_run_at: Optional[datetime] = None
+    last_started_at: Optional[datetime] = None
+    last_outcome: Optional[str] = None
+    last_duration_s: Optional[float] = None
+    last_error: Optional[str] = None
+
+    def in_window(self, dt: datetime) -> bool:
+        """Return whether the source may be refreshed at a (local) time."""
+        return self.window is None or self.window.contains(dt)
+
+    def next_slot(self, after: datetime) -> datetime:
+        """Return the first slot after a time that falls within the window."""
+        week_start = (after - timedelta(days=after.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        # aware datetimes sharing a tzinfo are subtracted in wall-clock time, so slots stay on the hour across DST
+        slot = week_start + self.offset + ((after - week_start - self.offset) // self.cadence + 1) * self.cadence
+        for _ in range(WEEK // self.cadence):
+            if self.in_window(slot):
+                break
+            slot += self.cadence
+        return slot
+
+
+class RefreshScheduler:
+    def __init__(self, status_path: Path, timezone: ZoneInfo, max_sleep_s: float):
+        self.status_path = status_path
+        self.timezone = timezone
+        self.max_sleep_s = max_sleep_s
+        self.refreshes: List[ScheduledRefresh] = []
+        self.started_at = self.now()
+
+    def now(self) -> datetime:
+        """Return the current local time."""
+        return datetime.now(self.timezone)
+
+    def register(
+        self,
+        name: str,
+        refresh: Callable[[], Awaitable],
+        expires_at: Callable[[], Optional[datetime]],
+        slots: RefreshSlots,
+    ) -> None:
+        """Refresh a source in the given slots, or sooner if its cache would otherwise expire.
+
+        Sources due at the same time are refreshed in the order they were registered,
+        so a source should be registered after any it depends on.
+        """
+        cadence = timedelta(seconds=slots.cadence_s)
+        assert timedelta(0) < cadence <= WEEK and WEEK % cadence == timedelta(0), 'cadence_s must divide a week'
+        self.refreshes.append(
+            ScheduledRefresh(
+                name=name,
+                refresh=refresh,
+                expires_at=expires_at,
+                cadence=cadence,
+                offset=timedelta(seconds=slots.offset_s + random.uniform(0, slots.jitter_s)),
+                window=slots.window,
+            )
+        )
+
+    def next_run_at(self, scheduled: ScheduledRefresh, now: datetime) -> datetime:
+        """Return when a source should next be refreshed: at its next slot, or sooner if its cache would expire."""
+        slot = scheduled.next_slot(scheduled.last_started_at or self.started_at)
+        expires_at = scheduled.expires_at()
+        if expires_at is not None:
+            expires_at = expires_at.astimezone(self.timezone)
+        if scheduled.last_started_at is not None and (expires_at is None or expires_at <= scheduled.last_started_at):
+            # the last refresh didn't renew the cache, so wait for the next slot rather than retrying straight away
+            return slot
+        due = now if expires_at is None else max(now, expires_at)
+        return due if due < slot and scheduled.in_window(due) else slot
+
+    async def run(self) -> None:
+        """Refresh each source whenever it is due, forever."""
+        log.debug('Refresh scheduler started')
+        while True:
+            now = self.now()
+            # recalculated every time, as caches may also be renewed when a user request finds them expired
+            for scheduled in self.refreshes:
+                scheduled.next_run_at = self.next_run_at(scheduled, now)
+            self.write_status()
+            scheduled = min(self.refreshes, key=lambda s: s.next_run_at)
+            delay_s = (scheduled.next_run_at - now).total_seconds()
+            if delay_s > 0:
+                await asyncio.sleep(min(delay_s, self.max_sleep_s))
+            else:
+                await self.run_refresh(scheduled, now)
+
+    async def run_refresh(self, scheduled: ScheduledRefresh, now: datetime) -> None:
+        """Refresh a source, alerting by email if it fails."""
+        log.info(f'Refreshing {scheduled.name}...')
+        scheduled.last_started_at = now
+        start = time.perf_counter()
+        previous_expiry = scheduled.expires_at()
+        try:
+            await scheduled.refresh()
+            # scrapers fall back to cached data rather than raising, which would leave the cache as it was
+            if scheduled.expires_at() == previous_expiry:
+                raise RuntimeError('the cached data was not renewed')
+            scheduled.last_outcome, scheduled.last_error = 'refreshed', None
+            log.info(f'Refreshed {scheduled.name}.')
+        except Exception as e:
+            scheduled.last_outcome, scheduled.last_error = 'failed', str(e)
+            log.error(f'Refreshing {scheduled.name} failed with error {e}')
+            ALERTS.alert(f'Refreshing {scheduled.name} failed with error {e}')
+        scheduled.last_duration_s = time.perf_counter() - start
+        AUTOREFRESHES.labels(scheduled.name, scheduled.last_outcome).inc()
+
+    def status(self) -> dict:
+        """Describe when each source is refreshed, when it will next be, and how its last refresh went."""
+
+        def isoformat(dt: Optional[datetime]) -> Optional[str]:
+            return None if dt is None else dt.isoformat()
+
+        sources = []
+        for scheduled in self.refreshes:
+            expires_at = scheduled.expires_at()
+            sources.append(
+                {
+                    'name': scheduled.name,
+                    'cadence_s': scheduled.cadence.total_seconds(),
+                    'offset_s': scheduled.offset.total_seconds(),
+                    'window': None if scheduled.window is None else asdict(scheduled.window),
+                    'expires_at': isoformat(None if expires_at is None else expires_at.astimezone(self.timezone)),
+                    'next_run_at': isoformat(scheduled.next_run_at),
+                    'last_started_at': isoformat(scheduled.last_started_at),
+                    'last_outcome': scheduled.last_outcome,
+                    'last_duration_s': scheduled.last_duration_s,
+                    'last_error': scheduled.last_error,
+                }
+            )
+        return {'timezone': str(self.timezone), 'updated_at': self.now().isoformat(), 'sources': sources}
+
+    def write_status(self) -> None:
+        """Write the status where every worker can read it, replacing it atomically."""
+        os.makedirs(self.status_path.parent, exist_ok=True)
+        tmp_path = self.status_path.with_name(f'{self.status_path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(self.status()), encoding='utf-8')
+        os.replace(tmp_path, self.status_path)
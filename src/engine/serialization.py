@@ -0,0 +1,50 @@
+"""Encoding cached data (and nowcasts) as bytes, in a choice of formats.
+
+Each format is identified by the suffix files written in it are given (e.g. 'json' or 'msgpack.zst'),
+so data written in any format can be read back however the cache writing it is now configured.
+JSON is encoded with orjson, which is several times faster than the json module and produces the same
+compact JSON, except that NaN and infinity become null. msgpack is a little smaller, and keeps bytes and
+keys that aren't strings as they are, but decodes no faster. Either can be compressed with zstd, which
+makes nowcasts about 4x smaller for a few times the encoding cost, for large data that is read rarely.
+See benchmarks/serialization.py.
+"""
+
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, Dict
+
+import msgpack
+import orjson
+import zstandard
+
+# zstd levels above about 10 take much longer to compress for little gain on this sort of data
+ZSTD_LEVEL = 6
+
+
+@dataclass(frozen=True)
+class Serializer:
+    suffix: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes], Any]
+
+
+def dumps_json(data: Any) -> bytes:
+    """Encode data as compact JSON, as json.dumps does (including numpy values, and keys that aren't strings)."""
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _zstd(serializer: Serializer) -> Serializer:
+    return Serializer(
+        f'{serializer.suffix}.zst',
+        lambda data: zstandard.compress(serializer.dumps(data), ZSTD_LEVEL),
+        lambda raw: serializer.loads(zstandard.decompress(raw)),
+    )
+
+
+JSON = Serializer('json', dumps_json, orjson.loads)
+# msgpack keeps keys that aren't strings as they are, unlike JSON
+MSGPACK = Serializer('msgpack', msgpack.packb, partial(msgpack.unpackb, strict_map_key=False))
+JSON_ZSTD = _zstd(JSON)
+MSGPACK_ZSTD = _zstd(MSGPACK)
+
+SERIALIZERS: Dict[str, Serializer] = {s.suffix: s for s in (JSON, MSGPACK, JSON_ZSTD, MSGPACK_ZSTD)}
@@ -1,63 +1,271 @@
-import json
 import logging
 import os
-from datetime import datetime
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
-from engine.config import CACHE_ROOT
+from engine.config import CACHE_ROOT, SIMPLE_CACHE_MEMORY_BYTES
+from engine.metrics import CACHE_READS
+from engine.serialization import JSON, SERIALIZERS, Serializer
 
 log = logging.getLogger(__name__)
 
+CacheKey = Tuple[Path, str]
+
+
+@dataclass(frozen=True, kw_only=True)
+class CacheEntry:
+    data: Union[dict, list]
+    written_at: datetime
+    is_stale: bool
+
+    def age_s(self, now: Optional[datetime] = None) -> float:
+        """Return how old the cached data is, in seconds."""
+        return ((now or datetime.now()) - self.written_at).total_seconds()
+
+
+@dataclass(frozen=True)
+class MemoryEntry:
+    data: Union[dict, list]
+    written_at: datetime
+    size: int  # bytes serialized, as an estimate of memory use
+
+
+class MemoryTier:
+    """Data recently read from or written to any SimpleCache, kept in memory within a size limit.
+
+    The least recently used data is evicted first. Each cache has a generation, bumped whenever this
+    process writes or clears it, so that data read from disk isn't kept if the cache changed meanwhile.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[CacheKey, MemoryEntry] = OrderedDict()
+        self._generations: Dict[CacheKey, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: CacheKey) -> Optional[MemoryEntry]:
+        """Return a cache's data, if it is in memory."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def generation(self, key: CacheKey) -> int:
+        """Return the current generation of a cache."""
+        return self._generations.get(key, 0)
+
+    def put(self, key: CacheKey, entry: MemoryEntry, generation: Optional[int] = None) -> None:
+        """Keep a cache's data in memory, unless it has been written or cleared since the given generation."""
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key, 0):
+                return
+            self._discard(key)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def invalidate(self, key: CacheKey) -> None:
+        """Forget a cache's data, as it has been written or cleared."""
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._discard(key)
+
+    def _discard(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+
+MEMORY_TIER = MemoryTier(SIMPLE_CACHE_MEMORY_BYTES)
+
 
 class SimpleCache:
     """A very simple file-based cache with a timeout.
 
     Being file-based means it persists between restarts.
     It also awkwardly means it counts as a global, but don't tell the linter that...
+
+    Entries have a soft timeout (max_age_s), after which they are stale, and a hard timeout
+    (hard_max_age_s), after which they are deleted. Stale entries are only returned by read_entry(),
+    so that callers can choose to serve them while a refresh happens elsewhere.
+    By default the two timeouts are the same, so nothing is ever stale.
+
+    Data is also kept in memory (see MemoryTier), so reading current data doesn't touch the disk.
+    Once that data is stale, the file is checked again in case another process has written newer data.
+    Data returned is shared with the memory tier, so must not be modified.
+
+    Data is written using the given serializer, with its suffix as the file extension, so files written
+    with any serializer (e.g. before the cache was switched to another) can still be read.
     """
 
-    def __init__(self, name: str, max_age_s: float, cache_root: str = CACHE_ROOT):
+    def __init__(
+        self,
+        name: str,
+        max_age_s: float,
+        cache_root: str = CACHE_ROOT,
+        hard_max_age_s: Optional[float] = None,
+        serializer: Serializer = JSON,
+    ):
         self.name = name
+        self.serializer = serializer
         self.file_prefix = f'{name}_'
         self.max_age_s = max_age_s
+        self.hard_max_age_s = max_age_s if hard_max_age_s is None else hard_max_age_s
         self.cache_root = Path(cache_root)
+        self.key = (self.cache_root, name)
         os.makedirs(self.cache_root, exist_ok=True)
 
         assert self.max_age_s >= 0
+        assert self.hard_max_age_s >= self.max_age_s
 
     def read(self) -> Optional[Union[dict, list]]:
         """Read the cache.
 
         If a sufficiently new cache file is available, load and return it.
-        Otherwise, delete any old cache files and return None.
+        Otherwise, delete any expired cache files and return None.
+        """
+        entry = self.read_entry()
+        if entry is None or entry.is_stale:
+            return None
+        return entry.data
+
+    def _files(self) -> List[Tuple[datetime, Path]]:
+        """Return each cache file with when it was written, newest first.
+
+        Only names holding a timestamp and a known suffix match, so other files sharing the prefix
+        (e.g. leftovers from older versions) and files still being written are ignored.
+        """
+        files = []
+        for path in self.cache_root.glob(f'{self.file_prefix}[0-9]*'):
+            timestamp, suffix = self._split_name(path)
+            if suffix in SERIALIZERS:
+                files.append((self.from_os_safe_iso_timestamp(timestamp), path))
+        return sorted(files, reverse=True)
+
+    def _split_name(self, path: Path) -> Tuple[str, str]:
+        # timestamps hold no '.', but suffixes may (e.g. msgpack.zst)
+        timestamp, _, suffix = path.name.removeprefix(self.file_prefix).partition('.')
+        return timestamp, suffix
+
+    def read_entry(self) -> Optional[CacheEntry]:
+        """Read the cache, including stale data.
+
+        Returns the cached data along with when it was written and whether it is stale,
+        or None if there is no cache file younger than the hard timeout (in which case any are deleted).
         """
         current_dt = datetime.now()
-        for path in self.cache_root.glob(f'{self.file_prefix}*.json'):
+        cached = MEMORY_TIER.get(self.key)
+        if cached is not None and (current_dt - cached.written_at).total_seconds() <= self.max_age_s:
+            CACHE_READS.labels(self.name, 'hit', 'memory').inc()
+            return CacheEntry(data=cached.data, written_at=cached.written_at, is_stale=False)
+
+        generation = MEMORY_TIER.generation(self.key)
+        files, expired = self._files(), []
+        while files:
+            cached_dt, path = files.pop(0)
             log.debug(f'found {path}')
-            cached_nowcast_dt = self.from_os_safe_iso_timestamp(path.stem.replace(self.file_prefix, ''))
-            if (current_dt - cached_nowcast_dt).total_seconds() <= self.max_age_s:
+            age_s = (current_dt - cached_dt).total_seconds()
+            if age_s > self.hard_max_age_s:
+                expired.append(path)
+                continue
+            if cached is not None and cached.written_at == cached_dt:
+                # nobody has written the cache since we last read it
+                data, raw = cached.data, None
+            else:
+                try:
+                    raw = path.read_bytes()
+                except FileNotFoundError:
+                    # superseded since we looked (or cleared), so look again for whatever superseded it
+                    files, expired = self._files(), []
+                    continue
+                data = SERIALIZERS[self._split_name(path)[1]].loads(raw)
+            is_stale = age_s > self.max_age_s
+            CACHE_READS.labels(self.name, 'stale' if is_stale else 'hit', 'file').inc()
+            if is_stale:
+                log.info(f'{path} is stale ({age_s:.0f}s old), but can still be served while refreshing.')
+            else:
                 log.info(f'{path} is still current, returning it instead of generating.')
-                with path.open('r', encoding='utf-8') as f:
-                    return json.load(f)
+            if raw is not None:
+                MEMORY_TIER.put(self.key, MemoryEntry(data, cached_dt, len(raw)), generation)
+            return CacheEntry(data=data, written_at=cached_dt, is_stale=is_stale)
 
+        CACHE_READS.labels(self.name, 'miss', 'file').inc()
         log.info(f'{self.name} cache is empty or out of date.')
-        self.clear()
+        if cached is not None:
+            MEMORY_TIER.invalidate(self.key)
+        # only those found expired, as another process may have written a new file since
+        for path in expired:
+            path.unlink(missing_ok=True)
         return None
 
+    def expires_at(self) -> Optional[datetime]:
+        """Return when the cached data will become stale, or None if there is none, without reading it."""
+        cached = MEMORY_TIER.get(self.key)
+        if cached is not None and cached.written_at + timedelta(seconds=self.max_age_s) > datetime.now():
+            return cached.written_at + timedelta(seconds=self.max_age_s)
+        files = self._files()
+        if not files:
+            return None
+        return files[0][0] + timedelta(seconds=self.max_age_s)
+
     def write(self, data: Union[dict, list]) -> None:
-        """Write new data to the cache."""
-        self.clear()
-        with open(
-            self.cache_root / f'{self.file_prefix}{self.to_os_safe_iso_timestamp(datetime.now())}.json', 'w'
-        ) as fh:
-            json.dump(data, fh)
-            log.debug(f'New data added to {self.name} cache.')
+        """Write new data to the cache.
+
+        The data is written to a temporary file, flushed to disk and then renamed into place, so readers
+        (in any process) always find either the previous data or the new data, complete, even if this
+        process crashes part way. Older files are only removed once the new one is in place.
+        """
+        # so that a read already under way in this process doesn't keep older data in memory
+        MEMORY_TIER.invalidate(self.key)
+        # the file name only holds whole seconds, so neither does the data kept in memory
+        written_at = datetime.now().replace(microsecond=0)
+        raw = self.serializer.dumps(data)
+        path = (
+            self.cache_root / f'{self.file_prefix}{self.to_os_safe_iso_timestamp(written_at)}.{self.serializer.suffix}'
+        )
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_root, prefix=f'.{self.file_prefix}', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(raw)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self._fsync_cache_root()
+        MEMORY_TIER.put(self.key, MemoryEntry(data, written_at, len(raw)))
+        log.debug(f'New data added to {self.name} cache.')
+
+        for file_written_at, old_path in self._files():
+            if file_written_at <= written_at and old_path != path:
+                old_path.unlink(missing_ok=True)
+
+    def _fsync_cache_root(self) -> None:
+        # makes the rename itself durable; directories can't be opened like this on Windows
+        if os.name != 'nt':
+            fd = os.open(self.cache_root, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
 
     def clear(self) -> None:
         """Clear the cache."""
-        for path in self.cache_root.glob(f'{self.file_prefix}*.json'):
-            os.remove(path)
+        MEMORY_TIER.invalidate(self.key)
+        for _, path in self._files():
+            path.unlink(missing_ok=True)
         log.debug(f'{self.name} cache cleared.')
 
     @staticmethod
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+log = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one in-flight task.
+
+    The first caller for a key starts the work; anyone else asking for that key
+    while it is still running awaits the same task and receives the same result
+    (or exception). Once the task finishes, the next call starts afresh.
+
+    The shared task is shielded, so a caller being cancelled (e.g. a client
+    disconnecting mid-request) doesn't cancel the work for everyone else.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    def in_flight(self, key: str) -> bool:
+        """Return whether work for this key is currently running."""
+        return key in self._in_flight
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await fn(), or the already-running call for this key if there is one."""
+        return await asyncio.shield(self._get_or_start(key, fn))
+
+    def start(self, key: str, fn: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        """Start fn() in the background unless it is already running, without waiting for it.
+
+        Failures are logged, as there may be nobody awaiting the task to see them.
+        """
+        already_running = key in self._in_flight
+        task = self._get_or_start(key, fn)
+        if not already_running:
+            task.add_done_callback(lambda t: self._log_failure(key, t))
+        return task
+
+    def _get_or_start(self, key: str, fn: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._in_flight.get(key)
+        if task is None:
+            log.debug(f'Starting single-flight task for {key}')
+            task = asyncio.create_task(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            log.debug(f'Joining in-flight task for {key}')
+        return task
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    @staticmethod
+    def _log_failure(key: str, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f'Background task for {key} failed with error {task.exception()}')
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import json
+import math
+import sys
+from array import array
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+
+import brotli
+
+from engine.serialization import dumps_json
+
+# Content codings we can serve, in order of preference when the client accepts several equally.
+SUPPORTED_ENCODINGS = ('br', 'gzip')
+
+UINT16_MAX = 2**16 - 1
+# What a density with no value (NaN) is encoded as in uint16, so the largest density is encoded as one less.
+UINT16_MISSING = UINT16_MAX
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick the best content coding we support from an Accept-Encoding header.
+
+    Returns None if the client should be sent the uncompressed (identity) bytes.
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    wildcard_quality = qualities.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        quality = qualities.get(coding, wildcard_quality)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def oa_densities(nowcast: Mapping[str, Any]) -> Dict[str, float]:
+    """Return just the per-OA densities from a nowcast, dropping metadata such as its timestamp.
+
+    An OA with no density is NaN, as when generated, or None, as NaN is once the nowcast has been through JSON.
+    Either way it is returned as NaN, so the OAs are the same whether or not the nowcast was reloaded.
+    """
+    return {
+        k: math.nan if v is None else v
+        for k, v in nowcast.items()
+        if v is None or (isinstance(v, (int, float)) and not isinstance(v, bool))
+    }
+
+
+def _little_endian_bytes(values: array) -> bytes:
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+@dataclass(frozen=True, kw_only=True)
+class OAIndex:
+    """A fixed order of OAs, used to send the nowcast as a bare array of values.
+
+    OAs are identified by the nowcast keys, which are the code_uint ids Tegola uses as feature ids,
+    and are kept in ascending code_uint order. The id is a digest of the order, so clients can tell
+    whether an index they hold still matches a binary nowcast.
+    """
+
+    codes: Tuple[str, ...]
+    id: str
+    json: bytes
+
+    @classmethod
+    def from_codes(cls, codes: Iterable[str]) -> 'OAIndex':
+        """Build the index for a set of nowcast keys."""
+        # sorting by length first puts numeric strings in numeric order, without choking on anything else
+        ordered = tuple(sorted(codes, key=lambda code: (len(code), code)))
+        index_id = hashlib.sha256('\n'.join(ordered).encode('utf-8')).hexdigest()[:16]
+        index_json = json.dumps({'id': index_id, 'codes': ordered}, separators=(',', ':')).encode('utf-8')
+        return cls(codes=ordered, id=index_id, json=index_json)
+
+
+@dataclass(frozen=True, kw_only=True)
+class NowcastSnapshot:
+    """An immutable nowcast, serialized and compressed once when it is produced.
+
+    Serving a snapshot is then just a matter of handing back the bytes the client can accept.
+    The version is a digest of the serialized nowcast, so it is the same for the same nowcast
+    whichever process produced or reloaded it.
+    """
+
+    nowcast: Mapping[str, Any]
+    created_at: datetime
+    version: str
+    raw: bytes
+    gzip: bytes
+    brotli: bytes
+    index: OAIndex
+    # the nowcast as little-endian arrays in index order; uint16 values are multiplied by uint16_scale to decode,
+    # except that densities with no value, which are NaN in float32, are UINT16_MISSING
+    float32: bytes
+    uint16: bytes
+    uint16_scale: float
+
+    @classmethod
+    def from_nowcast(cls, nowcast: dict, created_at: datetime) -> 'NowcastSnapshot':
+        """Serialize and compress a nowcast into a new snapshot."""
+        raw = dumps_json(nowcast)
+        densities = oa_densities(nowcast)
+        index = OAIndex.from_codes(densities.keys())
+        values = [densities[code] for code in index.codes]
+        uint16_scale = (max((v for v in values if not math.isnan(v)), default=0.0) / (UINT16_MAX - 1)) or 1.0
+        return cls(
+            nowcast=MappingProxyType(dict(nowcast)),
+            created_at=created_at,
+            version=hashlib.sha256(raw).hexdigest()[:16],
+            raw=raw,
+            gzip=gzip.compress(raw, compresslevel=9),
+            brotli=brotli.compress(raw, quality=11),
+            index=index,
+            float32=_little_endian_bytes(array('f', values)),
+            uint16=_little_endian_bytes(
+                array('H', [UINT16_MISSING if math.isnan(v) else round(max(v, 0.0) / uint16_scale) for v in values])
+            ),
+            uint16_scale=uint16_scale,
+        )
+
+    def age_s(self, now: Optional[datetime] = None) -> float:
+        """Return how old the underlying nowcast is, in seconds."""
+        return ((now or datetime.now()) - self.created_at).total_seconds()
+
+    def encoded(self, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        """Return the body to send and its Content-Encoding (None for identity)."""
+        encoding = choose_encoding(accept_encoding)
+        if encoding == 'br':
+            return self.brotli, encoding
+        if encoding == 'gzip':
+            return self.gzip, encoding
+        return self.raw, None
@@ -0,0 +1,67 @@
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely import STRtree
+
+log = logging.getLogger(__name__)
+
+WGS84_EPSG = 4326
+
+# Matches the OAs that Tegola serves (see tegola_config.toml)
+OA_QUERY = 'SELECT code_uint, is_residential, wkb_geometry FROM public.edinburgh_oas WHERE is_residential = FALSE'
+
+
+class OASpatialIndex:
+    """OA geometries held in memory in an STRtree.
+
+    OAs are identified by their code_uint, as a string, so they can be looked up directly in a nowcast.
+    Lookups never touch the database, and take microseconds.
+    """
+
+    def __init__(self, codes: Sequence[str], geometries: Sequence[shapely.Geometry]):
+        assert len(codes) == len(geometries)
+        self.codes = np.asarray(codes, dtype=object)
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.centroids = shapely.centroid(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def from_geodataframe(cls, oas: gpd.GeoDataFrame) -> 'OASpatialIndex':
+        """Build the index from OAs with a code_uint column, dropping residential ones if they are marked."""
+        if 'is_residential' in oas.columns:
+            oas = oas[~oas['is_residential'].astype(bool)]
+        if oas.crs is not None and oas.crs.to_epsg() != WGS84_EPSG:
+            oas = oas.to_crs(epsg=WGS84_EPSG)
+        return cls(oas['code_uint'].astype('int64').astype(str).tolist(), oas.geometry.values)
+
+    @classmethod
+    def from_source(cls, source: str) -> 'OASpatialIndex':
+        """Load the OAs from PostGIS (given a postgresql:// URI) or from a GeoPackage stand-in (given a path).
+
+        A GeoPackage must contain an edinburgh_oas layer with the same columns as the PostGIS table.
+        """
+        if source.startswith('postgresql'):
+            oas = gpd.read_postgis(OA_QUERY, source, geom_col='wkb_geometry')
+        else:
+            oas = gpd.read_file(source, layer='edinburgh_oas')
+        log.info(f'Loaded {len(oas)} OA geometries from {source.split("@")[-1]}')
+        return cls.from_geodataframe(oas)
+
+    def codes_in_bbox(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> List[str]:
+        """Return the codes of the OAs intersecting a bounding box."""
+        hits = self.tree.query(shapely.box(min_lon, min_lat, max_lon, max_lat), predicate='intersects')
+        return self.codes[hits].tolist()
+
+    def oa_at(self, lat: float, lon: float) -> Optional[Tuple[str, Tuple[float, float]]]:
+        """Return the code and (lon, lat) centroid of the OA containing a point, if there is one."""
+        hits = self.tree.query(shapely.Point(lon, lat), predicate='intersects')
+        if len(hits) == 0:
+            return None
+        centroid = self.centroids[hits[0]]
+        return self.codes[hits[0]], (centroid.x, centroid.y)
@@ -0,0 +1,126 @@
+import logging
+import math
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+import shapely
+from shapely import STRtree
+
+from engine import mvt
+from engine.snapshot import NowcastSnapshot, oa_densities
+from engine.spatial import OASpatialIndex
+
+log = logging.getLogger(__name__)
+
+TileId = Tuple[int, int, int]
+
+LAYER_NAME = 'density'
+DENSITY_KEY = 'density'
+
+
+class DensityTiles:
+    """Vector tiles of the OAs, each OA carrying its current density as an attribute.
+
+    OAs are identified by their code_uint, as the feature id. Clipping and encoding geometry is the
+    expensive part, and it never changes, so each tile's encoded feature geometries are cached the first
+    time they are needed. A new nowcast then only needs the density attributes encoding alongside them.
+    render_all() does this for every tile, so that serving a tile is just a dictionary lookup.
+    """
+
+    def __init__(self, index: OASpatialIndex, min_zoom: int, max_zoom: int, extent: int = 4096, buffer: int = 64):
+        assert 0 <= min_zoom <= max_zoom
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.extent = extent
+        self.buffer = buffer
+        self.feature_ids = [int(code) for code in index.codes]
+        self.world_geometries = shapely.transform(index.geometries, mvt.lon_lat_to_world)
+        self.tree = STRtree(self.world_geometries)
+        self._geometry_cache: Dict[TileId, List[Tuple[str, bytes]]] = {}
+        # the version rendered and its tiles, swapped together so readers never see a mix of versions
+        self._rendered: Tuple[Optional[str], Dict[TileId, bytes]] = (None, {})
+
+    @property
+    def rendered_version(self) -> Optional[str]:
+        """The version of the nowcast that tiles were last pre-rendered for."""
+        return self._rendered[0]
+
+    def covers(self, z: int, x: int, y: int) -> bool:
+        """Return whether a tile id is valid and within the zoom range served."""
+        return self.min_zoom <= z <= self.max_zoom and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+    def tile_ids(self) -> Iterator[TileId]:
+        """Iterate over every tile (in the zoom range) that the OAs' bounding box touches."""
+        min_x, min_y, max_x, max_y = shapely.total_bounds(self.world_geometries)
+        for z in range(self.min_zoom, self.max_zoom + 1):
+            n = 1 << z
+            for x in range(int(min_x * n), min(int(max_x * n), n - 1) + 1):
+                for y in range(int(min_y * n), min(int(max_y * n), n - 1) + 1):
+                    yield z, x, y
+
+    def feature_geometries(self, z: int, x: int, y: int) -> List[Tuple[str, bytes]]:
+        """Return the code and encoded geometry fields of every OA in a tile, clipped to the tile (plus buffer)."""
+        tile_id = (z, x, y)
+        cached = self._geometry_cache.get(tile_id)
+        if cached is not None:
+            return cached
+
+        min_x, min_y, max_x, max_y = mvt.tile_bounds(z, x, y)
+        scale = self.extent / (max_x - min_x)
+        pad = self.buffer / scale
+        clip_box = (min_x - pad, min_y - pad, max_x + pad, max_y + pad)
+
+        features = []
+        for i in sorted(self.tree.query(shapely.box(*clip_box), predicate='intersects')):
+            clipped = shapely.clip_by_rect(self.world_geometries[i], *clip_box)
+            in_tile = shapely.transform(clipped, lambda coords, x0=min_x, y0=min_y: (coords - (x0, y0)) * scale)
+            geometry_fields = mvt.polygon_feature_geometry(self.feature_ids[i], in_tile)
+            if geometry_fields:
+                features.append((str(self.feature_ids[i]), geometry_fields))
+
+        self._geometry_cache[tile_id] = features
+        return features
+
+    def render(self, z: int, x: int, y: int, densities: Mapping[str, float]) -> bytes:
+        """Encode a tile with the given densities, or return b'' if there are no OAs in it."""
+        features = []
+        values = []
+        value_indices: Dict[float, int] = {}
+        for code, geometry_fields in self.feature_geometries(z, x, y):
+            density = densities.get(code)
+            tags = []
+            if density is not None and not math.isnan(density):
+                if density not in value_indices:
+                    value_indices[density] = len(values)
+                    values.append(mvt.float_value(density))
+                tags = [0, value_indices[density]]
+            features.append(mvt.feature(geometry_fields, tags))
+        if not features:
+            return b''
+        return mvt.layer(LAYER_NAME, features, [DENSITY_KEY], values, self.extent)
+
+    def render_all(self, snapshot: NowcastSnapshot) -> Dict[TileId, bytes]:
+        """Render every non-empty tile for a nowcast, replacing those rendered for the previous one, and return them."""
+        densities = oa_densities(snapshot.nowcast)
+        rendered = {}
+        for tile_id in self.tile_ids():
+            tile = self.render(*tile_id, densities)
+            if tile:
+                rendered[tile_id] = tile
+        self._rendered = (snapshot.version, rendered)
+        log.info(f'Rendered {len(rendered)} density tiles for nowcast version {snapshot.version}')
+        return rendered
+
+    def use_rendered(self, version: str, rendered: Dict[TileId, bytes]) -> None:
+        """Serve tiles rendered elsewhere (e.g. by another worker) for a nowcast, in place of those rendered here."""
+        self._rendered = (version, rendered)
+
+    def get(self, z: int, x: int, y: int, snapshot: NowcastSnapshot) -> bytes:
+        """Return a tile for a nowcast, or b'' if there are no OAs in it.
+
+        Tiles pre-rendered for this nowcast are returned as they are; otherwise (e.g. while a new
+        version is still being rendered) the tile is rendered on the spot.
+        """
+        rendered_version, rendered = self._rendered
+        if snapshot.version == rendered_version:
+            return rendered.get((z, x, y), b'')
+        return self.render(z, x, y, oa_densities(snapshot.nowcast))
@@ -0,0 +1,114 @@
+import json
+import logging
+import math
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Optional
+
+from engine.serialization import dumps_json
+from engine.snapshot import NowcastSnapshot
+
+log = logging.getLogger(__name__)
+
+
+def changed_entries(old: Mapping[str, Any], new: Mapping[str, Any], epsilon: float) -> Dict[str, Any]:
+    """Return the entries of new that are missing from old, or differ from it by more than epsilon.
+
+    An entry with no value (NaN, or None as NaN becomes in JSON) counts as changed if it gets one, or loses it.
+    Other non-numeric entries (e.g. the nowcast timestamp) count as changed whenever they are not equal.
+    """
+    changes = {}
+    for key, value in new.items():
+        if key not in old:
+            changes[key] = value
+            continue
+        old_value = old[key]
+        if _has_no_value(value) or _has_no_value(old_value):
+            if _has_no_value(value) != _has_no_value(old_value):
+                changes[key] = value
+        elif isinstance(value, (int, float)) and isinstance(old_value, (int, float)):
+            if abs(value - old_value) > epsilon:
+                changes[key] = value
+        elif value != old_value:
+            changes[key] = value
+    return changes
+
+
+def _has_no_value(value: Any) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def removed_entries(old: Mapping[str, Any], new: Mapping[str, Any]) -> List[str]:
+    return [key for key in old if key not in new]
+
+
+class NowcastVersions:
+    """A small ring of the most recent nowcast snapshots, newest last.
+
+    Keeping a few old versions lets clients that already hold one be sent only what has changed since.
+    Deltas are memoised until a new version arrives, as every client polling after a refresh asks for the same one.
+    """
+
+    def __init__(self, max_versions: int):
+        assert max_versions >= 1
+        self.max_versions = max_versions
+        self._snapshots: OrderedDict[str, NowcastSnapshot] = OrderedDict()
+        self._deltas: Dict[str, bytes] = {}
+
+    @property
+    def latest(self) -> Optional[NowcastSnapshot]:
+        """The current snapshot, if there is one."""
+        if not self._snapshots:
+            return None
+        return next(reversed(self._snapshots.values()))
+
+    def get(self, version: str) -> Optional[NowcastSnapshot]:
+        """Return the snapshot for a version, if it is still held."""
+        return self._snapshots.get(version)
+
+    def add(self, snapshot: NowcastSnapshot) -> None:
+        """Make a snapshot the latest version, forgetting the oldest if the ring is full.
+
+        Re-adding an unchanged nowcast just refreshes it, so it doesn't count as a new version.
+        """
+        latest = self.latest
+        if latest is None or latest.version != snapshot.version:
+            self._deltas.clear()
+        self._snapshots.pop(snapshot.version, None)
+        self._snapshots[snapshot.version] = snapshot
+        while len(self._snapshots) > self.max_versions:
+            forgotten, _ = self._snapshots.popitem(last=False)
+            log.debug(f'Forgot nowcast version {forgotten}')
+
+    def delta_since(self, version: str, epsilon: float) -> bytes:
+        """Return a JSON delta from a previous version to the latest one.
+
+        If that version is no longer (or was never) held, the delta is the full latest nowcast
+        and is flagged as such.
+        """
+        latest = self.latest
+        assert latest is not None, 'No nowcast has been published yet'
+
+        if version in self._deltas:
+            return self._deltas[version]
+
+        base = self._snapshots.get(version)
+        header = json.dumps({'version': latest.version, 'since': version, 'full': base is None})[:-1]
+        if base is None:
+            # Not memoised, as the version comes from the client. Splicing the already-serialized
+            # nowcast in rather than encoding it again keeps this cheap anyway.
+            log.debug(f'Nowcast version {version} is unknown, sending full nowcast as delta')
+            return f'{header}, "removed": [], "changes": '.encode('utf-8') + latest.raw + b'}'
+
+        changes = changed_entries(base.nowcast, latest.nowcast, epsilon)
+        removed = removed_entries(base.nowcast, latest.nowcast)
+        log.debug(f'{len(changes)} entries changed and {len(removed)} removed since nowcast version {version}')
+        # encoded as the nowcast itself is, so that NaN becomes null rather than (invalid) bare NaN
+        delta = (
+            f'{header}, "removed": '.encode('utf-8')
+            + dumps_json(removed)
+            + b', "changes": '
+            + dumps_json(changes)
+            + b'}'
+        )
+        self._deltas[version] = delta
+        return delta
@@ -0,0 +1,303 @@
+"""Coordination between uvicorn worker processes sharing a CACHE_ROOT.
+
+One worker, whichever holds an exclusive lock on a file in CACHE_ROOT, is the refresher: it alone
+polls the sensors, and it shares each nowcast it generates through a snapshot file. The other workers
+(followers) watch that file and serve whatever it holds, asking the refresher for a new nowcast when
+they need one. If the refresher dies, the OS releases its lock and a follower takes over.
+
+The refresher also shares the density tiles it renders for each nowcast, so that followers don't render
+them too, and every worker shares its metrics, so that whichever worker answers /metrics can sum them all.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+from dataclasses import replace
+from datetime import datetime
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import orjson
+
+from engine.snapshot import NowcastSnapshot, OAIndex, oa_densities
+
+log = logging.getLogger(__name__)
+
+StatKey = Tuple[int, int, int]
+TileId = Tuple[int, int, int]  # as in engine.tiles, which is too heavy to import here
+
+
+def _stat_key(path: Path) -> Optional[StatKey]:
+    """Identify a version of a file without reading it (a replaced file has a new inode)."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _if_created_later(known: NowcastSnapshot, created_at: float) -> Optional[NowcastSnapshot]:
+    """Return the known snapshot as created at created_at (in epoch seconds), if that is later than it was."""
+    if created_at <= known.created_at.timestamp():
+        return None
+    return replace(known, created_at=datetime.fromtimestamp(created_at))
+
+
+class LeaderLock:
+    """A non-blocking, exclusive lock on a file, held until released or the process exits."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        """Whether this process holds the lock."""
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        """Take the lock if nobody else holds it, returning whether this process now holds it."""
+        if self._fd is None:
+            os.makedirs(self.path.parent, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode('ascii'))
+            self._fd = fd
+            log.info(f'Process {os.getpid()} now holds {self.path}')
+        return True
+
+    def release(self) -> None:
+        """Release the lock, if held."""
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class SharedSnapshotFile:
+    """A nowcast snapshot shared between processes, as a file replaced atomically on each write.
+
+    The file holds a fixed-size header followed by every pre-encoded body of the snapshot, so readers
+    neither recompress it nor reserialize it. Readers notice a new file by stat()ing it, then memory-map it
+    and read the header to see whether it holds a version they don't have before copying anything out.
+
+    A second, empty file is touched to ask the refresher for a new nowcast.
+    """
+
+    MAGIC = b'EDNCSNP1'
+    # magic, version, created_at (epoch seconds), uint16 scale, then the lengths of the five bodies
+    HEADER = struct.Struct('<8s16sdd5Q')
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.refresh_request_path = path.with_name(f'{path.name}.refresh')
+        self._seen: Optional[StatKey] = None
+        self._seen_refresh_request: Optional[StatKey] = None
+        self._listening_for_refresh_requests = False
+
+    def write(self, snapshot: NowcastSnapshot) -> None:
+        """Share a snapshot, replacing whatever was shared before."""
+        bodies = (snapshot.raw, snapshot.gzip, snapshot.brotli, snapshot.float32, snapshot.uint16)
+        header = self.HEADER.pack(
+            self.MAGIC,
+            snapshot.version.encode('ascii'),
+            snapshot.created_at.timestamp(),
+            snapshot.uint16_scale,
+            *(len(body) for body in bodies),
+        )
+        os.makedirs(self.path.parent, exist_ok=True)
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            for body in bodies:
+                f.write(body)
+        os.replace(tmp_path, self.path)
+        # no need for this process to read back what it wrote
+        self._seen = _stat_key(self.path)
+        log.debug(f'Shared nowcast version {snapshot.version}')
+
+    def read_if_changed(self, known: Optional[NowcastSnapshot]) -> Optional[NowcastSnapshot]:
+        """Return the shared snapshot, if the file has changed since last checked and holds a newer one than known.
+
+        A snapshot of the known version that was created later (as when an unchanged nowcast is regenerated)
+        is returned as the known one with the later creation time, without copying its bodies out.
+        """
+        key = _stat_key(self.path)
+        if key is None or key == self._seen:
+            return None
+        self._seen = key
+        try:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                magic, version, created_at, uint16_scale, *lengths = self.HEADER.unpack_from(mapped)
+                if magic != self.MAGIC:
+                    log.warning(f'{self.path} is not a shared snapshot, ignoring it')
+                    return None
+                version = version.decode('ascii')
+                if known is not None and version == known.version:
+                    bodies = None
+                else:
+                    offset = self.HEADER.size
+                    bodies = []
+                    for length in lengths:
+                        bodies.append(mapped[offset : offset + length])
+                        offset += length
+        except FileNotFoundError:
+            return None
+        except (ValueError, struct.error) as e:
+            log.warning(f'Could not read shared snapshot {self.path}: {e}')
+            return None
+
+        if bodies is None:
+            return _if_created_later(known, created_at)
+
+        raw, gzip, brotli, float32, uint16 = bodies
+        nowcast = orjson.loads(raw)
+        return NowcastSnapshot(
+            nowcast=MappingProxyType(nowcast),
+            created_at=datetime.fromtimestamp(created_at),
+            version=version,
+            raw=raw,
+            gzip=gzip,
+            brotli=brotli,
+            index=OAIndex.from_codes(oa_densities(nowcast).keys()),
+            float32=float32,
+            uint16=uint16,
+            uint16_scale=uint16_scale,
+        )
+
+    def request_refresh(self) -> None:
+        """Ask the refresher for a new nowcast."""
+        self.refresh_request_path.touch()
+
+    def refresh_requested(self) -> bool:
+        """Return whether a refresh has been asked for since this was last called.
+
+        The first call only notes any existing request, as it was made before this process was listening.
+        """
+        key = _stat_key(self.refresh_request_path)
+        if not self._listening_for_refresh_requests:
+            self._listening_for_refresh_requests = True
+            self._seen_refresh_request = key
+            return False
+        if key is None or key == self._seen_refresh_request:
+            return False
+        self._seen_refresh_request = key
+        return True
+
+
+class SharedTilesFile:
+    """Density tiles rendered by the refresher, shared with the other workers so that they needn't render them.
+
+    Like SharedSnapshotFile, this is one file replaced atomically on each write: a header holding the version
+    of the nowcast the tiles were rendered for and the number of tiles, an index giving each tile's id and
+    length, then the tiles themselves.
+    """
+
+    MAGIC = b'EDTILES1'
+    # magic, version, number of tiles
+    HEADER = struct.Struct('<8s16sQ')
+    # z, x, y, length
+    ENTRY = struct.Struct('<BIIQ')
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._seen: Optional[StatKey] = None
+
+    def write(self, version: str, tiles: Mapping[TileId, bytes]) -> None:
+        """Share the tiles rendered for a version, replacing whatever was shared before."""
+        os.makedirs(self.path.parent, exist_ok=True)
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, version.encode('ascii'), len(tiles)))
+            for (z, x, y), tile in tiles.items():
+                f.write(self.ENTRY.pack(z, x, y, len(tile)))
+            for tile in tiles.values():
+                f.write(tile)
+        os.replace(tmp_path, self.path)
+        self._seen = _stat_key(self.path)
+        log.debug(f'Shared {len(tiles)} density tiles for nowcast version {version}')
+
+    def read_if_changed(self, known_version: Optional[str]) -> Optional[Tuple[str, Dict[TileId, bytes]]]:
+        """Return the version and tiles shared, if the file has changed since last checked and is for a new version."""
+        key = _stat_key(self.path)
+        if key is None or key == self._seen:
+            return None
+        self._seen = key
+        try:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                magic, version, n_tiles = self.HEADER.unpack_from(mapped)
+                version = version.decode('ascii')
+                if magic != self.MAGIC or version == known_version:
+                    return None
+                entries = [
+                    self.ENTRY.unpack_from(mapped, self.HEADER.size + i * self.ENTRY.size) for i in range(n_tiles)
+                ]
+                offset = self.HEADER.size + n_tiles * self.ENTRY.size
+                tiles = {}
+                for z, x, y, length in entries:
+                    tiles[(z, x, y)] = mapped[offset : offset + length]
+                    offset += length
+        except FileNotFoundError:
+            return None
+        except (ValueError, struct.error) as e:
+            log.warning(f'Could not read shared tiles {self.path}: {e}')
+            return None
+        return version, tiles
+
+
+class SharedMetrics:
+    """Each worker's metrics, dumped to a file of their own in a directory, so that any worker can serve them all.
+
+    Files left by workers that have since exited are removed, so their counts drop out of the totals,
+    which Prometheus treats as a counter reset. As the directory may outlive the processes (e.g. in a volume
+    kept across container restarts, where PIDs are soon reused), a file not rewritten within max_age_s is
+    taken to have been left by an exited worker too, whatever process now has its PID.
+    """
+
+    def __init__(self, directory: Path, max_age_s: float):
+        self.directory = directory
+        self.max_age_s = max_age_s
+
+    def write(self, dump: bytes) -> None:
+        """Replace this worker's dumped metrics."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.directory / f'{os.getpid()}.json'
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        tmp_path.write_bytes(dump)
+        os.replace(tmp_path, path)
+
+    def read_others(self) -> List[bytes]:
+        """Return the dumped metrics of every other live worker."""
+        dumps = []
+        now = time.time()
+        for path in self.directory.glob('[0-9]*.json'):
+            pid = int(path.stem)
+            if pid == os.getpid():
+                continue
+            try:
+                if now - path.stat().st_mtime > self.max_age_s or not _is_alive(pid):
+                    path.unlink(missing_ok=True)
+                    continue
+                dumps.append(path.read_bytes())
+            except FileNotFoundError:
+                continue
+        return dumps
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # it exists, but belongs to someone else
+    return True
@@ -0,0 +1,172 @@
+"""A headless Chromium kept running between scrapes, rather than launched for each one.
+
+Playwright itself is only imported once a page is first wanted, so importing this is cheap.
+"""
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from random import choice
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional
+
+from engine import config
+from engine.metrics import BROWSER_LAUNCHES
+
+if TYPE_CHECKING:
+    from playwright.async_api import Browser, BrowserContext, Page, Playwright
+
+log = logging.getLogger(__name__)
+
+PROC_ROOT = Path('/proc')
+
+
+def process_tree_rss_bytes(root_pid: int, proc_root: Path = PROC_ROOT) -> int:
+    """Return the total resident memory of every descendant of a process (but not the process itself).
+
+    Read from /proc, so this is 0 where there isn't one.
+    """
+    parents: Dict[int, int] = {}
+    for stat_path in proc_root.glob('[0-9]*/stat'):
+        try:
+            # the command name, in brackets, may itself hold spaces and brackets
+            fields = stat_path.read_text().rpartition(')')[2].split()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        parents[int(stat_path.parent.name)] = int(fields[1])
+
+    descendants, to_visit = set(), [root_pid]
+    while to_visit:
+        pid = to_visit.pop()
+        children = [child for child, parent in parents.items() if parent == pid and child not in descendants]
+        descendants.update(children)
+        to_visit.extend(children)
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    rss_bytes = 0
+    for pid in descendants:
+        try:
+            rss_bytes += int((proc_root / str(pid) / 'statm').read_text().split()[1]) * page_size
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return rss_bytes
+
+
+class BrowserPool:
+    """One headless Chromium, launched when a page is first wanted and kept running until closed.
+
+    Pages are opened in browser contexts kept for reuse, each with an identity (user agent, viewport
+    and locale) picked at random when it was created, with at most max_pages pages open at once.
+    Once the browser has opened pages_per_browser pages, or it (with its helper processes) uses more
+    than max_rss_bytes, or it has crashed, it is relaunched before the next page is opened, as soon as
+    the pages open in it have been closed.
+    """
+
+    def __init__(self, max_pages: int, pages_per_browser: int, max_rss_bytes: int):
+        self.max_pages = max_pages
+        self.pages_per_browser = pages_per_browser
+        self.max_rss_bytes = max_rss_bytes
+        self._slots = asyncio.Semaphore(max_pages)
+        # held while choosing a context, so that nothing is opened while the browser is relaunched
+        self._lock = asyncio.Lock()
+        self._playwright: Optional['Playwright'] = None
+        self._browser: Optional['Browser'] = None
+        self._idle_contexts: List['BrowserContext'] = []
+        self._pages_opened = 0
+        self._open_pages = 0
+        self._no_open_pages = asyncio.Event()
+        self._no_open_pages.set()
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator['Page']:
+        """Open a page, waiting for one of max_pages to be free, and close it afterwards."""
+        async with self._slots:
+            context = await self._open_context()
+            try:
+                page = await context.new_page()
+                try:
+                    yield page
+                finally:
+                    try:
+                        await page.close()
+                    except Exception as e:
+                        # e.g. the browser crashed, in which case it is relaunched for the next page
+                        log.warning(f'Could not close page cleanly: {e}')
+            finally:
+                self._release_context(context)
+
+    def _relaunch_reason(self) -> Optional[str]:
+        if self._browser is None:
+            return 'first use'
+        if not self._browser.is_connected():
+            return 'disconnected'
+        if self._pages_opened >= self.pages_per_browser:
+            return 'pages'
+        if process_tree_rss_bytes(os.getpid()) > self.max_rss_bytes:
+            return 'memory'
+        return None
+
+    async def _open_context(self) -> 'BrowserContext':
+        async with self._lock:
+            reason = self._relaunch_reason()
+            if reason is not None:
+                await self._no_open_pages.wait()
+                await self._close_browser()
+                await self._launch(reason)
+            self._pages_opened += 1
+            self._open_pages += 1
+            self._no_open_pages.clear()
+            if self._idle_contexts:
+                return self._idle_contexts.pop()
+            try:
+                # randomise identity a bit
+                return await self._browser.new_context(
+                    user_agent=choice(config.PLAYWRIGHT_USER_AGENTS),
+                    viewport=choice(config.PLAYWRIGHT_VIEWPORTS),
+                    locale=choice(config.PLAYWRIGHT_LOCALES),
+                )
+            except BaseException:
+                self._release_context(None)
+                raise
+
+    def _release_context(self, context: Optional['BrowserContext']) -> None:
+        # contexts of a browser that has since been relaunched went with it
+        if context is not None and context.browser is self._browser:
+            self._idle_contexts.append(context)
+        self._open_pages -= 1
+        if self._open_pages == 0:
+            self._no_open_pages.set()
+
+    async def _launch(self, reason: str) -> None:
+        from playwright.async_api import async_playwright
+
+        log.info(f'Launching browser ({reason})...')
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(headless=True)
+        self._pages_opened = 0
+        BROWSER_LAUNCHES.labels(reason).inc()
+
+    async def _close_browser(self) -> None:
+        self._idle_contexts = []
+        if self._browser is not None:
+            browser, self._browser = self._browser, None
+            try:
+                await browser.close()
+            except Exception as e:
+                log.warning(f'Could not close browser cleanly: {e}')
+
+    async def close(self) -> None:
+        """Close the browser, if launched, once the pages open in it have been closed."""
+        async with self._lock:
+            await self._no_open_pages.wait()
+            await self._close_browser()
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
+
+
+BROWSER_POOL = BrowserPool(
+    config.PLAYWRIGHT_MAX_PAGES, config.PLAYWRIGHT_PAGES_PER_BROWSER, config.PLAYWRIGHT_MAX_BROWSER_RSS_BYTES
+)
@@ -1,72 +1,165 @@
 import logging
 from datetime import datetime, timedelta
 from io import StringIO
-from typing import Dict, List
+from typing import Any, Dict, List, Optional
 
 import pandas as pd
 from bs4 import BeautifulSoup
 
 from engine.classes import PedFluxCounterMeasurement
-from engine.config import ETD_CACHE_TIMEOUT_S, ETD_MAX_PAX_PER_HOUR, ETD_PAGE_LOAD_INDICATOR_SELECTOR
+from engine.config import (
+    ETD_ALLOWED_RESOURCE_TYPES,
+    ETD_ALLOWED_URL_PATTERNS,
+    ETD_CACHE_HARD_TIMEOUT_S,
+    ETD_CACHE_TIMEOUT_S,
+    ETD_DAY_TABLE_CACHE_TIMEOUT_S,
+    ETD_FETCH_OVER_HTTP_FIRST,
+    ETD_MAX_PAX_PER_HOUR,
+    ETD_PAGE_LOAD_INDICATOR_SELECTOR,
+)
+from engine.keyed_cache import SQLITE_BACKEND, KeyedCache
 from engine.simple_cache import SimpleCache
-from scrapers.utils import scrape_urls
+from engine.single_flight import SingleFlight
+from scrapers.utils import FetchStrategy, ResourcePolicy, stream_urls
 
 log = logging.getLogger(__name__)
 
+ETD_CACHE = SimpleCache('edintraveldata', ETD_CACHE_TIMEOUT_S, hard_max_age_s=ETD_CACHE_HARD_TIMEOUT_S)
+# Each sensor's hourly measurements for a day (keyed by sensor and date), as {'HH:00': pax per hour or None}
+ETD_DAY_TABLES = KeyedCache('edintraveldata_days', ETD_DAY_TABLE_CACHE_TIMEOUT_S, backend=SQLITE_BACKEND)
+# Concurrent cache misses share one scrape rather than each launching a browser
+ETD_SCRAPES = SingleFlight()
+ETD_FETCH_STRATEGY = FetchStrategy(
+    ETD_PAGE_LOAD_INDICATOR_SELECTOR,
+    ResourcePolicy('edintraveldata', ETD_ALLOWED_RESOURCE_TYPES, ETD_ALLOWED_URL_PATTERNS),
+    over_http_first=ETD_FETCH_OVER_HTTP_FIRST,
+)
 
-async def poll_edintraveldata(sensor_descriptions: List[Dict]) -> List[PedFluxCounterMeasurement]:
+
+async def poll_edintraveldata(
+    sensor_descriptions: List[Dict], force_refresh: bool = False
+) -> List[PedFluxCounterMeasurement]:
     """Extract measurements from Edintraveldata.
 
     Wrapper function including caching for extracting measurements from Edintraveldata.
+    If a scrape finds no measurements, stale cached ones are used instead (up to the hard timeout).
+    With force_refresh, the site is scraped even if the cached measurements are still current.
     """
-    cache = SimpleCache('edintraveldata', ETD_CACHE_TIMEOUT_S)
-
-    measurements = cache.read()
+    entry = ETD_CACHE.read_entry()
     current_dt = datetime.now()
 
-    if measurements is None:
-        measurements = {}
-        hour_str = f'{current_dt.hour:02d}:00'
+    if entry is not None and not entry.is_stale and not force_refresh:
+        measurements = entry.data
+    else:
+        measurements = await ETD_SCRAPES.do(
+            'edintraveldata', lambda: scrape_measurements(sensor_descriptions, current_dt, ETD_CACHE)
+        )
+        if len(measurements) == 0 and entry is not None:
+            log.warning(f'Edintraveldata scrape found no measurements, using cached ones from {entry.written_at}.')
+            measurements = entry.data
+
+    return [
+        PedFluxCounterMeasurement(sensor_name=k, datetime=current_dt, flow_pax_per_hour=v)
+        for k, v in measurements.items()
+    ]
+
+
+def day_table_key(sensor_name: str, date_str: str) -> str:
+    """Return the key a sensor's hourly measurements for a date are cached under."""
+    return f'{sensor_name}/{date_str}'
+
+
+def parse_day_table(html: str) -> Optional[Dict[str, Optional[int]]]:
+    """Return the hourly measurements in a report page, with None for hours not (yet) reported.
+
+    Each row is parsed on its own, so a cell that isn't a whole number (e.g. one left empty) only loses
+    the measurement for that hour. Returns None if the page holds no report table.
+    """
+    table = BeautifulSoup(html, 'html.parser').find('table', {'class': 'grid', 'id': 'gridTable'})
+    if table is None:
+        return None
+    df = pd.read_html(StringIO(str(table)))[0]
+    return {time: _parse_ped(time, ped) for time, ped in zip(df['Time'], df['Ped'])}
 
-        # we extract the measurement from the previous day to mitigate the fact that some sensors
-        # delay their reporting by some hours
-        yesterday_date_str = (current_dt - timedelta(days=1)).strftime('%Y-%m-%d')
 
-        urls = [
-            s['source']
-            + f'tfreport.asp?node=EDINBURGH_CYCLE&cosit={int(s["name"][3:]):012d}'
-            + f'&reportdate={yesterday_date_str}&enddate={yesterday_date_str}&dimtype=2'
-            for s in sensor_descriptions
-        ]
+def _parse_ped(time: str, ped: Any) -> Optional[int]:
+    if ped == '-':
+        return None
+    try:
+        count = float(ped)
+    except (TypeError, ValueError):
+        count = float('nan')
+    if not count.is_integer():  # including NaN, as read from an empty cell
+        log.warning(f'Could not read the measurement {ped!r} reported for {time}, treating it as not reported.')
+        return None
+    return int(count)
 
-        log.debug(f'going to check the following Edintraveldata URLs: \n{"\n".join(urls)}')
-        htmls = await scrape_urls(urls, ETD_PAGE_LOAD_INDICATOR_SELECTOR)
 
-        for sd, html in zip(sensor_descriptions, htmls):
-            soup = BeautifulSoup(html, 'html.parser')
-            table = soup.find('table', {'class': 'grid', 'id': 'gridTable'})
-            if table is None:
+async def scrape_measurements(
+    sensor_descriptions: List[Dict], current_dt: datetime, cache: SimpleCache
+) -> Dict[str, int]:
+    """Find the current hour's measurements for each sensor, caching them if any were found.
+
+    Sensors whose measurements for the day are cached and include this hour aren't scraped again,
+    so most hours no pages are loaded at all.
+    """
+    measurements = {}
+    hour_str = f'{current_dt.hour:02d}:00'
+
+    # we extract the measurement from the previous day to mitigate the fact that some sensors
+    # delay their reporting by some hours
+    yesterday_date_str = (current_dt - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    day_tables = ETD_DAY_TABLES.get_many(day_table_key(s['name'], yesterday_date_str) for s in sensor_descriptions)
+    # including those whose table had this hour missing when it was scraped, as it may have been reported since
+    to_scrape = [
+        s
+        for s in sensor_descriptions
+        if day_tables.get(day_table_key(s['name'], yesterday_date_str), {}).get(hour_str) is None
+    ]
+    sensors_by_url = {
+        s['source']
+        + f'tfreport.asp?node=EDINBURGH_CYCLE&cosit={int(s["name"][3:]):012d}'
+        + f'&reportdate={yesterday_date_str}&enddate={yesterday_date_str}&dimtype=2': s
+        for s in to_scrape
+    }
+
+    scraped_tables = {}
+    if sensors_by_url:
+        log.debug(f'going to check the following Edintraveldata URLs: \n{"\n".join(sensors_by_url)}')
+        # each page is parsed as soon as it has been fetched, while the rest are still being fetched
+        async for url, html in stream_urls(list(sensors_by_url), ETD_FETCH_STRATEGY):
+            sd = sensors_by_url[url]
+            day_table = parse_day_table(html)
+            if day_table is None:
                 log.warning(
                     f'Could not find table in html returned for sensor {sd["name"]}'
                     f' for date {yesterday_date_str}, ignoring.'
                 )
             else:
-                df = pd.read_html(StringIO(str(table)))[0]
-                measurement = df.loc[df['Time'] == hour_str, 'Ped'].iloc[0]
-                if measurement == '-':
-                    log.warning(f"Measurement for sensor {sd['name']} for time {hour_str} was '-'; ignoring.")
-                else:
-                    log.debug(f'Found measurement {measurement} pax per hour for {sd["name"]} for time {hour_str}')
-                    measurements[sd['name']] = int(measurement)
-        if len(measurements) > 0:
-            # sanity check
-            assert all([v >= 0 and v <= ETD_MAX_PAX_PER_HOUR for v in measurements.values()]), (
-                f'ETD scraper produced nonsense values! {measurements}'
-            )
-
-            cache.write(measurements)
+                scraped_tables[day_table_key(sd['name'], yesterday_date_str)] = day_table
+    else:
+        log.debug(f'all Edintraveldata measurements for {hour_str} on {yesterday_date_str} were already cached')
+    if scraped_tables:
+        ETD_DAY_TABLES.put_many(scraped_tables)
+    day_tables.update(scraped_tables)
 
-    return [
-        PedFluxCounterMeasurement(sensor_name=k, datetime=current_dt, flow_pax_per_hour=v)
-        for k, v in measurements.items()
-    ]
+    for sd in sensor_descriptions:
+        day_table = day_tables.get(day_table_key(sd['name'], yesterday_date_str))
+        if day_table is None:
+            continue
+        measurement = day_table.get(hour_str)
+        if measurement is None:
+            log.warning(f"Measurement for sensor {sd['name']} for time {hour_str} was missing or '-'; ignoring.")
+        else:
+            log.debug(f'Found measurement {measurement} pax per hour for {sd["name"]} for time {hour_str}')
+            measurements[sd['name']] = measurement
+    if len(measurements) > 0:
+        # sanity check
+        assert all([v >= 0 and v <= ETD_MAX_PAX_PER_HOUR for v in measurements.values()]), (
+            f'ETD scraper produced nonsense values! {measurements}'
+        )
+
+        cache.write(measurements)
+
+    return measurements
@@ -1,4 +1,6 @@
 import logging
+import re
+import time
 from datetime import date, datetime, timedelta
 from typing import Callable, Dict, List, Tuple
 
@@ -9,11 +11,29 @@ from bs4 import BeautifulSoup
 
 from engine import config
 from engine.classes import PedFluxCounterMeasurement
+from engine.metrics import EXTRACT_LINES_CPU
 from engine.simple_cache import SimpleCache
-from scrapers.utils import scrape_urls
+from engine.single_flight import SingleFlight
+from scrapers.utils import FetchStrategy, ResourcePolicy, fetch_urls
 
 log = logging.getLogger(__name__)
 
+EE_CACHE = SimpleCache('essential_edinburgh', config.EE_CACHE_TIMEOUT_S, hard_max_age_s=config.EE_CACHE_HARD_TIMEOUT_S)
+# Concurrent cache misses share one scrape rather than each launching a browser
+EE_SCRAPES = SingleFlight()
+# found in the src of the images of each chart we extract measurements from
+CHART_SRC_PATTERNS = {'EE001': 'PS-52-Week_Update', 'EE002': 'RoseSt-52-Week_Update'}
+EE_FETCH_STRATEGY = FetchStrategy(
+    config.EE_PAGE_LOAD_INDICATOR_SELECTOR,
+    ResourcePolicy(
+        'essential_edinburgh',
+        config.EE_ALLOWED_RESOURCE_TYPES,
+        config.EE_ALLOWED_URL_PATTERNS,
+        always_allowed_url_patterns=tuple(re.escape(pattern) for pattern in CHART_SRC_PATTERNS.values()),
+    ),
+    over_http_first=config.EE_FETCH_OVER_HTTP_FIRST,
+)
+
 WORKDAYS_PER_WEEK = 5
 HOURS_PER_DAY = 24
 WEEKS_PER_YEAR = 52
@@ -42,6 +62,7 @@ def get_pixel_to_data_transform(
     return transform
 
 
+@EXTRACT_LINES_CPU.time(time.thread_time)
 def extract_lines_from_graph(image_bytes: bytes) -> List[Tuple]:
     """Extract the lines from Essential Edinburgh's graphs.
 
@@ -127,11 +148,11 @@ async def scrape_dashboard() -> Dict[str, List[Tuple[int]]]:
     log.info('commencing scrape of Essential Edinburgh.')
 
     images_to_find = [
-        {'name': 'EE001', 'src_pattern': 'PS-52-Week_Update', 'image_bytes': None, 'df': None},
-        {'name': 'EE002', 'src_pattern': 'RoseSt-52-Week_Update', 'image_bytes': None, 'df': None},
+        {'name': name, 'src_pattern': src_pattern, 'image_bytes': None, 'df': None}
+        for name, src_pattern in CHART_SRC_PATTERNS.items()
     ]
 
-    html = await scrape_urls(['https://www.essentialedinburgh.co.uk/stats/'], config.EE_PAGE_LOAD_INDICATOR_SELECTOR)
+    html = await fetch_urls(['https://www.essentialedinburgh.co.uk/stats/'], EE_FETCH_STRATEGY)
     soup = BeautifulSoup(html[0], 'html.parser')
 
     found_all_figures = False
@@ -245,21 +266,38 @@ def correct_for_diurnal_and_day_of_week(
     return {k: v / 7 * diurnal_model[dt.hour] for k, v in most_recent_measurements_pax_per_week.items()}
 
 
-async def poll_essential_edinburgh() -> List[PedFluxCounterMeasurement]:
+async def scrape_weekly_measurements(cache: SimpleCache) -> Dict[str, int]:
+    """Scrape the website and cache the most recent weekly measurements."""
+    all_measurements_pax_per_week = await scrape_dashboard()
+    weekly_measurements_pax_per_week = extract_most_recent_measurements(all_measurements_pax_per_week)
+    cache.write(weekly_measurements_pax_per_week)
+    return weekly_measurements_pax_per_week
+
+
+async def poll_essential_edinburgh(force_refresh: bool = False) -> List[PedFluxCounterMeasurement]:
     """Extract measurements from Essential Edinburgh.
 
     Wrapper function including caching
     for extracting measurements from Essential Edinburgh.
+    If a scrape fails, stale cached measurements are used instead (up to the hard timeout).
+    With force_refresh, the site is scraped even if the cached measurements are still current.
     """
-    cache = SimpleCache('essential_edinburgh', config.EE_CACHE_TIMEOUT_S)
-
-    weekly_measurements_pax_per_week = cache.read()
+    entry = EE_CACHE.read_entry()
 
-    if weekly_measurements_pax_per_week is None:
-        # scrape the website and cache the result
-        all_measurements_pax_per_week = await scrape_dashboard()
-        weekly_measurements_pax_per_week = extract_most_recent_measurements(all_measurements_pax_per_week)
-        cache.write(weekly_measurements_pax_per_week)
+    if entry is not None and not entry.is_stale and not force_refresh:
+        weekly_measurements_pax_per_week = entry.data
+    else:
+        try:
+            weekly_measurements_pax_per_week = await EE_SCRAPES.do(
+                'essential_edinburgh', lambda: scrape_weekly_measurements(EE_CACHE)
+            )
+        except Exception as e:
+            if entry is None:
+                raise
+            log.error(
+                f'Essential Edinburgh scrape failed with error {e}, using cached measurements from {entry.written_at}.'
+            )
+            weekly_measurements_pax_per_week = entry.data
 
     # Adjust the results for the current time of day / week.
     # This happens hourly while the scrape happens weekly.
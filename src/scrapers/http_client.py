@@ -0,0 +1,66 @@
+"""An HTTP client kept open between scrapes, so that connections to each site are reused for the pages of a scrape.
+
+httpx itself is only imported once a page is first fetched, so importing this is cheap.
+"""
+
+import logging
+from random import choice
+from typing import TYPE_CHECKING, Optional
+
+from engine import config
+
+if TYPE_CHECKING:
+    import httpx
+
+log = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """An async HTTP/1.1 client, created when a page is first fetched and kept open until closed.
+
+    At most max_connections requests are made at once (others wait for a connection to be free), and idle
+    connections are kept alive for keepalive_expiry_s, so that the pages of one scrape of a site reuse a few
+    connections rather than each opening its own. Scrapes are hours apart, far longer than sites keep idle
+    connections open, so each scrape opens its connections afresh. The client has a user agent picked at
+    random when it was created.
+    """
+
+    def __init__(self, max_connections: int, keepalive_expiry_s: float, timeout_s: float):
+        self.max_connections = max_connections
+        self.keepalive_expiry_s = keepalive_expiry_s
+        self.timeout_s = timeout_s
+        self._client: Optional['httpx.AsyncClient'] = None
+
+    async def get_text(self, url: str) -> str:
+        """Fetch a page, returning its body.
+
+        Raises httpx.HTTPError if it couldn't be fetched, including if its status wasn't a success.
+        """
+        response = await self._get_client().get(url)
+        response.raise_for_status()
+        return response.text
+
+    def _get_client(self) -> 'httpx.AsyncClient':
+        if self._client is None:
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                headers={'User-Agent': choice(config.PLAYWRIGHT_USER_AGENTS)},
+                timeout=self.timeout_s,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry_s,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def close(self) -> None:
+        """Close the client's connections, if it was created."""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+
+HTTP_CLIENT = HttpClient(config.HTTP_MAX_CONNECTIONS, config.HTTP_KEEPALIVE_EXPIRY_S, config.HTTP_TIMEOUT_S)
@@ -0,0 +1,151 @@
+"""Spreading scrapers' requests out, so that neither this box nor the sites scraped are strained."""
+
+import asyncio
+import logging
+import time
+from random import random
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple, Type, TypeVar
+from urllib.parse import urlsplit
+
+from engine import config
+from engine.metrics import SCRAPE_ATTEMPTS
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class TokenBucket:
+    """Lets requests through at rate_per_s on average, in bursts of up to burst at once."""
+
+    def __init__(self, rate_per_s: float, burst: int):
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        # so that requests are let through in the order they arrived
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a request may be made."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate_per_s)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate_per_s)
+
+
+class ScrapeScheduler:
+    """Fetches batches of pages with at most max_concurrent requests in progress at once (across all batches).
+
+    Requests to each host are also rate limited by a token bucket, of requests_per_host_per_s in bursts of up
+    to burst_per_host. A request that fails with one of the exceptions it may be retried on is retried, up to
+    max_attempts attempts in all, after a backoff that doubles with each attempt (from backoff_s, with jitter).
+    Pages still being fetched (or waiting to be retried) when their batch's deadline passes are cancelled.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        requests_per_host_per_s: float,
+        burst_per_host: int,
+        max_attempts: int,
+        backoff_s: float,
+    ):
+        self.requests_per_host_per_s = requests_per_host_per_s
+        self.burst_per_host = burst_per_host
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    async def as_completed(
+        self, urls: List[str], fetch_url: Callable[[str], Awaitable[T]], default: T, deadline: float
+    ) -> AsyncIterator[Tuple[int, T]]:
+        """Fetch each URL at once, yielding the index of each URL with its result as soon as it has been fetched.
+
+        Each is fetched by fetch_url, which should make its requests by attempt. Those not fetched by the
+        deadline (by time.monotonic()) are cancelled, and yielded last, with default. Exceptions are raised.
+        """
+        tasks = {asyncio.create_task(fetch_url(url)): i for i, url in enumerate(urls)}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for task in done:
+                    yield tasks[task], task.result()
+        finally:
+            # also if the caller stopped iterating, or a fetch raised
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        for i in sorted(tasks[task] for task in pending):
+            log.warning(f'Gave up on {urls[i]}, as the scrape ran out of time.')
+            SCRAPE_ATTEMPTS.labels(_host(urls[i]), 'deadline').inc()
+            yield i, default
+
+    async def attempt(
+        self,
+        url: str,
+        fetch: Callable[[str], Awaitable[T]],
+        default: T,
+        deadline: float,
+        retry_on: Tuple[Type[BaseException], ...] = (),
+    ) -> T:
+        """Fetch a URL once a fetch slot is free and its host's rate limit allows, returning default if it failed.
+
+        Fetches failing with one of the exceptions in retry_on are retried, unless the backoff would take
+        them past the deadline (by time.monotonic()). Other exceptions are raised.
+        """
+        host = _host(url)
+        for attempt in range(1, self.max_attempts + 1):
+            async with self._slots:
+                await self._bucket(host).acquire()
+                try:
+                    result = await fetch(url)
+                except retry_on as e:
+                    SCRAPE_ATTEMPTS.labels(host, 'failed').inc()
+                    failure = e
+                else:
+                    SCRAPE_ATTEMPTS.labels(host, 'ok').inc()
+                    return result
+
+            backoff_s = self.backoff_s * 2 ** (attempt - 1) * (0.5 + random())
+            if attempt == self.max_attempts or time.monotonic() + backoff_s >= deadline:
+                break
+            log.info(f'Attempt {attempt} at {url} failed ({failure!r}), retrying in {backoff_s:.1f}s.')
+            await asyncio.sleep(backoff_s)
+        log.warning(f'Gave up on {url} after {attempt} attempts ({failure!r}).')
+        return default
+
+    def _bucket(self, host: str) -> TokenBucket:
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.requests_per_host_per_s, self.burst_per_host)
+        return self._buckets[host]
+
+
+def _host(url: str) -> str:
+    return urlsplit(url).hostname or ''
+
+
+def batch_deadline() -> float:
+    """Return the deadline (by time.monotonic()) for a batch of fetches starting now."""
+    return time.monotonic() + config.SCRAPE_DEADLINE_S
+
+
+SCRAPE_SCHEDULER = ScrapeScheduler(
+    config.SCRAPE_MAX_CONCURRENT,
+    config.SCRAPE_REQUESTS_PER_HOST_PER_S,
+    config.SCRAPE_BURST_PER_HOST,
+    config.SCRAPE_MAX_ATTEMPTS,
+    config.SCRAPE_BACKOFF_S,
+)
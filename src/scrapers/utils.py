@@ -1,54 +1,174 @@
 import asyncio
 import logging
-from random import choice, random
-from typing import List
+import re
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, FrozenSet, List, Optional, Tuple
 
-from playwright.async_api import Browser, TimeoutError, async_playwright
+import httpx
+from bs4 import BeautifulSoup
+from playwright.async_api import Error, Page, Request, Route, TimeoutError
 
 from engine import config
+from engine.metrics import BLOCKED_REQUESTS, PAGE_BYTES, PAGE_FETCHES, PAGE_LOAD_DURATION
+from scrapers.browser_pool import BROWSER_POOL, BrowserPool
+from scrapers.http_client import HTTP_CLIENT, HttpClient
+from scrapers.scrape_scheduler import SCRAPE_SCHEDULER, batch_deadline
 
 log = logging.getLogger(__name__)
 
 
-async def _fetch_single_page(browser: Browser, url: str, page_load_indicator_selector: str) -> str:
-    # break up requests in time slightly so the site is not strained
-    await asyncio.sleep(random() * config.PLAYWRIGHT_POLL_JITTER_S)
+@dataclass(frozen=True)
+class ResourcePolicy:
+    """Which requests a scraped page may make; every other request is aborted.
+
+    A request is allowed if it is of one of the resource types (as Playwright names them, e.g. 'document'
+    or 'script') and its URL matches one of url_patterns, or if its URL matches one of
+    always_allowed_url_patterns, whatever its type. Patterns are regular expressions, searched for in the URL.
+    """
+
+    site: str  # as used to label the page load metrics
+    resource_types: FrozenSet[str]
+    url_patterns: Tuple[str, ...]
+    always_allowed_url_patterns: Tuple[str, ...] = ()
+
+    def allows(self, resource_type: str, url: str) -> bool:
+        """Return whether a page may make a request."""
+        if any(re.search(pattern, url) for pattern in self.always_allowed_url_patterns):
+            return True
+        return resource_type in self.resource_types and any(re.search(pattern, url) for pattern in self.url_patterns)
+
+
+@dataclass(frozen=True)
+class FetchStrategy:
+    """How to fetch a site's pages, each of which has loaded once page_load_indicator_selector appears in it.
+
+    If over_http_first, each page is first fetched over plain HTTP, as is enough for pages rendered by the
+    server, and only loaded in the browser (making the requests resource_policy allows) if the selector isn't
+    found in what was fetched. Otherwise, pages are always loaded in the browser.
+    """
+
+    page_load_indicator_selector: str
+    resource_policy: ResourcePolicy
+    over_http_first: bool = False
+
+
+async def _fetch_single_page(
+    pool: BrowserPool, url: str, page_load_indicator_selector: str, policy: ResourcePolicy
+) -> str:
     log.debug(f'Opening page for: {url}')
-    # randomise identity a bit
-    context = await browser.new_context(
-        user_agent=choice(config.PLAYWRIGHT_USER_AGENTS),
-        viewport=choice(config.PLAYWRIGHT_VIEWPORTS),
-        locale=choice(config.PLAYWRIGHT_LOCALES),
-    )
-    page = await context.new_page()
+    async with pool.page() as page:
+        return await _load_page(page, url, page_load_indicator_selector, policy)
+
+
+async def _load_page(page: Page, url: str, page_load_indicator_selector: str, policy: ResourcePolicy) -> str:
+    async def apply_policy(route: Route) -> None:
+        request = route.request
+        if policy.allows(request.resource_type, request.url):
+            await route.continue_()
+        else:
+            BLOCKED_REQUESTS.labels(policy.site, request.resource_type).inc()
+            await route.abort()
+
+    finished: List[Request] = []
+    page.on('requestfinished', finished.append)
+    await page.route('**/*', apply_policy)
+    start = time.perf_counter()
     try:
         await page.goto(url, timeout=config.PLAYWRIGHT_LOAD_TIMEOUT_S * 1000)
         log.debug(f'Waiting for {url} to render...')
 
         await page.wait_for_selector(page_load_indicator_selector, timeout=config.PLAYWRIGHT_LOAD_TIMEOUT_S * 1000)
+        PAGE_LOAD_DURATION.labels(policy.site, 'loaded').observe(time.perf_counter() - start)
 
         html = await page.content()
         log.debug('html extracted')
         return html
     except TimeoutError:
+        PAGE_LOAD_DURATION.labels(policy.site, 'timeout').observe(time.perf_counter() - start)
         html = await page.content()
         log.warning(
             f'Timed out when fetching {url}, page url was {page.url}, '
-            f'page title was {await page.title()}, content contained {html[:10000]}, '
-            'returning empty string.'
+            f'page title was {await page.title()}, content contained {html[:10000]}.'
         )
-        return ''
+        raise
     finally:
-        await page.close()
-
-
-async def scrape_urls(urls: List[str], page_load_indicator_selector: str) -> List[str]:
-    async with async_playwright() as p:
-        log.debug('Launching browser...')
-        browser = await p.chromium.launch(headless=True)
-        try:
-            tasks = [_fetch_single_page(browser, url, page_load_indicator_selector) for url in urls]
-            html_pages = await asyncio.gather(*tasks)
-            return html_pages
-        finally:
-            await browser.close()
+        await _record_bytes_transferred(policy.site, finished)
+
+
+async def _record_bytes_transferred(site: str, requests: List[Request]) -> None:
+    try:
+        sizes = await asyncio.gather(*[request.sizes() for request in requests])
+    except Error as e:
+        log.debug(f'Could not measure the bytes transferred for a page: {e}')
+        return
+    PAGE_BYTES.labels(site).observe(sum(s['responseHeadersSize'] + s['responseBodySize'] for s in sizes))
+
+
+async def _fetch_over_http(client: HttpClient, url: str, strategy: FetchStrategy) -> Optional[str]:
+    """Return a page fetched over plain HTTP, or None if it couldn't be or the selector wasn't found in it."""
+    try:
+        html = await client.get_text(url)
+    except httpx.HTTPError as e:
+        log.info(f'Could not fetch {url} over HTTP ({e!r}), loading it in the browser instead.')
+        return None
+    if BeautifulSoup(html, 'html.parser').select_one(strategy.page_load_indicator_selector) is None:
+        log.info(f'{url} fetched over HTTP had no {strategy.page_load_indicator_selector}, loading it in the browser.')
+        return None
+    return html
+
+
+async def _fetch_page(url: str, strategy: FetchStrategy, deadline: float) -> str:
+    site = strategy.resource_policy.site
+    if strategy.over_http_first:
+        html = await SCRAPE_SCHEDULER.attempt(
+            url, lambda url: _fetch_over_http(HTTP_CLIENT, url, strategy), default=None, deadline=deadline
+        )
+        if html is not None:
+            PAGE_FETCHES.labels(site, 'http').inc()
+            return html
+    PAGE_FETCHES.labels(site, 'browser').inc()
+    return await SCRAPE_SCHEDULER.attempt(
+        url,
+        lambda url: _fetch_single_page(
+            BROWSER_POOL, url, strategy.page_load_indicator_selector, strategy.resource_policy
+        ),
+        default='',
+        deadline=deadline,
+        retry_on=(TimeoutError,),
+    )
+
+
+async def _fetch_as_completed(urls: List[str], strategy: FetchStrategy) -> AsyncIterator[Tuple[int, str]]:
+    deadline = batch_deadline()
+    async for i, html in SCRAPE_SCHEDULER.as_completed(
+        urls, lambda url: _fetch_page(url, strategy, deadline), default='', deadline=deadline
+    ):
+        yield i, html
+
+
+async def stream_urls(urls: List[str], strategy: FetchStrategy) -> AsyncIterator[Tuple[str, str]]:
+    """Fetch each page as the site's strategy says, yielding it with its HTML (or '' if it didn't load) once fetched.
+
+    Pages are fetched as the scrape scheduler allows, retrying those that time out in the browser, until
+    SCRAPE_DEADLINE_S from now. They are yielded in the order they were fetched, so each can be dealt with
+    while the rest are still being fetched.
+    """
+    async for i, html in _fetch_as_completed(urls, strategy):
+        yield urls[i], html
+
+
+async def fetch_urls(urls: List[str], strategy: FetchStrategy) -> List[str]:
+    """Fetch each page as stream_urls does, returning their HTML (or '' if it didn't load) in order."""
+    htmls = [''] * len(urls)
+    async for i, html in _fetch_as_completed(urls, strategy):
+        htmls[i] = html
+    return htmls
+
+
+async def scrape_urls(urls: List[str], page_load_indicator_selector: str, policy: ResourcePolicy) -> List[str]:
+    """Load each page in the shared browser, returning its HTML (or '' if it didn't load), in order.
+
+    Each page is loaded until page_load_indicator_selector appears, making only the requests the policy allows.
+    """
+    return await fetch_urls(urls, FetchStrategy(page_load_indicator_selector, policy))
@@ -1,41 +1,211 @@
-from smtplib import SMTPResponseException
-from unittest.mock import MagicMock, patch
+import asyncio
+import socket
+from email import message_from_bytes
+from email.policy import default
 
-from engine.alerting import alert_via_email
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
 
+from engine.alerting import AlertDispatcher, SMTPServer
 
-def test_alert_via_email_sends_message():
-    test_alert = 'Test alert'
-    test_recipient = 'test@example.com'
 
-    with patch('engine.alerting.smtplib.SMTP_SSL') as mock_smtp:
-        mock_smtp_instance = MagicMock()
-        mock_smtp.return_value.__enter__.return_value = mock_smtp_instance
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+        self.sessions = []
 
-        alert_via_email(test_alert, destination_email=test_recipient)
+    async def handle_DATA(self, server, session, envelope):
+        """Record each message received, and which connection it came over."""
+        self.messages.append(message_from_bytes(envelope.content, policy=default))
+        self.sessions.append(id(session))
+        return '250 OK'
 
-        # Assert login was called with correct credentials
-        mock_smtp_instance.login.assert_called_once()
-        args, _ = mock_smtp_instance.login.call_args
-        assert '@' in args[0]  # crude check to ensure it's an email
-        assert isinstance(args[1], str)
 
-        # Assert message was sent
-        mock_smtp_instance.send_message.assert_called_once()
-        sent_msg = mock_smtp_instance.send_message.call_args[0][0]
-        assert test_alert in sent_msg.get_content()
-        assert sent_msg['To'] == test_recipient
-        assert sent_msg['Subject'] == 'Edinburgh Crowds Alert'
+def accept_any_login(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=True)
 
 
-def test_alert_via_email_handles_smtp_exception(caplog):
-    with patch('engine.alerting.smtplib.SMTP_SSL') as mock_smtp:
-        mock_smtp_instance = MagicMock()
-        mock_smtp_instance.send_message.side_effect = SMTPResponseException(550, b'Mock failure')
-        mock_smtp.return_value.__enter__.return_value = mock_smtp_instance
+@pytest.fixture
+def smtp_server():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    handler = RecordingHandler()
+    controller = Controller(
+        handler, hostname='127.0.0.1', port=port, authenticator=accept_any_login, auth_require_tls=False
+    )
+    controller.start()
+    yield handler, SMTPServer('127.0.0.1', port, False, 'user', 'password')
+    controller.stop()
 
-        # Call with defaults
-        alert_via_email('Failure test')
 
-        # Check that an error was logged
-        assert any('SMTP error' in record.message for record in caplog.records if record.levelname == 'ERROR')
+async def wait_for_messages(handler, n_messages):
+    async with asyncio.timeout(5):
+        while len(handler.messages) < n_messages:
+            await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_alerts_raised_within_a_window_are_sent_as_one_digest(smtp_server):
+    handler, server = smtp_server
+    dispatcher = AlertDispatcher(server, 'test@example.com', digest_window_s=0.1, repeat_cooldown_s=0, max_queued=10)
+    running = asyncio.create_task(dispatcher.run())
+
+    for _ in range(3):
+        dispatcher.alert('Refreshing nowcast failed')
+    dispatcher.alert('Refreshing edintraveldata failed')
+    await wait_for_messages(handler, 1)
+
+    dispatcher.alert('Refreshing nowcast failed again')
+    await wait_for_messages(handler, 2)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    digest, later = handler.messages
+    assert digest['To'] == 'test@example.com'
+    assert digest['Subject'] == 'Edinburgh Crowds Alert (4 alerts)'
+    body = digest.get_content()
+    assert body.count('Refreshing nowcast failed') == 1
+    assert 'and 2 more times' in body
+    assert 'Refreshing edintraveldata failed' in body
+    assert later['Subject'] == 'Edinburgh Crowds Alert'
+    # the connection was kept open between the two
+    assert handler.sessions[0] == handler.sessions[1]
+
+
+@pytest.mark.asyncio
+async def test_repeats_of_an_emailed_alert_are_held_back_for_the_cooldown(smtp_server):
+    handler, server = smtp_server
+    dispatcher = AlertDispatcher(server, 'test@example.com', digest_window_s=0.05, repeat_cooldown_s=0.5, max_queued=10)
+    running = asyncio.create_task(dispatcher.run())
+
+    dispatcher.alert('Refreshing nowcast failed')
+    await wait_for_messages(handler, 1)
+    # the same alert again, after the window it was emailed in has closed
+    dispatcher.alert('Refreshing nowcast failed')
+    await asyncio.sleep(0.1)
+    assert len(handler.messages) == 1
+    dispatcher.alert('Refreshing edintraveldata failed')
+    await wait_for_messages(handler, 2)
+    await asyncio.sleep(0.5)
+    dispatcher.alert('Refreshing nowcast failed')
+    await wait_for_messages(handler, 3)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    _, other, after_cooldown = (m.get_content() for m in handler.messages)
+    assert 'Refreshing nowcast failed' not in other
+    assert 'also raised 1 times since it was last emailed' in after_cooldown
+
+
+@pytest.mark.asyncio
+async def test_alerts_are_sent_on_shutdown(smtp_server):
+    handler, server = smtp_server
+    dispatcher = AlertDispatcher(server, 'test@example.com', digest_window_s=60, repeat_cooldown_s=0, max_queued=10)
+    running = asyncio.create_task(dispatcher.run())
+
+    dispatcher.alert('Shutting down')
+    await asyncio.sleep(0.05)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    assert [m.get_content().strip().endswith('Shutting down') for m in handler.messages] == [True]
+
+
+@pytest.mark.asyncio
+async def test_closed_connection_is_reopened(smtp_server):
+    handler, server = smtp_server
+    dispatcher = AlertDispatcher(server, 'test@example.com', digest_window_s=0, repeat_cooldown_s=0, max_queued=10)
+    running = asyncio.create_task(dispatcher.run())
+
+    dispatcher.alert('first')
+    await wait_for_messages(handler, 1)
+    dispatcher._smtp.close()
+    dispatcher.alert('second')
+    await wait_for_messages(handler, 2)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    assert handler.sessions[0] != handler.sessions[1]
+
+
+def test_full_queue_drops_alerts(smtp_server, caplog):
+    _, server = smtp_server
+    dispatcher = AlertDispatcher(server, 'test@example.com', digest_window_s=0, repeat_cooldown_s=0, max_queued=2)
+
+    for i in range(3):
+        dispatcher.alert(f'alert {i}')
+
+    assert dispatcher.queue.qsize() == dispatcher.queue.maxsize
+    assert any('dropping alert: alert 2' in record.message for record in caplog.records)
+
+
+@pytest.mark.asyncio
+async def test_undeliverable_alerts_are_logged(caplog):
+    dispatcher = AlertDispatcher(
+        SMTPServer('127.0.0.1', 1, False, 'user', 'password'),
+        'test@example.com',
+        digest_window_s=0,
+        repeat_cooldown_s=0,
+        max_queued=2,
+    )
+    running = asyncio.create_task(dispatcher.run())
+
+    dispatcher.alert('nobody is listening')
+    await asyncio.sleep(0.1)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    assert any('Email was not delivered' in record.message for record in caplog.records)
+
+
+@pytest.mark.asyncio
+async def test_undelivered_alerts_are_not_held_back(caplog):
+    dispatcher = AlertDispatcher(
+        SMTPServer('127.0.0.1', 1, False, 'user', 'password'),
+        'test@example.com',
+        digest_window_s=0,
+        repeat_cooldown_s=60,
+        max_queued=2,
+    )
+    running = asyncio.create_task(dispatcher.run())
+
+    attempts = 2
+    for _ in range(attempts):
+        dispatcher.alert('nobody is listening')
+        await asyncio.sleep(0.1)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    assert len([record for record in caplog.records if 'Email was not delivered' in record.message]) == attempts
+
+
+@pytest.mark.asyncio
+async def test_alerts_are_forgotten_once_cooled_down(smtp_server):
+    handler, server = smtp_server
+    dispatcher = AlertDispatcher(server, 'test@example.com', digest_window_s=0, repeat_cooldown_s=0.05, max_queued=10)
+    running = asyncio.create_task(dispatcher.run())
+
+    dispatcher.alert('Refreshing nowcast failed with error 1')
+    await wait_for_messages(handler, 1)
+    dispatcher.alert('Refreshing nowcast failed with error 1')
+    await asyncio.sleep(0.1)
+    dispatcher.alert('Refreshing nowcast failed with error 2')
+    await wait_for_messages(handler, 2)
+    async with asyncio.timeout(5):
+        # once the dispatcher has seen it was delivered
+        while 'Refreshing nowcast failed with error 2' not in dispatcher._last_emailed:
+            await asyncio.sleep(0.01)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    assert list(dispatcher._last_emailed) == ['Refreshing nowcast failed with error 2']
+    assert dispatcher._suppressed == {}
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from engine.broadcast import Broadcaster
+
+N_SUBSCRIBERS = 100
+
+
+@pytest.mark.asyncio
+async def test_publish_wakes_all_waiting_subscribers():
+    broadcaster = Broadcaster()
+    waiters = [asyncio.create_task(broadcaster.wait_for_message(0, timeout_s=5)) for _ in range(N_SUBSCRIBERS)]
+    await asyncio.sleep(0)
+
+    broadcaster.publish(b'hello')
+
+    results = await asyncio.gather(*waiters)
+    assert results == [(1, b'hello')] * N_SUBSCRIBERS
+    # every subscriber got the very same bytes, not a copy
+    assert all(message is results[0][1] for _, message in results)
+
+
+@pytest.mark.asyncio
+async def test_wait_times_out_without_a_new_message():
+    broadcaster = Broadcaster()
+    broadcaster.publish(b'old news')
+
+    assert await broadcaster.wait_for_message(broadcaster.sequence, timeout_s=0.01) == (1, None)
+
+
+@pytest.mark.asyncio
+async def test_subscribers_that_fall_behind_skip_to_the_latest_message():
+    broadcaster = Broadcaster()
+    broadcaster.publish(b'first')
+    broadcaster.publish(b'second')
+
+    sequence, message = await broadcaster.wait_for_message(0, timeout_s=0.01)
+    assert message == b'second'
+    assert sequence == broadcaster.sequence
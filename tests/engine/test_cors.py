@@ -0,0 +1,99 @@
+from http import HTTPStatus
+
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.testclient import TestClient
+
+from engine.cors import DynamicCORSMiddleware, is_allowed_origin, is_vercel_preview_deployment
+
+PRODUCTION = 'https://www.edinburghcrowds.co.uk'
+MAX_AGE_S = 600
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+
+    @app.get('/thing')
+    async def get_thing() -> Response:
+        return Response(content=b'{}', media_type='application/json', headers={'Vary': 'Accept-Encoding'})
+
+    app.add_middleware(DynamicCORSMiddleware, expose_headers='X-Nowcast-Version', max_age_s=MAX_AGE_S)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize(
+    'url',
+    [
+        'https://edicrowds-frontend-abc123-tristan-goss-projects.vercel.app',
+        'https://edicrowds-frontend-preview-7fa9c7-tristan-goss-projects.vercel.app',
+        'https://edicrowds-frontend-xyz-123-tristan-goss-projects.vercel.app',
+    ],
+)
+def test_valid_vercel_preview_urls(url):
+    assert is_vercel_preview_deployment(url) is True
+
+
+@pytest.mark.parametrize(
+    'url',
+    [
+        'http://edicrowds-frontend-abc123-tristan-goss-projects.vercel.app',  # wrong scheme
+        'https://edicrowds-frontend--tristan-goss-projects.vercel.app',  # empty slug
+        'https://otherdomain.com',  # totally different
+        'https://edicrowds-frontend-abc123-tristan.vercel.app',  # wrong subdomain
+        'https://vercel.app',  # bare domain
+    ],
+)
+def test_invalid_vercel_preview_urls(url):
+    assert is_vercel_preview_deployment(url) is False
+
+
+def test_allowed_origins_are_memoised():
+    is_allowed_origin.cache_clear()
+    assert is_allowed_origin(PRODUCTION)
+    assert is_allowed_origin(PRODUCTION)
+    assert not is_allowed_origin('https://otherdomain.com')
+    assert is_allowed_origin.cache_info().hits == 1
+
+
+def test_allowed_origin_gets_cors_headers(client):
+    response = client.get('/thing', headers={'Origin': PRODUCTION})
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['access-control-allow-origin'] == PRODUCTION
+    assert response.headers['access-control-allow-credentials'] == 'true'
+    assert response.headers['access-control-expose-headers'] == 'X-Nowcast-Version'
+    assert response.headers['vary'] == 'Accept-Encoding, Origin'
+
+
+@pytest.mark.parametrize('headers', [{}, {'Origin': 'https://otherdomain.com'}])
+def test_other_requests_are_untouched(client, headers):
+    response = client.get('/thing', headers=headers)
+
+    assert response.status_code == HTTPStatus.OK
+    assert 'access-control-allow-origin' not in response.headers
+    assert response.headers['vary'] == 'Accept-Encoding'
+
+
+def test_preflight_is_answered_directly(client):
+    response = client.options(
+        '/thing',
+        headers={
+            'Origin': PRODUCTION,
+            'Access-Control-Request-Method': 'GET',
+            'Access-Control-Request-Headers': 'If-None-Match',
+        },
+    )
+
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    assert response.headers['access-control-allow-origin'] == PRODUCTION
+    assert response.headers['access-control-allow-methods'] == 'GET'
+    assert response.headers['access-control-allow-headers'] == 'If-None-Match'
+    assert response.headers['access-control-max-age'] == str(MAX_AGE_S)
+
+
+def test_preflight_from_other_origin_is_not_answered(client):
+    response = client.options(
+        '/thing', headers={'Origin': 'https://otherdomain.com', 'Access-Control-Request-Method': 'GET'}
+    )
+    assert response.status_code == HTTPStatus.METHOD_NOT_ALLOWED
@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from engine.history import NowcastHistory
+from engine.simple_cache import SimpleCache
+
+START = datetime(2025, 3, 19, 9, 0)
+HOUR = timedelta(hours=1)
+
+
+@pytest.fixture
+def history(tmp_path):
+    return NowcastHistory('history', max_rows=3, cache_root=tmp_path)
+
+
+def test_empty_history(history):
+    assert len(history) == 0
+    assert history.series('141177') is None
+
+
+def test_append_and_read_series(history):
+    history.append({'141177': 0.01986, '141194': 0.5}, START)
+    history.append({'141177': 0.02, '141194': 0.25}, START + HOUR)
+
+    assert history.series('141177') == ([START, START + HOUR], [0.01986, 0.02])
+    assert history.series('141194', start=START + HOUR) == ([START + HOUR], [0.25])
+    assert history.series('141194', end=START) == ([START], [0.5])
+    assert history.series('141194', start=START + 2 * HOUR) == ([], [])
+
+
+def test_ring_buffer_overwrites_oldest(history):
+    for i in range(history.max_rows + 2):
+        history.append({'141177': float(i)}, START + i * HOUR)
+
+    timestamps, densities = history.series('141177')
+    assert len(history) == history.max_rows
+    assert densities == [2.0, 3.0, 4.0]
+    assert timestamps == [START + i * HOUR for i in (2, 3, 4)]
+
+
+def test_history_persists(history, tmp_path):
+    history.append({'141177': 0.5}, START)
+
+    reopened = NowcastHistory('history', max_rows=3, cache_root=tmp_path)
+
+    assert reopened.series('141177') == ([START], [0.5])
+    reopened.append({'141177': 0.25}, START + HOUR)
+    assert reopened.series('141177') == ([START, START + HOUR], [0.5, 0.25])
+
+
+@pytest.mark.parametrize('appended_before_second_opened', [0, 1])
+def test_appending_from_another_instance_keeps_the_history(tmp_path, appended_before_second_opened):
+    first = NowcastHistory('history', max_rows=5, cache_root=tmp_path)
+    for i in range(appended_before_second_opened):
+        first.append({'141177': float(i)}, START + i * HOUR)
+    # as when a follower worker, started alongside the refresher, takes over from it
+    second = NowcastHistory('history', max_rows=5, cache_root=tmp_path)
+    for i in range(appended_before_second_opened, 3):
+        first.append({'141177': float(i)}, START + i * HOUR)
+
+    second.append({'141177': 3.0}, START + 3 * HOUR)
+
+    reader = NowcastHistory('history', max_rows=5, cache_root=tmp_path)
+    assert reader.series('141177') == ([START + i * HOUR for i in range(4)], [0.0, 1.0, 2.0, 3.0])
+    assert len(second) == len(reader)
+
+
+def test_history_survives_the_nowcast_cache_being_cleared(tmp_path):
+    history = NowcastHistory('nowcast_history', max_rows=3, cache_root=tmp_path)
+    history.append({'141177': 0.5}, START)
+    cache = SimpleCache('nowcast', 60 * 60, cache_root=tmp_path)
+    cache.write({'141177': 0.5})
+    cache.clear()
+
+    reopened = NowcastHistory('nowcast_history', max_rows=3, cache_root=tmp_path)
+
+    assert reopened.series('141177') == ([START], [0.5])
+
+
+def test_legacy_sidecar_is_kept(tmp_path):
+    NowcastHistory('nowcast_history', max_rows=3, cache_root=tmp_path).append({'141177': 0.5}, START)
+    (tmp_path / 'nowcast_history.meta').rename(tmp_path / 'nowcast_history.json')
+
+    reopened = NowcastHistory('nowcast_history', max_rows=3, cache_root=tmp_path)
+
+    assert reopened.series('141177') == ([START], [0.5])
+    assert not (tmp_path / 'nowcast_history.json').exists()
+
+
+def test_older_nowcasts_are_not_appended(history):
+    history.append({'141177': 0.5}, START)
+    history.append({'141177': 0.25}, START)
+    history.append({'141177': 0.25}, START - HOUR)
+
+    assert history.series('141177') == ([START], [0.5])
+
+
+def test_changing_oas_starts_afresh(history):
+    history.append({'141177': 0.5, '141194': 0.5}, START)
+    history.append({'141177': 0.25}, START + HOUR)
+
+    assert history.series('141177') == ([START + HOUR], [0.25])
+    assert history.series('141194') is None
+
+
+def test_changing_size_starts_afresh(history, tmp_path):
+    history.append({'141177': 0.5}, START)
+
+    resized = NowcastHistory('history', max_rows=5, cache_root=tmp_path)
+
+    assert len(resized) == 0
+    assert resized.series('141177') is None
@@ -0,0 +1,122 @@
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from engine.keyed_cache import FileCacheBackend, KeyedCache, SQLiteCacheBackend
+from engine.metrics import CACHE_READS
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'file':
+        yield FileCacheBackend(tmp_path)
+    else:
+        backend = SQLiteCacheBackend(tmp_path / 'cache.sqlite3', evict_interval_s=60 * 60)
+        yield backend
+        backend.close()
+
+
+def test_put_and_get(backend):
+    cache = KeyedCache('sensors', max_age_s=60, backend=backend)
+    cache.put('https://example.com/?site=1', {'count': 1})
+
+    assert cache.get('https://example.com/?site=1') == {'count': 1}
+    assert cache.get('https://example.com/?site=2') is None
+
+
+def test_batched_get_and_put(backend):
+    cache = KeyedCache('sensors', max_age_s=60, backend=backend)
+    sites = range(1200)
+    cache.put_many({str(site): site for site in sites})
+    cache.put('3', 'replaced')
+
+    found = cache.get_many([str(site) for site in range(0, 1300, 3)])
+
+    assert len(found) == len(range(0, 1200, 3))
+    assert found['3'] == 'replaced'
+    assert found[str(sites[-3])] == sites[-3]
+
+
+def test_namespaces_are_separate(backend):
+    KeyedCache('a', max_age_s=60, backend=backend).put('key', 'a')
+    KeyedCache('b', max_age_s=60, backend=backend).put('key', 'b')
+    KeyedCache('b', max_age_s=60, backend=backend).clear()
+
+    assert KeyedCache('a', max_age_s=60, backend=backend).get('key') == 'a'
+    assert KeyedCache('b', max_age_s=60, backend=backend).get('key') is None
+
+
+def test_stale_values_are_only_returned_as_entries(backend):
+    cache = KeyedCache('sensors', max_age_s=0.05, backend=backend, hard_max_age_s=60)
+    cache.put('key', 'value')
+    time.sleep(0.1)
+
+    assert cache.get('key') is None
+    entry = cache.get_entries(['key'])['key']
+    assert entry.data == 'value'
+    assert entry.is_stale
+
+
+def test_values_are_gone_after_the_hard_timeout(backend):
+    cache = KeyedCache('sensors', max_age_s=0.05, backend=backend, hard_max_age_s=0.1)
+    cache.put('key', 'value')
+    time.sleep(0.2)
+
+    assert cache.get_entries(['key']) == {}
+
+
+def test_eviction(backend):
+    short_lived = {'a': 1, 'b': 2}
+    KeyedCache('short', max_age_s=0.1, backend=backend).put_many(short_lived)
+    KeyedCache('long', max_age_s=60, backend=backend).put('a', 1)
+
+    assert backend.evict(datetime.now() + timedelta(seconds=1)) == len(short_lived)
+    assert KeyedCache('long', max_age_s=60, backend=backend).get('a') == 1
+
+
+def test_values_survive_a_restart(backend, tmp_path):
+    KeyedCache('sensors', max_age_s=60, backend=backend).put('key', [1, 2])
+
+    if isinstance(backend, SQLiteCacheBackend):
+        backend.close()
+        backend = SQLiteCacheBackend(backend.path, evict_interval_s=60 * 60)
+    else:
+        backend = FileCacheBackend(tmp_path)
+
+    assert KeyedCache('sensors', max_age_s=60, backend=backend).get('key') == [1, 2]
+
+
+def test_reads_are_counted(backend):
+    cache = KeyedCache('countedkeyedcache', max_age_s=60, backend=backend)
+    cache.put('a', 1)
+    hits = CACHE_READS.labels('countedkeyedcache', 'hit', backend.name)
+    misses = CACHE_READS.labels('countedkeyedcache', 'miss', backend.name)
+    counts = hits.value, misses.value
+
+    cache.get_many(['a', 'b', 'c'])
+
+    assert (hits.value, misses.value) == (counts[0] + 1, counts[1] + 2)
+
+
+def test_sqlite_backend_uses_wal_and_indexes_expiry(tmp_path):
+    backend = SQLiteCacheBackend(tmp_path / 'cache.sqlite3', evict_interval_s=60 * 60)
+    KeyedCache('sensors', max_age_s=60, backend=backend).put('key', 'value')
+    backend.close()
+
+    connection = sqlite3.connect(tmp_path / 'cache.sqlite3')
+    assert connection.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    plan = connection.execute('EXPLAIN QUERY PLAN DELETE FROM cache_values WHERE expires_at <= 0').fetchall()
+    assert 'cache_values_expires_at' in str(plan)
+    connection.close()
+
+
+def test_sqlite_backend_evicts_periodically_when_writing(tmp_path):
+    backend = SQLiteCacheBackend(tmp_path / 'cache.sqlite3', evict_interval_s=0)
+    KeyedCache('short', max_age_s=0.05, backend=backend).put('a', 1)
+    time.sleep(0.1)
+    KeyedCache('long', max_age_s=60, backend=backend).put('b', 2)
+
+    assert backend._connect().execute('SELECT namespace, key FROM cache_values').fetchall() == [('long', 'b')]
+    backend.close()
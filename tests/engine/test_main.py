@@ -1,10 +1,61 @@
+import asyncio
 import json
-from datetime import datetime
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from http import HTTPStatus
 from unittest.mock import AsyncMock, MagicMock, patch
 
+import geopandas as gpd
+import httpx
+import mapbox_vector_tile
 import pytest
+import shapely
+from fastapi.testclient import TestClient
+
+import engine.main
+from engine.broadcast import Broadcaster
+from engine.history import NowcastHistory
+from engine.main import (
+    NOWCAST_REFRESHES,
+    app,
+    build_refresh_scheduler,
+    coordinate_workers,
+    load_oa_geometries,
+    load_shared_snapshot,
+    load_shared_tiles,
+    nowcast_event_stream,
+    nowcast_expires_at,
+    poll_all_sensors,
+    publish_nowcast_snapshot,
+    refresh_cached_nowcast,
+    warm_nowcast_snapshot,
+)
+from engine.simple_cache import CacheEntry
+from engine.snapshot import NowcastSnapshot
+from engine.spatial import OASpatialIndex
+from engine.tiles import DensityTiles
+from engine.versions import NowcastVersions
+from engine.workers import LeaderLock, SharedMetrics, SharedSnapshotFile, SharedTilesFile
+
+
+@pytest.fixture(autouse=True)
+def history(monkeypatch, tmp_path):
+    # keep generated nowcasts out of the real history in CACHE_ROOT
+    history = NowcastHistory('nowcast_history', max_rows=10, cache_root=tmp_path / 'history')
+    monkeypatch.setattr('engine.main.NOWCAST_HISTORY', history)
+    return history
 
-from engine.main import is_vercel_preview_deployment, nowcast_cache_autorefresh_iteration, refresh_cached_nowcast
+
+@pytest.fixture(autouse=True)
+def shared_snapshot(monkeypatch, tmp_path):
+    shared_snapshot = SharedSnapshotFile(tmp_path / 'nowcast.snapshot')
+    monkeypatch.setattr('engine.main.SHARED_SNAPSHOT', shared_snapshot)
+    monkeypatch.setattr('engine.main.SHARED_TILES', SharedTilesFile(tmp_path / 'density.tiles'))
+    monkeypatch.setattr('engine.main.SHARED_METRICS', SharedMetrics(tmp_path / 'metrics', max_age_s=60))
+    monkeypatch.setattr('engine.main.REFRESHER_LOCK', LeaderLock(tmp_path / 'refresher.lock'))
+    monkeypatch.setattr('engine.main.REFRESH_SCHEDULE_PATH', tmp_path / 'refresh_schedule.json')
+    return shared_snapshot
 
 
 @pytest.mark.asyncio
@@ -26,7 +77,23 @@ async def test_refresh_cached_nowcast_with_trade_secrets(monkeypatch):
 
 
 @pytest.mark.asyncio
-async def test_refresh_cached_nowcast_without_trade_secrets(monkeypatch, tmp_path):
+async def test_nowcast_is_published_even_if_the_history_cannot_be_written(monkeypatch, caplog):
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', False)
+    monkeypatch.setattr('engine.main.NOWCAST_CACHE', MagicMock())
+    history = MagicMock()
+    history.append.side_effect = OSError('No space left on device')
+    monkeypatch.setattr('engine.main.NOWCAST_HISTORY', history)
+
+    nowcast = await refresh_cached_nowcast()
+
+    assert dict(engine.main.NOWCAST_VERSIONS.latest.nowcast) == nowcast
+    assert SharedSnapshotFile(engine.main.SHARED_SNAPSHOT.path).read_if_changed(None) is not None
+    assert any('No space left on device' in record.message for record in caplog.records)
+
+
+@pytest.mark.asyncio
+async def test_refresh_cached_nowcast_without_trade_secrets(monkeypatch, tmp_path, history):
     monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', False)
 
     # Create a fake mock_nowcast.json file in a fake package structure
@@ -46,93 +113,541 @@ async def test_refresh_cached_nowcast_without_trade_secrets(monkeypatch, tmp_pat
     assert result == mock_data
     mock_cache.write.assert_called_once_with(mock_data)
     mock_log.assert_called_once()
+    assert history.series('oa003')[1] == [mock_data['oa003']]
 
 
-@pytest.mark.asyncio
-async def test_autorefresh_runs_when_time_is_in_window(monkeypatch):
-    fake_now = datetime(2024, 4, 30, 10, 0)  # Tuesday 10am
+def test_without_trade_secrets_only_the_nowcast_is_refreshed(monkeypatch):
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', False)
+    assert [s.name for s in build_refresh_scheduler().refreshes] == ['nowcast']
 
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_HOUR', 9)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_LAST_HOUR', 17)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_WEEKDAY', 0)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_LAST_WEEKDAY', 4)
 
-    mock_refresh = AsyncMock()
-    monkeypatch.setattr('engine.main.refresh_cached_nowcast', mock_refresh)
+def test_sources_are_refreshed_before_the_nowcast(monkeypatch):
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', True)
+    assert [s.name for s in build_refresh_scheduler().refreshes] == [
+        'essential_edinburgh',
+        'edintraveldata',
+        'nowcast',
+    ]
 
-    with patch('engine.main.log.info') as mock_log:
-        await nowcast_cache_autorefresh_iteration(fake_now)
 
-    mock_refresh.assert_awaited_once()
-    assert any('Autorefreshing cache' in call.args[0] for call in mock_log.call_args_list)
+def test_nowcast_expires_at(monkeypatch):
+    versions = NowcastVersions(max_versions=3)
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', versions)
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', Broadcaster())
+    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_TIMEOUT_S', 3600)
+    assert nowcast_expires_at() is None
 
+    publish_nowcast_snapshot({'141177': 0.5}, datetime(2025, 3, 19, 10, 5))
 
-@pytest.mark.asyncio
-async def test_autorefresh_skips_on_weekend(monkeypatch):
-    fake_now = datetime(2024, 4, 28, 10, 0)  # Sunday
+    assert nowcast_expires_at() == datetime(2025, 3, 19, 11, 5)
 
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_HOUR', 9)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_LAST_HOUR', 17)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_WEEKDAY', 0)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_LAST_WEEKDAY', 4)
 
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    # not used as a context manager, so the lifespan (and its refresh scheduler) doesn't start
+    return TestClient(app)
+
+
+@pytest.mark.parametrize('accept_encoding, expected_encoding', [('br', 'br'), ('gzip', 'gzip'), ('identity', None)])
+def test_get_nowcast_serves_precompressed_snapshot(client, monkeypatch, accept_encoding, expected_encoding):
+    nowcast = {'oa001': 0.7, 'oa002': 0.3}
+    publish_nowcast_snapshot(nowcast, datetime.now())
     mock_refresh = AsyncMock()
     monkeypatch.setattr('engine.main.refresh_cached_nowcast', mock_refresh)
 
-    with patch('engine.main.log.debug') as mock_log:
-        await nowcast_cache_autorefresh_iteration(fake_now)
+    response = client.get('/nowcast', headers={'Accept-Encoding': accept_encoding})
 
+    assert response.is_success
+    assert response.headers.get('content-encoding') == expected_encoding
+    assert response.headers['vary'] == 'Accept-Encoding'
+    assert response.headers['x-nowcast-stale'] == 'false'
+    assert response.json() == nowcast
     mock_refresh.assert_not_awaited()
-    assert any('did not autorefresh cache' in call.args[0] for call in mock_log.call_args_list)
+
+
+def test_get_nowcast_loads_snapshot_from_file_cache(client, monkeypatch):
+    nowcast = {'oa003': 0.1}
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = CacheEntry(data=nowcast, written_at=datetime.now(), is_stale=False)
+    monkeypatch.setattr('engine.main.NOWCAST_CACHE', mock_cache)
+    mock_refresh = AsyncMock()
+    monkeypatch.setattr('engine.main.refresh_cached_nowcast', mock_refresh)
+
+    assert client.get('/nowcast').json() == nowcast
+    assert client.get('/nowcast').json() == nowcast
+
+    # the second request is served from memory
+    mock_cache.read_entry.assert_called_once()
+    mock_refresh.assert_not_awaited()
+
+
+def test_get_nowcast_refreshes_expired_snapshot(client, monkeypatch):
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', True)
+    monkeypatch.setattr('engine.main.poll_all_sensors', AsyncMock())
+    monkeypatch.setattr('engine.main.generate_nowcast', lambda _: {'oa001': 0.5}, raising=False)
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = None
+    monkeypatch.setattr('engine.main.NOWCAST_CACHE', mock_cache)
+    publish_nowcast_snapshot({'oa001': 0.1}, datetime(2024, 4, 30, 10, 0))
+
+    assert client.get('/nowcast').json() == {'oa001': 0.5}
+    mock_cache.write.assert_called_once_with({'oa001': 0.5})
 
 
 @pytest.mark.asyncio
-async def test_autorefresh_handles_errors(monkeypatch):
-    fake_now = datetime(2024, 4, 30, 10, 0)  # In bounds
+async def test_concurrent_nowcast_requests_share_one_refresh(monkeypatch):
+    n_requests = 10
+    nowcast = {'oa001': 0.5}
+
+    async def slow_poll():
+        await asyncio.sleep(0.05)
+        return []
 
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_HOUR', 9)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_LAST_HOUR', 17)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_FIRST_WEEKDAY', 0)
-    monkeypatch.setattr('engine.main.config.NOWCAST_CACHE_AUTO_REFRESH_LAST_WEEKDAY', 4)
+    mock_poll = AsyncMock(side_effect=slow_poll)
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', True)
+    monkeypatch.setattr('engine.main.poll_all_sensors', mock_poll)
+    monkeypatch.setattr('engine.main.generate_nowcast', lambda _: nowcast, raising=False)
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = None
+    monkeypatch.setattr('engine.main.NOWCAST_CACHE', mock_cache)
 
-    async def raise_error():
-        raise RuntimeError('oh no!')
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as async_client:
+        responses = await asyncio.gather(*[async_client.get('/nowcast') for _ in range(n_requests)])
 
-    monkeypatch.setattr('engine.main.refresh_cached_nowcast', raise_error)
+    assert all(r.json() == nowcast for r in responses)
+    mock_poll.assert_awaited_once()
+    mock_cache.write.assert_called_once_with(nowcast)
 
-    mock_alert = patch('engine.main.alert_via_email').start()
-    mock_log = patch('engine.main.log.error').start()
 
-    await nowcast_cache_autorefresh_iteration(fake_now)
+@pytest.mark.asyncio
+async def test_stale_nowcast_is_served_while_refreshing_in_background(monkeypatch):
+    stale_nowcast = {'oa001': 0.1}
+    fresh_nowcast = {'oa001': 0.5}
+    refresh_may_finish = asyncio.Event()
 
-    mock_alert.assert_called_once()
-    mock_log.assert_called()
-    assert 'oh no!' in mock_alert.call_args[0][0]
+    async def slow_poll():
+        await refresh_may_finish.wait()
+        return []
 
-    patch.stopall()
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', True)
+    monkeypatch.setattr('engine.main.poll_all_sensors', slow_poll)
+    monkeypatch.setattr('engine.main.generate_nowcast', lambda _: fresh_nowcast, raising=False)
+    monkeypatch.setattr('engine.main.NOWCAST_CACHE', MagicMock())
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    stale_age = timedelta(hours=2)
+    publish_nowcast_snapshot(stale_nowcast, datetime.now() - stale_age)
 
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as async_client:
+        stale_response = await async_client.get('/nowcast')
+        assert stale_response.json() == stale_nowcast
+        assert stale_response.headers['x-nowcast-stale'] == 'true'
+        assert int(stale_response.headers['x-nowcast-age']) >= stale_age.total_seconds()
 
-@pytest.mark.parametrize(
-    'url',
-    [
-        'https://edicrowds-frontend-abc123-tristan-goss-projects.vercel.app',
-        'https://edicrowds-frontend-preview-7fa9c7-tristan-goss-projects.vercel.app',
-        'https://edicrowds-frontend-xyz-123-tristan-goss-projects.vercel.app',
-    ],
-)
-def test_valid_vercel_preview_urls(url):
-    assert is_vercel_preview_deployment(url) is True
-
-
-@pytest.mark.parametrize(
-    'url',
-    [
-        'http://edicrowds-frontend-abc123-tristan-goss-projects.vercel.app',  # wrong scheme
-        'https://edicrowds-frontend--tristan-goss-projects.vercel.app',  # empty slug
-        'https://otherdomain.com',  # totally different
-        'https://edicrowds-frontend-abc123-tristan.vercel.app',  # wrong subdomain
-        'https://vercel.app',  # bare domain
-    ],
-)
-def test_invalid_vercel_preview_urls(url):
-    assert is_vercel_preview_deployment(url) is False
+        # a second request while the refresh is running doesn't start another one
+        assert (await async_client.get('/nowcast')).json() == stale_nowcast
+        assert NOWCAST_REFRESHES.in_flight('nowcast')
+
+        refresh_may_finish.set()
+        while NOWCAST_REFRESHES.in_flight('nowcast'):
+            await asyncio.sleep(0.01)
+
+        fresh_response = await async_client.get('/nowcast')
+        assert fresh_response.json() == fresh_nowcast
+        assert fresh_response.headers['x-nowcast-stale'] == 'false'
+
+
+@pytest.mark.parametrize('dtype, item_size', [('float32', 4), ('uint16', 2)])
+def test_get_nowcast_binary(client, dtype, item_size):
+    nowcast = {'141200': 0.3, '141177': 0.7}
+    snapshot = publish_nowcast_snapshot(nowcast, datetime.now())
+
+    response = client.get('/nowcast.bin', params={'dtype': dtype})
+
+    assert response.is_success
+    assert response.headers['content-type'] == 'application/octet-stream'
+    assert response.headers['x-nowcast-index'] == snapshot.index.id
+    assert response.headers['x-nowcast-dtype'] == dtype
+    assert len(response.content) == len(nowcast) * item_size
+    assert ('x-nowcast-scale' in response.headers) == (dtype == 'uint16')
+    assert ('x-nowcast-missing' in response.headers) == (dtype == 'uint16')
+
+
+def test_get_nowcast_binary_rejects_unknown_dtype(client):
+    publish_nowcast_snapshot({'141177': 0.7}, datetime.now())
+    assert client.get('/nowcast.bin', params={'dtype': 'float64'}).is_client_error
+
+
+def test_get_nowcast_index_revalidates_with_etag(client):
+    snapshot = publish_nowcast_snapshot({'141200': 0.3, '141177': 0.7}, datetime.now())
+
+    response = client.get('/nowcast/index')
+    assert response.json() == {'id': snapshot.index.id, 'codes': ['141177', '141200']}
+
+    revalidated = client.get('/nowcast/index', headers={'If-None-Match': response.headers['etag']})
+    assert revalidated.status_code == HTTPStatus.NOT_MODIFIED
+    assert revalidated.content == b''
+
+
+def test_get_nowcast_delta(client, monkeypatch):
+    monkeypatch.setattr('engine.main.config.NOWCAST_DELTA_EPSILON', 0.01)
+    old = publish_nowcast_snapshot({'141177': 0.5, '141194': 0.5, '141200': 0.5}, datetime.now())
+    new = publish_nowcast_snapshot({'141177': 0.9, '141194': 0.505}, datetime.now())
+
+    response = client.get('/nowcast/delta', params={'since': old.version})
+
+    assert response.headers['x-nowcast-version'] == new.version
+    assert response.json() == {
+        'version': new.version,
+        'since': old.version,
+        'full': False,
+        'removed': ['141200'],
+        'changes': {'141177': 0.9},
+    }
+
+
+def test_get_nowcast_delta_from_unknown_version_is_full(client):
+    new = publish_nowcast_snapshot({'141177': 0.9}, datetime.now())
+
+    delta = client.get('/nowcast/delta', params={'since': 'ancient'}).json()
+
+    assert delta['full']
+    assert delta['version'] == new.version
+    assert delta['changes'] == {'141177': 0.9}
+
+
+@pytest.mark.asyncio
+async def test_nowcast_event_stream_announces_new_versions(monkeypatch):
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    events = Broadcaster()
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', events)
+    monkeypatch.setattr('engine.main.config.NOWCAST_EVENTS_HEARTBEAT_S', 0.01)
+    first = publish_nowcast_snapshot({'141177': 0.5}, datetime.now())
+
+    stream = nowcast_event_stream()
+    # a new subscriber is told the current version straight away
+    assert f'id: {first.version}'.encode() in await stream.__anext__()
+    assert events.subscribers == 1
+
+    # then heartbeats while nothing changes
+    assert await stream.__anext__() == b': heartbeat\n\n'
+
+    # republishing the same nowcast isn't a new version, so isn't announced
+    publish_nowcast_snapshot({'141177': 0.5}, datetime.now())
+    assert await stream.__anext__() == b': heartbeat\n\n'
+
+    second = publish_nowcast_snapshot({'141177': 0.6}, datetime.now())
+    event = await stream.__anext__()
+    assert event.startswith(b'event: nowcast\n')
+    assert json.loads(event.split(b'data: ')[1]) == {
+        'version': second.version,
+        'created_at': second.created_at.isoformat(),
+    }
+
+    await stream.aclose()
+    assert events.subscribers == 0
+
+
+@pytest.fixture
+def spatial_index(monkeypatch):
+    index = OASpatialIndex(['141177', '141194'], [shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1)])
+    monkeypatch.setattr('engine.main.OA_SPATIAL_INDEX', index)
+    return index
+
+
+def test_get_nowcast_in_bbox(client, spatial_index):
+    nowcast = {'141177': 0.5, '141194': 0.25, 'timestampISO': '2025-03-19T13:30:00'}
+    snapshot = publish_nowcast_snapshot(nowcast, datetime.now())
+
+    response = client.get('/nowcast', params={'bbox': '0.1,0.1,0.9,0.9'})
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['x-nowcast-version'] == snapshot.version
+    assert response.json() == {'141177': 0.5, 'timestampISO': '2025-03-19T13:30:00'}
+
+
+@pytest.mark.parametrize('bbox', ['1,2,3', '0,0,1,nope', '1,0,0,1'])
+def test_get_nowcast_with_bad_bbox(client, spatial_index, bbox):
+    publish_nowcast_snapshot({'141177': 0.5}, datetime.now())
+    assert client.get('/nowcast', params={'bbox': bbox}).status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_spatial_queries_without_index(client, monkeypatch):
+    monkeypatch.setattr('engine.main.OA_SPATIAL_INDEX', None)
+    publish_nowcast_snapshot({'141177': 0.5}, datetime.now())
+
+    assert client.get('/nowcast', params={'bbox': '0,0,1,1'}).status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert client.get('/nowcast/at', params={'lat': 0.5, 'lon': 0.5}).status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+
+def test_get_nowcast_at(client, spatial_index):
+    publish_nowcast_snapshot({'141177': 0.5, '141194': 0.25}, datetime.now())
+
+    response = client.get('/nowcast/at', params={'lat': 0.5, 'lon': 1.5})
+
+    assert response.json() == {'code': '141194', 'density': 0.25, 'centroid': [1.5, 0.5]}
+    assert client.get('/nowcast/at', params={'lat': 5, 'lon': 5}).status_code == HTTPStatus.NOT_FOUND
+
+
+def test_get_nowcast_history(client, history):
+    start = datetime(2025, 3, 19, 9, 0)
+    for hour, density in enumerate([0.1, 0.2, 0.3]):
+        history.append({'141177': density, '141194': 0.5}, start + timedelta(hours=hour))
+
+    response = client.get(
+        '/nowcast/history',
+        params={'oa': '141177', 'from': start.isoformat(), 'to': (start + timedelta(hours=1)).isoformat()},
+    )
+
+    assert response.json() == {
+        'oa': '141177',
+        'timestamps': [start.isoformat(), (start + timedelta(hours=1)).isoformat()],
+        'densities': [0.1, 0.2],
+    }
+    assert client.get('/nowcast/history', params={'oa': 'nope'}).status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.fixture
+def density_tiles(monkeypatch, spatial_index):
+    tiles = DensityTiles(spatial_index, min_zoom=0, max_zoom=2)
+    monkeypatch.setattr('engine.main.DENSITY_TILES', tiles)
+    # there's no event loop to pre-render in here, so tiles are rendered on demand
+    monkeypatch.setattr('engine.main.TILE_RENDERS', MagicMock())
+    return tiles
+
+
+def test_get_density_tile(client, density_tiles):
+    snapshot = publish_nowcast_snapshot({'141177': 0.5, '141194': 0.25}, datetime.now())
+
+    response = client.get('/tiles/0/0/0.pbf')
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['content-type'] == 'application/vnd.mapbox-vector-tile'
+    assert response.headers['etag'] == f'"{snapshot.version}"'
+    assert len(mapbox_vector_tile.decode(response.content)['density']['features']) == len(density_tiles.feature_ids)
+
+    revalidated = client.get('/tiles/0/0/0.pbf', headers={'If-None-Match': response.headers['etag']})
+    assert revalidated.status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_get_density_tile_outside_the_oas_or_zooms(client, density_tiles):
+    publish_nowcast_snapshot({'141177': 0.5}, datetime.now())
+
+    # the test OAs are just north east of (0, 0)
+    assert client.get('/tiles/2/0/0.pbf').status_code == HTTPStatus.NO_CONTENT
+    assert client.get('/tiles/3/4/3.pbf').status_code == HTTPStatus.NOT_FOUND
+    assert client.get('/tiles/1/2/0.pbf').status_code == HTTPStatus.NOT_FOUND
+
+
+def test_get_density_tile_without_geometries(client, monkeypatch):
+    monkeypatch.setattr('engine.main.DENSITY_TILES', None)
+    assert client.get('/tiles/0/0/0.pbf').status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+
+@pytest.mark.asyncio
+async def test_new_versions_are_prerendered(monkeypatch, spatial_index):
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', Broadcaster())
+    tiles = DensityTiles(spatial_index, min_zoom=0, max_zoom=2)
+    monkeypatch.setattr('engine.main.DENSITY_TILES', tiles)
+
+    snapshot = publish_nowcast_snapshot({'141177': 0.5}, datetime.now())
+    await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()})
+
+    assert tiles.rendered_version == snapshot.version
+
+
+@pytest.mark.asyncio
+async def test_followers_serve_the_refreshers_tiles(monkeypatch, spatial_index, shared_snapshot):
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', Broadcaster())
+    refresher_tiles = DensityTiles(spatial_index, min_zoom=0, max_zoom=2)
+    monkeypatch.setattr('engine.main.DENSITY_TILES', refresher_tiles)
+    snapshot = publish_nowcast_snapshot({'141177': 0.5}, datetime.now())
+    await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()})
+
+    follower_tiles = DensityTiles(spatial_index, min_zoom=0, max_zoom=2)
+    monkeypatch.setattr('engine.main.DENSITY_TILES', follower_tiles)
+    monkeypatch.setattr('engine.main.IS_FOLLOWER', True)
+    monkeypatch.setattr('engine.main.SHARED_TILES', SharedTilesFile(engine.main.SHARED_TILES.path))
+    follower_tiles.render = MagicMock(side_effect=AssertionError('followers should not render tiles'))
+    publish_nowcast_snapshot({'141177': 0.5}, snapshot.created_at)
+    await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()})
+    load_shared_tiles()
+
+    assert follower_tiles.rendered_version == snapshot.version
+    assert follower_tiles.get(0, 0, 0, snapshot) == refresher_tiles.get(0, 0, 0, snapshot)
+
+
+def test_get_metrics(client):
+    client.get('/nowcast/history', params={'oa': 'nope'})
+
+    response = client.get('/metrics')
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert '# TYPE edicrowds_http_request_duration_seconds histogram' in response.text
+    assert 'route="/nowcast/history",status="404"' in response.text
+
+
+@pytest.mark.asyncio
+async def test_refresher_shares_new_nowcasts(monkeypatch, tmp_path, shared_snapshot):
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', False)
+    monkeypatch.setattr('engine.main.NOWCAST_CACHE', MagicMock())
+
+    nowcast = await refresh_cached_nowcast()
+
+    shared = SharedSnapshotFile(shared_snapshot.path).read_if_changed(None)
+    assert dict(shared.nowcast) == nowcast
+
+
+@pytest.mark.asyncio
+async def test_follower_waits_for_the_refresher(monkeypatch, tmp_path, shared_snapshot):
+    versions = NowcastVersions(max_versions=3)
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', versions)
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', Broadcaster())
+    monkeypatch.setattr('engine.main.IS_FOLLOWER', True)
+    generate = AsyncMock()
+    monkeypatch.setattr('engine.main._generate_and_cache_nowcast', generate)
+    refresher = SharedSnapshotFile(shared_snapshot.path)
+    refresher.refresh_requested()
+
+    waiting = asyncio.create_task(refresh_cached_nowcast())
+    await asyncio.sleep(0.01)
+    assert refresher.refresh_requested()
+
+    nowcast = {'141177': 0.5}
+    refresher.write(NowcastSnapshot.from_nowcast(nowcast, datetime.now()))
+    load_shared_snapshot()
+
+    assert await waiting == nowcast
+    generate.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_follower_keeps_up_with_regenerated_nowcasts(monkeypatch, shared_snapshot):
+    versions = NowcastVersions(max_versions=3)
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', versions)
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', Broadcaster())
+    nowcast = {'141177': 0.5}
+    refresher = SharedSnapshotFile(shared_snapshot.path)
+    refresher.write(NowcastSnapshot.from_nowcast(nowcast, datetime(2025, 3, 19, 9)))
+    load_shared_snapshot()
+
+    # the same nowcast generated again an hour later, e.g. the mock nowcast
+    monkeypatch.setattr('engine.main.IS_FOLLOWER', True)
+    waiting = asyncio.create_task(refresh_cached_nowcast())
+    await asyncio.sleep(0.01)
+    regenerated = NowcastSnapshot.from_nowcast(nowcast, datetime(2025, 3, 19, 10))
+    refresher.write(regenerated)
+    load_shared_snapshot()
+
+    assert await waiting == nowcast
+    assert versions.latest.version == regenerated.version
+    assert versions.latest.created_at == regenerated.created_at
+
+
+@pytest.mark.asyncio
+async def test_coordinate_workers_elects_one_refresher(monkeypatch, tmp_path):
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', Broadcaster())
+    monkeypatch.setattr('engine.main.config.WORKER_POLL_INTERVAL_S', 0.01)
+    scheduler_started = asyncio.Event()
+
+    async def run_scheduler():
+        scheduler_started.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr('engine.main.build_refresh_scheduler', lambda: MagicMock(run=run_scheduler))
+    other_worker = LeaderLock(tmp_path / 'refresher.lock')
+    assert other_worker.try_acquire()
+
+    coordinator = asyncio.create_task(coordinate_workers())
+    await asyncio.sleep(0.05)
+    assert engine.main.IS_FOLLOWER
+    assert not scheduler_started.is_set()
+
+    # the other worker dies, so this one takes over
+    other_worker.release()
+    await asyncio.wait_for(scheduler_started.wait(), 1)
+    assert not engine.main.IS_FOLLOWER
+
+    coordinator.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await coordinator
+    assert other_worker.try_acquire()
+
+
+def test_importing_main_leaves_heavy_dependencies_unloaded():
+    heavy = ['geopandas', 'pandas', 'cv2', 'bs4', 'playwright', 'shapely']
+    code = f'import sys, engine.main; print([m for m in {heavy!r} if m in sys.modules])'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
+
+
+@pytest.mark.asyncio
+async def test_poll_all_sensors_imports_scrapers_when_called(monkeypatch):
+    fake_sensor_data = MagicMock()
+    monkeypatch.setattr('engine.sensors.poll_all_sensors', AsyncMock(return_value=fake_sensor_data))
+    assert await poll_all_sensors() is fake_sensor_data
+
+
+def test_warm_nowcast_snapshot_from_file_cache(monkeypatch):
+    versions = NowcastVersions(max_versions=3)
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', versions)
+    monkeypatch.setattr('engine.main.NOWCAST_EVENTS', Broadcaster())
+    nowcast = {'141177': 0.5}
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = CacheEntry(data=nowcast, written_at=datetime.now(), is_stale=False)
+    monkeypatch.setattr('engine.main.NOWCAST_CACHE', mock_cache)
+
+    warm_nowcast_snapshot()
+
+    assert dict(versions.latest.nowcast) == nowcast
+
+
+@pytest.mark.asyncio
+async def test_load_oa_geometries(monkeypatch, tmp_path):
+    oas = gpd.GeoDataFrame(
+        {'code_uint': [141177], 'is_residential': [False], 'wkb_geometry': [shapely.box(0, 0, 1, 1)]},
+        geometry='wkb_geometry',
+        crs='EPSG:4326',
+    )
+    oas.to_file(tmp_path / 'oas.gpkg', layer='edinburgh_oas')
+    monkeypatch.setattr('engine.main.config.OA_GEOMETRY_SOURCE', str(tmp_path / 'oas.gpkg'))
+    monkeypatch.setattr('engine.main.OA_SPATIAL_INDEX', None)
+    monkeypatch.setattr('engine.main.DENSITY_TILES', None)
+    monkeypatch.setattr('engine.main.NOWCAST_VERSIONS', NowcastVersions(max_versions=3))
+
+    await load_oa_geometries()
+
+    assert engine.main.OA_SPATIAL_INDEX.oa_at(lat=0.5, lon=0.5)[0] == '141177'
+    assert engine.main.DENSITY_TILES is not None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('source', ['missing.gpkg', None])
+async def test_failing_to_load_oa_geometries_disables_spatial_queries(monkeypatch, tmp_path, source):
+    monkeypatch.setattr('engine.main.config.OA_GEOMETRY_SOURCE', source and str(tmp_path / source))
+    monkeypatch.setattr('engine.main.OA_SPATIAL_INDEX', None)
+    monkeypatch.setattr('engine.main.DENSITY_TILES', None)
+
+    await load_oa_geometries()
+
+    assert engine.main.OA_SPATIAL_INDEX is None
+    assert engine.main.DENSITY_TILES is None
+
+
+def test_get_refresh_schedule(client, monkeypatch, tmp_path):
+    assert client.get('/refresh/schedule').status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+    monkeypatch.setattr('engine.main.TRADE_SECRETS_AVAILABLE', False)
+    build_refresh_scheduler().write_status()
+    response = client.get('/refresh/schedule')
+
+    assert response.status_code == HTTPStatus.OK
+    assert [source['name'] for source in response.json()['sources']] == ['nowcast']
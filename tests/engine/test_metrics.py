@@ -0,0 +1,145 @@
+import time
+from http import HTTPStatus
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from engine.metrics import Histogram, MetricsMiddleware, Registry
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter(registry):
+    reads = registry.counter('reads_total', 'Reads.', ('cache', 'result'))
+    reads.labels('nowcast', 'hit').inc()
+    reads.labels('nowcast', 'hit').inc()
+    reads.labels('nowcast', 'miss').inc()
+
+    assert registry.render() == (
+        '# HELP reads_total Reads.\n'
+        '# TYPE reads_total counter\n'
+        'reads_total{cache="nowcast",result="hit"} 2\n'
+        'reads_total{cache="nowcast",result="miss"} 1\n'
+    )
+
+
+def test_labels_are_reused(registry):
+    reads = registry.counter('reads_total', 'Reads.', ('cache',))
+    assert reads.labels('nowcast') is reads.labels('nowcast')
+    with pytest.raises(AssertionError):
+        reads.labels('nowcast', 'extra')
+
+
+def test_histogram(registry):
+    latency = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        latency.observe(value)
+
+    assert registry.render() == (
+        '# HELP latency_seconds Latency.\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{le="0.1"} 2\n'
+        'latency_seconds_bucket{le="1"} 3\n'
+        'latency_seconds_bucket{le="+Inf"} 4\n'
+        'latency_seconds_sum 2.65\n'
+        'latency_seconds_count 4\n'
+    )
+
+
+def test_other_workers_dumps_are_summed(registry):
+    other = Registry()
+    for r in (registry, other):
+        r.counter('reads_total', 'Reads.', ('cache',))
+        r.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+    reads, latency = registry.metrics
+    other_reads, other_latency = other.metrics
+    reads.labels('nowcast').inc()
+    other_reads.labels('nowcast').inc(2)
+    other_reads.labels('ee').inc()
+    latency.observe(0.05)
+    other_latency.observe(0.5)
+
+    assert registry.render([other.dump()]) == (
+        '# HELP reads_total Reads.\n'
+        '# TYPE reads_total counter\n'
+        'reads_total{cache="nowcast"} 3\n'
+        'reads_total{cache="ee"} 1\n'
+        '# HELP latency_seconds Latency.\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{le="0.1"} 1\n'
+        'latency_seconds_bucket{le="1"} 2\n'
+        'latency_seconds_bucket{le="+Inf"} 2\n'
+        'latency_seconds_sum 0.55\n'
+        'latency_seconds_count 2\n'
+    )
+    # the other worker's values are only summed in when rendering
+    assert reads.labels('nowcast').value == 1
+
+
+def test_histogram_timer():
+    histogram = Histogram('cpu_seconds', 'CPU.')
+    start, end = 1.0, 1.5
+    clock = iter([start, end])
+
+    with histogram.time(lambda: next(clock)):
+        pass
+
+    assert histogram.labels().sum == end - start
+
+
+def test_histogram_timer_as_decorator():
+    histogram = Histogram('work_seconds', 'Work.')
+
+    @histogram.time(time.thread_time)
+    def work():
+        return 'done'
+
+    assert work() == 'done'
+    assert work() == 'done'
+    assert sum(histogram.labels().counts) == 1 + 1
+
+
+def test_duplicate_names_are_refused(registry):
+    registry.counter('things_total', 'Things.')
+    with pytest.raises(AssertionError):
+        registry.counter('things_total', 'Things again.')
+
+
+def test_middleware_labels_requests_by_route(monkeypatch):
+    latency = Histogram('latency_seconds', 'Latency.', ('method', 'route', 'status'))
+    monkeypatch.setattr('engine.metrics.HTTP_REQUEST_DURATION', latency)
+    app = FastAPI()
+
+    @app.get('/tiles/{z}')
+    async def get_tile(z: int) -> dict:
+        return {'z': z}
+
+    app.add_middleware(MetricsMiddleware)
+    client = TestClient(app)
+
+    client.get('/tiles/1')
+    client.get('/tiles/2')
+    assert client.get('/nope').status_code == HTTPStatus.NOT_FOUND
+
+    assert sum(latency.labels('GET', '/tiles/{z}', '200').counts) == 1 + 1
+    assert sum(latency.labels('GET', 'unmatched', '404').counts) == 1
+
+
+def test_middleware_lumps_unknown_methods_together(monkeypatch):
+    latency = Histogram('latency_seconds', 'Latency.', ('method', 'route', 'status'))
+    monkeypatch.setattr('engine.metrics.HTTP_REQUEST_DURATION', latency)
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+    client = TestClient(app)
+
+    unknown_methods = [f'X{i}' for i in range(5)]
+    for method in unknown_methods:
+        client.request(method, '/')
+    client.request('GET', '/')
+
+    assert {label_values[0] for label_values in latency._children} == {'other', 'GET'}
+    assert sum(latency.labels('other', 'unmatched', '404').counts) == len(unknown_methods)
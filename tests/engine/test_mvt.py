@@ -0,0 +1,57 @@
+import mapbox_vector_tile
+import pytest
+import shapely
+
+from engine import mvt
+
+EXTENT = 4096
+
+
+@pytest.mark.parametrize('value, expected', [(0, b'\x00'), (1, b'\x01'), (300, b'\xac\x02')])
+def test_varint(value, expected):
+    assert mvt.varint(value) == expected
+
+
+@pytest.mark.parametrize('value, expected', [(0, 0), (-1, 1), (1, 2), (-2, 3), (2, 4)])
+def test_zigzag(value, expected):
+    assert mvt.zigzag(value) == expected
+
+
+def test_polygon_commands_match_spec_example():
+    # from section 4.3.5.3 of the MVT 2.1 spec
+    assert mvt.polygon_commands(shapely.Polygon([(3, 6), (8, 12), (20, 34)])) == [9, 6, 12, 18, 10, 12, 24, 44, 15]
+
+
+def test_polygon_commands_wind_rings_as_spec_requires():
+    # given with the exterior wound the wrong way
+    square = shapely.Polygon([(0, 0), (0, 10), (10, 10), (10, 0)], [[(2, 2), (4, 2), (4, 4), (2, 4)]])
+
+    layer = mvt.layer('test', [mvt.feature(mvt.polygon_feature_geometry(1, square), [])], [], [], EXTENT)
+    decoded = mapbox_vector_tile.decode(layer, default_options={'y_coord_down': True})
+
+    polygon = shapely.geometry.shape(decoded['test']['features'][0]['geometry'])
+    assert polygon.equals(square)
+    assert len(polygon.interiors) == 1
+
+
+def test_collapsed_geometry_is_dropped():
+    assert mvt.polygon_feature_geometry(1, shapely.box(0.1, 0.1, 0.2, 0.2)) == b''
+
+
+def test_layer_roundtrip():
+    geometry_fields = mvt.polygon_feature_geometry(141177, shapely.box(0, 0, 100, 100))
+    density = 0.5
+    layer = mvt.layer(
+        'density',
+        [mvt.feature(geometry_fields, [0, 0]), mvt.feature(geometry_fields, [])],
+        ['density'],
+        [mvt.float_value(density)],
+        EXTENT,
+    )
+
+    decoded = mapbox_vector_tile.decode(layer)['density']
+
+    assert decoded['extent'] == EXTENT
+    assert [f['id'] for f in decoded['features']] == [141177, 141177]
+    assert [f['properties'] for f in decoded['features']] == [{'density': density}, {}]
+    assert decoded['features'][0]['geometry']['type'] == 'Polygon'
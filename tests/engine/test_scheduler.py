@@ -0,0 +1,186 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from engine.metrics import AUTOREFRESHES
+from engine.scheduler import RefreshScheduler, RefreshSlots, RefreshWindow
+
+LONDON = ZoneInfo('Europe/London')
+HOUR_S = 60 * 60
+WEEK_S = 7 * 24 * HOUR_S
+WORKING_HOURS = RefreshWindow(first_hour=8, last_hour=18, first_weekday=0, last_weekday=4)
+TUESDAY_MORNING = datetime(2025, 3, 18, 10, 30, tzinfo=LONDON)
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    scheduler = RefreshScheduler(tmp_path / 'refresh_schedule.json', LONDON, max_sleep_s=0.01)
+    scheduler.started_at = TUESDAY_MORNING
+    return scheduler
+
+
+def register(scheduler, expires_at=None, refresh=None, **kwargs):
+    scheduler.register(
+        'etd',
+        refresh or AsyncMock(),
+        lambda: expires_at,
+        RefreshSlots(**{'cadence_s': HOUR_S, 'offset_s': 60, **kwargs}),
+    )
+    return scheduler.refreshes[-1]
+
+
+def test_window():
+    assert WORKING_HOURS.contains(datetime(2025, 3, 18, 18, 59))
+    assert not WORKING_HOURS.contains(datetime(2025, 3, 18, 19, 0))
+    assert not WORKING_HOURS.contains(datetime(2025, 3, 22, 12, 0))  # Saturday
+
+
+@pytest.mark.parametrize(
+    'after, expected',
+    [
+        (TUESDAY_MORNING, datetime(2025, 3, 18, 11, 1)),
+        (datetime(2025, 3, 18, 11, 1, tzinfo=LONDON), datetime(2025, 3, 18, 12, 1)),
+        (datetime(2025, 3, 18, 18, 30, tzinfo=LONDON), datetime(2025, 3, 19, 8, 1)),
+        (datetime(2025, 3, 21, 18, 30, tzinfo=LONDON), datetime(2025, 3, 24, 8, 1)),  # Friday evening
+    ],
+)
+def test_hourly_slots_are_on_the_hour_in_working_hours(scheduler, after, expected):
+    scheduled = register(scheduler, window=WORKING_HOURS)
+    assert scheduled.next_slot(after) == expected.replace(tzinfo=LONDON)
+
+
+def test_slots_stay_on_the_hour_across_daylight_saving(scheduler):
+    scheduled = register(scheduler)
+    # the clocks went forward at 01:00 on Sunday 30th March 2025, since the week started
+    slot = scheduled.next_slot(datetime(2025, 3, 30, 10, 30, tzinfo=LONDON))
+    assert slot == datetime(2025, 3, 30, 11, 1, tzinfo=LONDON)
+    assert slot.utcoffset() == timedelta(hours=1)
+
+
+def test_weekly_slots(scheduler):
+    scheduler.register('ee', AsyncMock(), lambda: None, RefreshSlots(WEEK_S, offset_s=8 * HOUR_S, window=WORKING_HOURS))
+    assert scheduler.refreshes[0].next_slot(TUESDAY_MORNING) == datetime(2025, 3, 24, 8, 0, tzinfo=LONDON)
+
+
+def test_cadence_must_divide_a_week(scheduler):
+    with pytest.raises(AssertionError):
+        register(scheduler, cadence_s=5 * HOUR_S)
+
+
+def test_jitter_is_drawn_once(scheduler):
+    scheduled = register(scheduler, jitter_s=120)
+    assert timedelta(seconds=60) <= scheduled.offset <= timedelta(seconds=180)
+    first = scheduled.next_slot(TUESDAY_MORNING)
+    assert scheduled.next_slot(first) - first == timedelta(hours=1)
+
+
+def test_empty_cache_is_refreshed_straight_away(scheduler):
+    scheduled = register(scheduler, window=WORKING_HOURS)
+    assert scheduler.next_run_at(scheduled, TUESDAY_MORNING) == TUESDAY_MORNING
+
+
+def test_empty_cache_waits_for_working_hours(scheduler):
+    scheduled = register(scheduler, window=WORKING_HOURS)
+    scheduler.started_at = datetime(2025, 3, 18, 22, 0, tzinfo=LONDON)
+    assert scheduler.next_run_at(scheduled, scheduler.started_at) == datetime(2025, 3, 19, 8, 1, tzinfo=LONDON)
+
+
+def test_cache_is_refreshed_as_it_expires_if_that_comes_before_the_next_slot(scheduler):
+    scheduled = register(scheduler, expires_at=datetime(2025, 3, 18, 10, 45, tzinfo=LONDON))
+    assert scheduler.next_run_at(scheduled, TUESDAY_MORNING) == datetime(2025, 3, 18, 10, 45, tzinfo=LONDON)
+
+
+def test_cache_expiring_after_the_next_slot_is_refreshed_at_the_slot(scheduler):
+    scheduled = register(scheduler, expires_at=datetime(2025, 3, 18, 11, 30, tzinfo=LONDON))
+    assert scheduler.next_run_at(scheduled, TUESDAY_MORNING) == datetime(2025, 3, 18, 11, 1, tzinfo=LONDON)
+
+
+def test_naive_expiry_is_local_system_time(scheduler):
+    expires_at = datetime(2025, 3, 18, 10, 45, tzinfo=LONDON)
+    scheduled = register(scheduler, expires_at=expires_at.astimezone().replace(tzinfo=None))
+    assert scheduler.next_run_at(scheduled, TUESDAY_MORNING) == expires_at
+
+
+def test_cache_not_renewed_by_the_last_refresh_waits_for_the_next_slot(scheduler):
+    scheduled = register(scheduler, expires_at=datetime(2025, 3, 18, 10, 0, tzinfo=LONDON))
+    scheduled.last_started_at = TUESDAY_MORNING
+    assert scheduler.next_run_at(scheduled, TUESDAY_MORNING) == datetime(2025, 3, 18, 11, 1, tzinfo=LONDON)
+
+
+@pytest.mark.asyncio
+async def test_run_refresh(scheduler):
+    expires_at = None
+
+    async def refresh():
+        nonlocal expires_at
+        expires_at = datetime(2025, 3, 18, 11, 30, tzinfo=LONDON)
+
+    scheduler.register('etd', refresh, lambda: expires_at, RefreshSlots(HOUR_S))
+    scheduled = scheduler.refreshes[0]
+    refreshed = AUTOREFRESHES.labels('etd', 'refreshed')
+    count = refreshed.value
+
+    await scheduler.run_refresh(scheduled, TUESDAY_MORNING)
+
+    assert scheduled.last_outcome == 'refreshed'
+    assert scheduled.last_started_at == TUESDAY_MORNING
+    assert scheduled.last_duration_s >= 0
+    assert refreshed.value == count + 1
+
+
+@pytest.mark.asyncio
+async def test_refresh_that_fails_alerts(scheduler):
+    scheduled = register(scheduler, refresh=AsyncMock(side_effect=RuntimeError('oh no!')))
+
+    with patch('engine.scheduler.ALERTS') as mock_alert:
+        await scheduler.run_refresh(scheduled, TUESDAY_MORNING)
+
+    assert scheduled.last_outcome == 'failed'
+    assert scheduled.last_error == 'oh no!'
+    assert 'oh no!' in mock_alert.alert.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_refresh_that_leaves_the_cache_as_it_was_fails(scheduler):
+    scheduled = register(scheduler, expires_at=datetime(2025, 3, 18, 10, 0, tzinfo=LONDON))
+
+    with patch('engine.scheduler.ALERTS') as mock_alert:
+        await scheduler.run_refresh(scheduled, TUESDAY_MORNING)
+
+    assert scheduled.last_outcome == 'failed'
+    mock_alert.alert.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_run_refreshes_due_sources_in_order(scheduler):
+    refreshed = []
+
+    def source(name):
+        expires_at = None
+
+        async def refresh():
+            nonlocal expires_at
+            refreshed.append(name)
+            expires_at = datetime.now() + timedelta(hours=1)
+
+        scheduler.register(name, refresh, lambda: expires_at, RefreshSlots(HOUR_S))
+
+    source('edintraveldata')
+    source('nowcast')
+    scheduler.started_at = scheduler.now()
+
+    running = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(0.05)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    assert refreshed == ['edintraveldata', 'nowcast']
+    status = json.loads(scheduler.status_path.read_text())
+    assert status['timezone'] == 'Europe/London'
+    assert [s['last_outcome'] for s in status['sources']] == ['refreshed', 'refreshed']
+    assert all(datetime.fromisoformat(s['next_run_at']) > scheduler.now() for s in status['sources'])
@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+import pytest
+
+from engine.keyed_cache import FileCacheBackend, KeyedCache
+from engine.serialization import JSON, MSGPACK, MSGPACK_ZSTD, SERIALIZERS, dumps_json
+from engine.simple_cache import MEMORY_TIER, SimpleCache
+
+NOWCAST = {'S00088956': 0.01986, 'S00088957': 0.0, 'time': '2025-03-18T10:00:00', 'sensors': [{'name': 'CEC123'}]}
+
+
+@pytest.mark.parametrize('suffix', sorted(SERIALIZERS))
+def test_round_trip(suffix):
+    serializer = SERIALIZERS[suffix]
+    assert serializer.loads(serializer.dumps(NOWCAST)) == NOWCAST
+
+
+def test_json_is_what_the_json_module_would_write():
+    assert json.loads(dumps_json(NOWCAST)) == NOWCAST
+    assert dumps_json(NOWCAST) == json.dumps(NOWCAST, separators=(',', ':')).encode('utf-8')
+
+
+def test_json_handles_numpy_values_and_keys_that_are_not_strings():
+    assert json.loads(dumps_json({1: np.float64(0.5), 'counts': np.array([1, 2])})) == {'1': 0.5, 'counts': [1, 2]}
+
+
+def test_simple_cache_names_files_by_format(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path, serializer=MSGPACK_ZSTD)
+    cache.write(NOWCAST)
+    MEMORY_TIER.invalidate(cache.key)
+
+    assert [path.name.endswith('.msgpack.zst') for path in tmp_path.iterdir()] == [True]
+    assert cache.read() == NOWCAST
+
+
+def test_simple_cache_reads_files_written_in_another_format(tmp_path):
+    SimpleCache('testcache', max_age_s=60, cache_root=tmp_path, serializer=JSON).write(NOWCAST)
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path, serializer=MSGPACK)
+    MEMORY_TIER.invalidate(cache.key)
+
+    assert cache.read() == NOWCAST
+    cache.write({'new': True})
+    MEMORY_TIER.invalidate(cache.key)
+    assert cache.read() == {'new': True}
+    assert [path.suffix for path in tmp_path.iterdir()] == ['.msgpack']
+
+
+def test_keyed_cache_reads_values_written_in_another_format(tmp_path):
+    backend = FileCacheBackend(tmp_path)
+    KeyedCache('tables', max_age_s=60, backend=backend, serializer=MSGPACK_ZSTD).put('a', NOWCAST)
+    KeyedCache('tables', max_age_s=60, backend=backend).put('b', [1, 2])
+
+    assert KeyedCache('tables', max_age_s=60, backend=backend).get_many(['a', 'b']) == {'a': NOWCAST, 'b': [1, 2]}
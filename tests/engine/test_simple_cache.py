@@ -1,9 +1,13 @@
+import json
+import multiprocessing
 import time
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 
 import pytest
 
-from engine.simple_cache import SimpleCache
+from engine.metrics import CACHE_READS
+from engine.simple_cache import MEMORY_TIER, MemoryEntry, MemoryTier, SimpleCache
 
 
 def test_cache_write_and_read(tmp_path):
@@ -56,7 +60,258 @@ def test_safe_timestamp_conversion_roundtrip_unix(monkeypatch):
     assert restored == dt
 
 
+def test_other_files_sharing_the_prefix_are_ignored(tmp_path):
+    cache = SimpleCache('nowcast', max_age_s=60, cache_root=tmp_path)
+    (tmp_path / 'nowcast_history.json').write_text('{}', encoding='utf-8')
+    cache.write({'foo': 'bar'})
+    cache.clear()
+
+    assert cache.read() is None
+    assert (tmp_path / 'nowcast_history.json').exists()
+
+
+def test_write_replaces_older_files_once_the_new_one_is_in_place(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=600, cache_root=tmp_path)
+    write_aged_cache_file(cache, {'old': True}, timedelta(minutes=5))
+    cache.write({'new': True})
+
+    assert [path.name for path in tmp_path.iterdir()] == [cache._files()[0][1].name]
+    MEMORY_TIER.invalidate(cache.key)
+    assert cache.read() == {'new': True}
+
+
+def test_newest_file_is_read_first(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=600, cache_root=tmp_path)
+    write_aged_cache_file(cache, {'old': True}, timedelta(minutes=5))
+    write_aged_cache_file(cache, {'new': True}, timedelta(minutes=1))
+    assert cache.read() == {'new': True}
+
+
+def test_miss_only_deletes_the_expired_files_it_found(tmp_path, monkeypatch):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path)
+    write_aged_cache_file(cache, {'old': True}, timedelta(minutes=5))
+    found = cache._files()
+    # another process writes new data just after this one looked
+    write_aged_cache_file(cache, {'new': True}, timedelta(0))
+    monkeypatch.setattr(cache, '_files', lambda: found)
+
+    assert cache.read() is None
+    assert [path.name for path in tmp_path.iterdir()] == [SimpleCache._files(cache)[0][1].name]
+
+
+def test_file_superseded_while_reading_is_looked_for_again(tmp_path, monkeypatch):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path)
+    write_aged_cache_file(cache, {'old': True}, timedelta(seconds=30))
+    found = cache._files()
+    # another process replaces it just after this one looked
+    write_aged_cache_file(cache, {'new': True}, timedelta(0))
+    found[0][1].unlink()
+    listings = iter([found, SimpleCache._files(cache)])
+    monkeypatch.setattr(cache, '_files', lambda: next(listings))
+
+    assert cache.read() == {'new': True}
+
+
+def test_failed_write_leaves_the_previous_data(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path)
+    cache.write({'foo': 'bar'})
+
+    with pytest.raises(TypeError):
+        cache.write({'foo': object()})
+
+    assert cache.read() == {'foo': 'bar'}
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+STRESS_GENERATIONS = 200
+STRESS_READERS = 3
+STRESS_PAYLOAD_LENGTH = 20_000
+STRESS_TIMEOUT_S = 60
+
+
+def write_generations(cache_root) -> None:
+    cache = SimpleCache('stress', max_age_s=60, cache_root=cache_root)
+    for generation in range(STRESS_GENERATIONS):
+        cache.write({'generation': generation, 'values': [generation] * STRESS_PAYLOAD_LENGTH})
+
+
+def read_until_last_generation(cache_root) -> dict:
+    cache = SimpleCache('stress', max_age_s=60, cache_root=cache_root)
+    outcomes = {'reads': 0, 'empty': 0, 'incomplete': 0}
+    seen_data = False
+    deadline = time.monotonic() + STRESS_TIMEOUT_S
+    while time.monotonic() < deadline:
+        MEMORY_TIER.invalidate(cache.key)  # always go to the files
+        data = cache.read()
+        if data is None:
+            outcomes['empty'] += seen_data
+            continue
+        seen_data = True
+        outcomes['reads'] += 1
+        if data['values'] != [data['generation']] * STRESS_PAYLOAD_LENGTH:
+            outcomes['incomplete'] += 1
+        if data['generation'] == STRESS_GENERATIONS - 1:
+            break
+    return outcomes
+
+
+def test_concurrent_readers_always_find_complete_data(tmp_path):
+    with ProcessPoolExecutor(STRESS_READERS + 1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        readers = [pool.submit(read_until_last_generation, tmp_path) for _ in range(STRESS_READERS)]
+        pool.submit(write_generations, tmp_path).result()
+        outcomes = [reader.result() for reader in readers]
+
+    # a corrupt file would have raised a JSONDecodeError in the reader
+    assert all(outcome['reads'] > 0 for outcome in outcomes)
+    assert sum(outcome['empty'] for outcome in outcomes) == 0
+    assert sum(outcome['incomplete'] for outcome in outcomes) == 0
+    assert len(list(tmp_path.iterdir())) == 1
+
+
 def test_invalid_timestamp_fails_cleanly():
     # Confirm ValueError bubbles up from datetime.fromisoformat
     with pytest.raises(ValueError):
         SimpleCache.from_os_safe_iso_timestamp('not-a-date')
+
+
+def write_aged_cache_file(cache: SimpleCache, payload, age: timedelta) -> None:
+    timestamp = SimpleCache.to_os_safe_iso_timestamp(datetime.now() - age)
+    (cache.cache_root / f'{cache.file_prefix}{timestamp}.json').write_text(json.dumps(payload), encoding='utf-8')
+
+
+def test_stale_entry_is_served_until_hard_timeout(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path, hard_max_age_s=600)
+    payload = {'foo': 'bar'}
+    cache.write(payload)
+
+    entry = cache.read_entry()
+    assert entry.data == payload
+    assert not entry.is_stale
+
+    cache.clear()
+    write_aged_cache_file(cache, payload, timedelta(minutes=5))
+    entry = cache.read_entry()
+    assert entry.data == payload
+    assert entry.is_stale
+    assert entry.age_s() > cache.max_age_s
+
+    # read() only ever returns fresh data, but leaves the stale file in place
+    assert cache.read() is None
+    assert len(list(tmp_path.glob('*.json'))) == 1
+
+
+def test_entry_is_dropped_after_hard_timeout(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=0.05, cache_root=tmp_path, hard_max_age_s=0.1)
+    cache.write({'foo': 'bar'})
+
+    time.sleep(0.2)
+    assert cache.read_entry() is None
+    assert not list(tmp_path.glob('*.json'))
+
+
+def test_hard_timeout_cannot_be_shorter_than_soft_timeout(tmp_path):
+    with pytest.raises(AssertionError):
+        SimpleCache('testcache', max_age_s=60, cache_root=tmp_path, hard_max_age_s=30)
+
+
+def test_reads_are_counted(tmp_path):
+    cache = SimpleCache('countedcache', max_age_s=60, cache_root=tmp_path, hard_max_age_s=600)
+    reads = [('hit', 'memory'), ('hit', 'file'), ('miss', 'file'), ('stale', 'file')]
+
+    def count(result, tier):
+        return CACHE_READS.labels('countedcache', result, tier).value
+
+    before = {read: count(*read) for read in reads}
+    cache.read()
+    cache.write({'foo': 'bar'})
+    cache.read()
+    MEMORY_TIER.invalidate(cache.key)
+    cache.read()
+    cache.clear()
+    write_aged_cache_file(cache, {'foo': 'bar'}, timedelta(minutes=5))
+    cache.read_entry()
+
+    assert {read: count(*read) - before[read] for read in reads} == {
+        ('hit', 'memory'): 1,
+        ('hit', 'file'): 1,
+        ('miss', 'file'): 1,
+        ('stale', 'file'): 1,
+    }
+
+
+def test_expires_at(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path)
+    assert cache.expires_at() is None
+
+    before = datetime.now().replace(microsecond=0)
+    cache.write({'foo': 'bar'})
+
+    assert before + timedelta(seconds=60) <= cache.expires_at() <= datetime.now() + timedelta(seconds=60)
+
+
+def test_current_data_is_read_from_memory(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path)
+    cache.write({'foo': 'bar'})
+    before = cache.expires_at()
+
+    # the disk isn't touched, so the data survives its file being deleted behind the cache's back
+    for path in tmp_path.glob('*.json'):
+        path.unlink()
+
+    assert cache.read() == {'foo': 'bar'}
+    assert cache.expires_at() == before
+
+
+def test_data_read_from_file_is_kept_in_memory(tmp_path):
+    writer = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path)
+    writer.write({'foo': 'bar'})
+    MEMORY_TIER.invalidate(writer.key)  # as if written by another process
+
+    reader = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path)
+    assert reader.read() == {'foo': 'bar'}
+    assert MEMORY_TIER.get(reader.key).data == {'foo': 'bar'}
+
+
+def test_stale_data_in_memory_is_checked_against_the_file(tmp_path):
+    cache = SimpleCache('testcache', max_age_s=60, cache_root=tmp_path, hard_max_age_s=600)
+    MEMORY_TIER.put(
+        cache.key, MemoryEntry({'old': True}, datetime.now().replace(microsecond=0) - timedelta(minutes=5), 1)
+    )
+    # another process has since written newer data
+    write_aged_cache_file(cache, {'new': True}, timedelta(0))
+
+    entry = cache.read_entry()
+
+    assert entry.data == {'new': True}
+    assert not entry.is_stale
+
+
+def test_memory_tier_evicts_least_recently_used():
+    tier = MemoryTier(max_bytes=10)
+    written_at = datetime.now()
+    tier.put('a', MemoryEntry('a', written_at, 4))
+    tier.put('b', MemoryEntry('b', written_at, 4))
+    tier.get('a')
+    tier.put('c', MemoryEntry('c', written_at, 4))
+
+    assert tier.get('b') is None
+    assert tier.get('a').data == 'a'
+    assert tier.get('c').data == 'c'
+    assert tier.size == tier.max_bytes - 2
+
+
+def test_memory_tier_ignores_data_read_before_a_write():
+    tier = MemoryTier(max_bytes=10)
+    generation = tier.generation('a')
+    tier.invalidate('a')  # e.g. written while the file was being read
+
+    tier.put('a', MemoryEntry('a', datetime.now(), 1), generation)
+
+    assert tier.get('a') is None
+
+
+def test_memory_tier_does_not_keep_oversized_data():
+    tier = MemoryTier(max_bytes=10)
+    tier.put('a', MemoryEntry('a', datetime.now(), 11))
+    assert tier.get('a') is None
+    assert tier.size == 0
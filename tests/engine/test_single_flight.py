@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from engine.single_flight import SingleFlight
+
+N_CALLERS = 10
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_task():
+    flights = SingleFlight()
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    results = await asyncio.gather(*[flights.do('key', work) for _ in range(N_CALLERS)])
+
+    assert calls == 1
+    assert results == [1] * N_CALLERS
+    assert not flights.in_flight('key')
+
+
+@pytest.mark.asyncio
+async def test_sequential_calls_run_again():
+    flights = SingleFlight()
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        return calls
+
+    first = await flights.do('key', work)
+    second = await flights.do('key', work)
+    assert second == first + 1
+
+
+@pytest.mark.asyncio
+async def test_different_keys_run_independently():
+    flights = SingleFlight()
+    started = []
+
+    async def work(key):
+        started.append(key)
+        await asyncio.sleep(0.01)
+        return key
+
+    results = await asyncio.gather(flights.do('a', lambda: work('a')), flights.do('b', lambda: work('b')))
+
+    assert results == ['a', 'b']
+    assert sorted(started) == ['a', 'b']
+
+
+@pytest.mark.asyncio
+async def test_exceptions_are_shared_and_not_cached():
+    flights = SingleFlight()
+    calls = 0
+
+    async def fail():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise RuntimeError('oh no!')
+
+    results = await asyncio.gather(*[flights.do('key', fail) for _ in range(N_CALLERS)], return_exceptions=True)
+
+    assert calls == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+    # a failure is not remembered, the next call tries again
+    with pytest.raises(RuntimeError):
+        await flights.do('key', fail)
+    assert calls == 1 + 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_shared_task():
+    flights = SingleFlight()
+    finished = asyncio.Event()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        finished.set()
+        return 'done'
+
+    impatient = asyncio.create_task(flights.do('key', work))
+    patient = asyncio.create_task(flights.do('key', work))
+    await asyncio.sleep(0)
+    impatient.cancel()
+
+    assert await patient == 'done'
+    assert finished.is_set()
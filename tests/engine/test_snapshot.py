@@ -0,0 +1,137 @@
+import gzip
+import json
+import math
+from array import array
+from datetime import datetime, timedelta
+
+import brotli
+import numpy as np
+import pytest
+
+from engine.simple_cache import MEMORY_TIER, SimpleCache
+from engine.snapshot import UINT16_MAX, UINT16_MISSING, NowcastSnapshot, OAIndex, choose_encoding
+
+
+@pytest.mark.parametrize(
+    'header, expected',
+    [
+        (None, None),
+        ('', None),
+        ('identity', None),
+        ('gzip', 'gzip'),
+        ('gzip, deflate, br', 'br'),
+        ('br;q=0.5, gzip', 'gzip'),
+        ('br;q=0, gzip;q=0', None),
+        ('*', 'br'),
+        ('*;q=0.1, gzip;q=0.9', 'gzip'),
+        ('br;q=nonsense, gzip', 'gzip'),
+    ],
+)
+def test_choose_encoding(header, expected):
+    assert choose_encoding(header) == expected
+
+
+def test_snapshot_encodings_roundtrip():
+    nowcast = {'141177': 0.01986, '141194': 0.00539}
+    snapshot = NowcastSnapshot.from_nowcast(nowcast, datetime.now())
+
+    assert json.loads(snapshot.raw) == nowcast
+    assert json.loads(gzip.decompress(snapshot.gzip)) == nowcast
+    assert json.loads(brotli.decompress(snapshot.brotli)) == nowcast
+
+    assert snapshot.encoded('gzip, br') == (snapshot.brotli, 'br')
+    assert snapshot.encoded('gzip') == (snapshot.gzip, 'gzip')
+    assert snapshot.encoded(None) == (snapshot.raw, None)
+
+
+def test_snapshot_is_immutable():
+    original_value = 0.01986
+    nowcast = {'141177': original_value}
+    snapshot = NowcastSnapshot.from_nowcast(nowcast, datetime.now())
+
+    # mutating the source dict must not affect the snapshot
+    nowcast['141177'] = 1.0
+    assert snapshot.nowcast['141177'] == original_value
+
+    with pytest.raises(TypeError):
+        snapshot.nowcast['141177'] = 1.0
+
+
+def test_snapshot_age():
+    created_at = datetime(2024, 4, 30, 10, 0)
+    age = timedelta(minutes=5)
+    snapshot = NowcastSnapshot.from_nowcast({}, created_at)
+    assert snapshot.age_s(created_at + age) == age.total_seconds()
+
+
+def test_oa_index_is_in_code_uint_order():
+    index = OAIndex.from_codes(['141200', '99', '141177', '1000'])
+
+    assert index.codes == ('99', '1000', '141177', '141200')
+    assert json.loads(index.json) == {'id': index.id, 'codes': list(index.codes)}
+
+
+def test_oa_index_id_only_depends_on_the_set_of_codes():
+    assert OAIndex.from_codes(['2', '1']).id == OAIndex.from_codes(['1', '2']).id
+    assert OAIndex.from_codes(['1', '2']).id != OAIndex.from_codes(['1', '3']).id
+
+
+def test_snapshot_binary_encodings():
+    nowcast = {'141200': 0.00627, '141177': 0.01986, '141194': 0.0}
+    snapshot = NowcastSnapshot.from_nowcast(nowcast, datetime.now())
+    expected = [nowcast[code] for code in snapshot.index.codes]
+
+    float32_values = array('f')
+    float32_values.frombytes(snapshot.float32)
+    np.testing.assert_allclose(float32_values, expected, rtol=1e-6)
+
+    uint16_values = array('H')
+    uint16_values.frombytes(snapshot.uint16)
+    assert max(uint16_values) == UINT16_MAX - 1
+    np.testing.assert_allclose(
+        [v * snapshot.uint16_scale for v in uint16_values], expected, atol=snapshot.uint16_scale / 2
+    )
+
+
+def test_snapshot_binary_encodings_of_missing_densities():
+    nowcast = {'141200': 0.00627, '141177': float('nan'), '141194': 0.01986}
+    snapshot = NowcastSnapshot.from_nowcast(nowcast, datetime.now())
+
+    float32_values = array('f')
+    float32_values.frombytes(snapshot.float32)
+    assert math.isnan(float32_values[snapshot.index.codes.index('141177')])
+
+    uint16_values = array('H')
+    uint16_values.frombytes(snapshot.uint16)
+    assert uint16_values[snapshot.index.codes.index('141177')] == UINT16_MISSING
+    assert uint16_values[snapshot.index.codes.index('141194')] == UINT16_MAX - 1
+
+
+def test_missing_densities_survive_the_nowcast_cache(tmp_path):
+    nowcast = {'1': 0.5, '2': float('nan'), '3': 0.7}
+    snapshot = NowcastSnapshot.from_nowcast(nowcast, datetime.now())
+    cache = SimpleCache('nowcast', 60, cache_root=tmp_path)
+    cache.write(nowcast)
+    # as after a restart, so the nowcast is read from disk
+    MEMORY_TIER.invalidate(cache.key)
+
+    reloaded = NowcastSnapshot.from_nowcast(cache.read(), snapshot.created_at)
+
+    assert reloaded.index == snapshot.index
+    assert reloaded.version == snapshot.version
+    assert (reloaded.float32, reloaded.uint16) == (snapshot.float32, snapshot.uint16)
+
+
+def test_snapshot_binary_encodings_of_empty_nowcast():
+    snapshot = NowcastSnapshot.from_nowcast({}, datetime.now())
+    assert snapshot.float32 == b''
+    assert snapshot.uint16 == b''
+
+
+def test_snapshot_index_ignores_metadata():
+    nowcast = {'141177': 0.01986, 'timestampISO': '2025-03-19T13:30:00.000000256'}
+    snapshot = NowcastSnapshot.from_nowcast(nowcast, datetime.now())
+
+    assert snapshot.index.codes == ('141177',)
+    assert len(snapshot.float32) == array('f').itemsize
+    assert json.loads(snapshot.raw) == nowcast
@@ -0,0 +1,62 @@
+import geopandas as gpd
+import pytest
+import shapely
+
+from engine.spatial import WGS84_EPSG, OASpatialIndex
+
+# two side-by-side unit squares, and a residential one that should be ignored
+OAS = gpd.GeoDataFrame(
+    {
+        'code_uint': [141177, 141194, 141200],
+        'is_residential': [False, False, True],
+        'wkb_geometry': [shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1), shapely.box(2, 0, 3, 1)],
+    },
+    geometry='wkb_geometry',
+    crs=f'EPSG:{WGS84_EPSG}',
+)
+
+
+@pytest.fixture
+def index():
+    return OASpatialIndex.from_geodataframe(OAS)
+
+
+def test_residential_oas_are_dropped(index):
+    assert sorted(index.codes) == ['141177', '141194']
+
+
+@pytest.mark.parametrize(
+    'bbox, expected',
+    [
+        ((0.1, 0.1, 0.2, 0.2), ['141177']),
+        ((0.5, 0.5, 1.5, 0.6), ['141177', '141194']),
+        ((2.5, 0.5, 2.6, 0.6), []),
+        ((5, 5, 6, 6), []),
+    ],
+)
+def test_codes_in_bbox(index, bbox, expected):
+    assert sorted(index.codes_in_bbox(*bbox)) == expected
+
+
+def test_oa_at(index):
+    assert index.oa_at(lat=0.5, lon=1.5) == ('141194', (1.5, 0.5))
+    assert index.oa_at(lat=0.5, lon=2.5) is None
+
+
+def test_from_geodataframe_reprojects_to_wgs84():
+    british_national_grid = OAS.to_crs(epsg=27700)
+    index = OASpatialIndex.from_geodataframe(british_national_grid)
+    code, (lon, lat) = index.oa_at(lat=0.5, lon=0.5)
+    assert code == '141177'
+    assert lon == pytest.approx(0.5)
+    assert lat == pytest.approx(0.5)
+
+
+def test_from_source_reads_geopackage(tmp_path):
+    path = tmp_path / 'oas.gpkg'
+    OAS.to_file(path, layer='edinburgh_oas')
+
+    index = OASpatialIndex.from_source(str(path))
+
+    assert len(index) == len(OAS) - 1
+    assert index.oa_at(lat=0.5, lon=0.5)[0] == '141177'
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+import mapbox_vector_tile
+import pytest
+import shapely
+
+from engine import mvt
+from engine.snapshot import NowcastSnapshot
+from engine.spatial import OASpatialIndex
+from engine.tiles import DensityTiles
+
+ZOOM = 14
+
+
+@pytest.fixture
+def tiles():
+    # two neighbouring OAs near Waverley
+    index = OASpatialIndex(
+        ['141177', '141194'], [shapely.box(-3.192, 55.951, -3.190, 55.953), shapely.box(-3.190, 55.951, -3.188, 55.953)]
+    )
+    return DensityTiles(index, min_zoom=ZOOM, max_zoom=ZOOM)
+
+
+def decode(tile):
+    return {f['id']: f['properties'] for f in mapbox_vector_tile.decode(tile)['density']['features']}
+
+
+def test_tile_ids_cover_the_oas(tiles):
+    tile_ids = list(tiles.tile_ids())
+    assert tile_ids
+    assert all(z == ZOOM for z, _, _ in tile_ids)
+    assert all(tiles.feature_geometries(*tile_id) for tile_id in tile_ids)
+
+
+def test_covers(tiles):
+    assert tiles.covers(ZOOM, 0, 0)
+    assert not tiles.covers(ZOOM + 1, 0, 0)
+    assert not tiles.covers(ZOOM, 1 << ZOOM, 0)
+
+
+def test_render_all_and_get(tiles):
+    snapshot = NowcastSnapshot.from_nowcast({'141177': 0.5, '141194': 0.25, 'timestampISO': 'now'}, datetime.now())
+    tiles.render_all(snapshot)
+    assert tiles.rendered_version == snapshot.version
+
+    tile_id = next(tiles.tile_ids())
+    assert decode(tiles.get(*tile_id, snapshot)) == {141177: {'density': 0.5}, 141194: {'density': 0.25}}
+    # a tile with nothing in it
+    assert tiles.get(ZOOM, 0, 0, snapshot) == b''
+
+
+def test_get_renders_other_versions_on_demand(tiles):
+    tiles.render_all(NowcastSnapshot.from_nowcast({'141177': 0.5}, datetime.now()))
+    newer = NowcastSnapshot.from_nowcast({'141177': 0.75}, datetime.now())
+
+    tile = tiles.get(*next(tiles.tile_ids()), newer)
+
+    # OAs missing from the nowcast have no density
+    assert decode(tile) == {141177: {'density': 0.75}, 141194: {}}
+
+
+def test_feature_geometry_is_cached_and_clipped(tiles):
+    tile_id = next(tiles.tile_ids())
+    first = tiles.feature_geometries(*tile_id)
+    assert tiles.feature_geometries(*tile_id) is first
+
+    layer = mapbox_vector_tile.decode(tiles.render(*tile_id, {}))['density']
+    for feature in layer['features']:
+        min_x, min_y, max_x, max_y = shapely.geometry.shape(feature['geometry']).bounds
+        assert min_x >= -tiles.buffer
+        assert max_x <= tiles.extent + tiles.buffer
+        assert min_y >= -tiles.buffer
+        assert max_y <= tiles.extent + tiles.buffer
+
+
+def test_world_coordinates():
+    world = mvt.lon_lat_to_world(shapely.get_coordinates(shapely.points([(0, 0), (-180, 0)])))
+    assert world.tolist() == [[0.5, 0.5], [0.0, 0.5]]
@@ -0,0 +1,106 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from engine.snapshot import NowcastSnapshot
+from engine.versions import NowcastVersions, changed_entries, removed_entries
+
+EPSILON = 1e-5
+
+
+def snapshot_of(nowcast):
+    return NowcastSnapshot.from_nowcast(nowcast, datetime.now())
+
+
+def test_changed_entries_respects_epsilon():
+    old = {'a': 0.1, 'b': 0.2, 'timestampISO': '2025-03-19T13:00:00'}
+    new = {'a': 0.100001, 'b': 0.3, 'c': 0.4, 'timestampISO': '2025-03-19T14:00:00'}
+
+    assert changed_entries(old, new, EPSILON) == {'b': 0.3, 'c': 0.4, 'timestampISO': '2025-03-19T14:00:00'}
+
+
+def test_changed_entries_include_gaining_or_losing_a_value():
+    old = {'1': 0.5, '2': float('nan'), '3': None, '4': float('nan')}
+    new = {'1': float('nan'), '2': 0.7, '3': 0.2, '4': None}
+
+    assert changed_entries(old, new, EPSILON) == {'1': new['1'], '2': 0.7, '3': 0.2}
+
+
+def test_removed_entries():
+    assert removed_entries({'a': 0.1, 'b': 0.2}, {'a': 0.1}) == ['b']
+
+
+def test_ring_forgets_oldest_versions():
+    versions = NowcastVersions(max_versions=2)
+    first, second, third = snapshot_of({'a': 1.0}), snapshot_of({'a': 2.0}), snapshot_of({'a': 3.0})
+    for snapshot in (first, second, third):
+        versions.add(snapshot)
+
+    assert versions.latest is third
+    assert versions.get(first.version) is None
+    assert versions.get(second.version) is second
+
+
+def test_unchanged_nowcast_is_not_a_new_version():
+    versions = NowcastVersions(max_versions=2)
+    original, republished = snapshot_of({'a': 1.0}), snapshot_of({'a': 1.0})
+    versions.add(original)
+    versions.add(republished)
+
+    assert original.version == republished.version
+    assert versions.latest is republished
+
+
+def test_delta_since_known_version():
+    versions = NowcastVersions(max_versions=3)
+    old, new = snapshot_of({'a': 1.0, 'b': 2.0}), snapshot_of({'a': 1.0, 'b': 2.5})
+    versions.add(old)
+    versions.add(new)
+
+    delta = json.loads(versions.delta_since(old.version, EPSILON))
+
+    assert delta == {'version': new.version, 'since': old.version, 'full': False, 'removed': [], 'changes': {'b': 2.5}}
+
+
+def test_delta_since_latest_version_is_empty():
+    versions = NowcastVersions(max_versions=3)
+    latest = snapshot_of({'a': 1.0})
+    versions.add(latest)
+
+    assert json.loads(versions.delta_since(latest.version, EPSILON))['changes'] == {}
+
+
+def test_delta_since_forgotten_version_is_full():
+    versions = NowcastVersions(max_versions=1)
+    old, new = snapshot_of({'a': 1.0}), snapshot_of({'a': 2.0, 'b': 3.0})
+    versions.add(old)
+    versions.add(new)
+
+    delta = json.loads(versions.delta_since(old.version, EPSILON))
+
+    assert delta['full']
+    assert delta['changes'] == {'a': 2.0, 'b': 3.0}
+
+
+def test_deltas_are_memoised_until_a_new_version_arrives():
+    versions = NowcastVersions(max_versions=3)
+    old, new, newer = snapshot_of({'a': 1.0}), snapshot_of({'a': 2.0}), snapshot_of({'a': 3.0})
+    versions.add(old)
+    versions.add(new)
+
+    assert versions.delta_since(old.version, EPSILON) is versions.delta_since(old.version, EPSILON)
+
+    versions.add(newer)
+    assert json.loads(versions.delta_since(old.version, EPSILON))['changes'] == {'a': 3.0}
+
+
+def test_delta_of_densities_gaining_or_losing_a_value_is_valid_json():
+    versions = NowcastVersions(max_versions=3)
+    old, new = snapshot_of({'1': 0.5, '2': float('nan')}), snapshot_of({'1': float('nan'), '2': 0.7})
+    versions.add(old)
+    versions.add(new)
+
+    delta = json.loads(versions.delta_since(old.version, EPSILON), parse_constant=pytest.fail)
+
+    assert delta['changes'] == {'1': None, '2': 0.7}
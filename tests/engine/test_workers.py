@@ -0,0 +1,141 @@
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from engine.snapshot import NowcastSnapshot
+from engine.workers import LeaderLock, SharedMetrics, SharedSnapshotFile, SharedTilesFile
+
+
+def test_only_one_lock_holder(tmp_path):
+    path = tmp_path / 'refresher.lock'
+    first, second = LeaderLock(path), LeaderLock(path)
+
+    assert first.try_acquire()
+    assert first.try_acquire()  # taking it again is a no-op
+    assert not second.try_acquire()
+    assert not second.held
+
+    first.release()
+    assert not first.held
+    assert second.try_acquire()
+    second.release()
+
+
+@pytest.fixture
+def snapshot():
+    return NowcastSnapshot.from_nowcast({'141177': 0.5, 'timestampISO': '2025-03-19T13:30:00'}, datetime(2025, 3, 19))
+
+
+def test_shared_snapshot_roundtrip(tmp_path, snapshot):
+    writer = SharedSnapshotFile(tmp_path / 'nowcast.snapshot')
+    reader = SharedSnapshotFile(tmp_path / 'nowcast.snapshot')
+    assert reader.read_if_changed(None) is None
+
+    writer.write(snapshot)
+    shared = reader.read_if_changed(None)
+
+    assert shared == snapshot
+    # nothing has changed since
+    assert reader.read_if_changed(None) is None
+    # the writer doesn't read back its own snapshot
+    assert writer.read_if_changed(None) is None
+
+
+def test_shared_snapshot_of_known_version_is_not_read(tmp_path, snapshot):
+    SharedSnapshotFile(tmp_path / 'nowcast.snapshot').write(snapshot)
+    assert SharedSnapshotFile(tmp_path / 'nowcast.snapshot').read_if_changed(snapshot) is None
+
+
+def test_regenerated_shared_snapshot_of_known_version_is_read(tmp_path, snapshot):
+    regenerated = NowcastSnapshot.from_nowcast(dict(snapshot.nowcast), snapshot.created_at + timedelta(hours=1))
+    SharedSnapshotFile(tmp_path / 'nowcast.snapshot').write(regenerated)
+
+    shared = SharedSnapshotFile(tmp_path / 'nowcast.snapshot').read_if_changed(snapshot)
+
+    assert shared.version == snapshot.version
+    assert shared.created_at == regenerated.created_at
+
+
+def test_shared_snapshot_with_missing_densities(tmp_path):
+    snapshot = NowcastSnapshot.from_nowcast({'1': 0.5, '2': float('nan'), '3': 0.7}, datetime(2025, 3, 19))
+    SharedSnapshotFile(tmp_path / 'nowcast.snapshot').write(snapshot)
+
+    shared = SharedSnapshotFile(tmp_path / 'nowcast.snapshot').read_if_changed(None)
+
+    assert shared.index == snapshot.index
+    assert (shared.float32, shared.uint16) == (snapshot.float32, snapshot.uint16)
+
+
+def test_corrupt_shared_snapshot_is_ignored(tmp_path):
+    (tmp_path / 'nowcast.snapshot').write_bytes(b'not a snapshot')
+    assert SharedSnapshotFile(tmp_path / 'nowcast.snapshot').read_if_changed(None) is None
+
+
+def test_refresh_requests(tmp_path):
+    follower = SharedSnapshotFile(tmp_path / 'nowcast.snapshot')
+    refresher = SharedSnapshotFile(tmp_path / 'nowcast.snapshot')
+
+    # requests made before the refresher started listening are ignored
+    follower.request_refresh()
+    assert not refresher.refresh_requested()
+
+    follower.request_refresh()
+    assert refresher.refresh_requested()
+    assert not refresher.refresh_requested()
+
+
+def test_shared_tiles_roundtrip(tmp_path):
+    writer = SharedTilesFile(tmp_path / 'density.tiles')
+    reader = SharedTilesFile(tmp_path / 'density.tiles')
+    assert reader.read_if_changed(None) is None
+    tiles = {(0, 0, 0): b'world', (2, 1, 3): b'', (2, 3, 1): b'somewhere'}
+
+    writer.write('a' * 16, tiles)
+
+    assert reader.read_if_changed(None) == ('a' * 16, tiles)
+    # nothing has changed since
+    assert reader.read_if_changed(None) is None
+    # tiles of a version we already have aren't read
+    assert SharedTilesFile(tmp_path / 'density.tiles').read_if_changed('a' * 16) is None
+
+
+def test_corrupt_shared_tiles_are_ignored(tmp_path):
+    (tmp_path / 'density.tiles').write_bytes(b'not tiles')
+    assert SharedTilesFile(tmp_path / 'density.tiles').read_if_changed(None) is None
+
+
+def test_shared_metrics_of_other_live_workers(tmp_path):
+    ours = SharedMetrics(tmp_path, max_age_s=60)
+    ours.write(b'ours')
+    exited = subprocess.Popen([sys.executable, '-c', ''])
+    exited.wait()
+    (tmp_path / f'{exited.pid}.json').write_bytes(b'exited')
+    live = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    try:
+        (tmp_path / f'{live.pid}.json').write_bytes(b'live')
+
+        assert ours.read_others() == [b'live']
+        assert not (tmp_path / f'{exited.pid}.json').exists()
+    finally:
+        live.kill()
+        live.wait()
+
+
+def test_old_shared_metrics_are_ignored_even_if_their_pid_is_in_use(tmp_path):
+    # as left by a worker before a restart, whose PID has since been reused
+    live = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    try:
+        path = tmp_path / f'{live.pid}.json'
+        path.write_bytes(b'before the restart')
+        written_at = time.time() - 120
+        os.utime(path, (written_at, written_at))
+
+        assert SharedMetrics(tmp_path, max_age_s=60).read_others() == []
+        assert not path.exists()
+    finally:
+        live.kill()
+        live.wait()
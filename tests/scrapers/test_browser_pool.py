@@ -0,0 +1,157 @@
+import asyncio
+import os
+import subprocess
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from engine.metrics import BROWSER_LAUNCHES
+from scrapers.browser_pool import BrowserPool, process_tree_rss_bytes
+
+LOTS_OF_MEMORY = 2**40
+
+
+def fake_browser():
+    browser = MagicMock(contexts=[])
+    browser.is_connected.return_value = True
+    browser.close = AsyncMock(side_effect=lambda: browser.is_connected.configure_mock(return_value=False))
+
+    def new_context(**kwargs):
+        context = MagicMock(browser=browser, identity=kwargs)
+        context.new_page = AsyncMock(side_effect=lambda: AsyncMock())
+        browser.contexts.append(context)
+        return context
+
+    browser.new_context = AsyncMock(side_effect=new_context)
+    return browser
+
+
+class Launched(list):
+    playwright: MagicMock
+
+
+@pytest.fixture
+def browsers(monkeypatch):
+    launched = Launched()
+
+    async def launch(headless):
+        launched.append(fake_browser())
+        return launched[-1]
+
+    playwright = MagicMock()
+    playwright.chromium.launch = AsyncMock(side_effect=launch)
+    playwright.stop = AsyncMock()
+    monkeypatch.setattr(
+        'playwright.async_api.async_playwright', lambda: MagicMock(start=AsyncMock(return_value=playwright))
+    )
+    monkeypatch.setattr('scrapers.browser_pool.process_tree_rss_bytes', lambda pid: 0)
+    launched.playwright = playwright
+    return launched
+
+
+@pytest.fixture
+def pool(browsers):
+    return BrowserPool(max_pages=2, pages_per_browser=5, max_rss_bytes=LOTS_OF_MEMORY)
+
+
+async def open_pages(pool, n_pages):
+    for _ in range(n_pages):
+        async with pool.page():
+            pass
+
+
+@pytest.mark.asyncio
+async def test_browser_is_launched_once_and_contexts_are_reused(pool, browsers):
+    await open_pages(pool, 3)
+    await open_pages(pool, 1)
+
+    assert len(browsers) == 1
+    assert len(browsers[0].contexts) == 1
+    assert {'user_agent', 'viewport', 'locale'} <= browsers[0].contexts[0].identity.keys()
+
+
+@pytest.mark.asyncio
+async def test_browser_is_relaunched_after_so_many_pages(pool, browsers):
+    relaunches = BROWSER_LAUNCHES.labels('pages')
+    count = relaunches.value
+
+    await open_pages(pool, pool.pages_per_browser + 1)
+
+    assert len(browsers) == 1 + 1
+    browsers[0].close.assert_awaited_once()
+    assert relaunches.value == count + 1
+
+
+@pytest.mark.asyncio
+async def test_browser_is_relaunched_when_using_too_much_memory(pool, browsers, monkeypatch):
+    await open_pages(pool, 1)
+    monkeypatch.setattr('scrapers.browser_pool.process_tree_rss_bytes', lambda pid: LOTS_OF_MEMORY + 1)
+    await open_pages(pool, 1)
+
+    assert len(browsers) == 1 + 1
+
+
+@pytest.mark.asyncio
+async def test_browser_is_relaunched_if_it_crashed(pool, browsers):
+    await open_pages(pool, 1)
+    browsers[0].is_connected.return_value = False
+    await open_pages(pool, 1)
+
+    assert len(browsers) == 1 + 1
+
+
+@pytest.mark.asyncio
+async def test_open_pages_are_capped(pool):
+    open_now, most_open = 0, 0
+
+    async def load():
+        nonlocal open_now, most_open
+        async with pool.page():
+            open_now += 1
+            most_open = max(most_open, open_now)
+            await asyncio.sleep(0.01)
+            open_now -= 1
+
+    await asyncio.gather(*[load() for _ in range(pool.pages_per_browser - 1)])
+
+    assert most_open == pool.max_pages
+
+
+@pytest.mark.asyncio
+async def test_relaunch_waits_for_open_pages_to_close(browsers):
+    pool = BrowserPool(max_pages=2, pages_per_browser=1, max_rss_bytes=LOTS_OF_MEMORY)
+    first_page_closed = asyncio.Event()
+
+    async def first():
+        async with pool.page():
+            await asyncio.sleep(0.02)
+            assert browsers[0].is_connected()
+        first_page_closed.set()
+
+    async def second():
+        await asyncio.sleep(0.01)
+        async with pool.page():
+            assert first_page_closed.is_set()
+
+    await asyncio.gather(first(), second())
+    assert len(browsers) == 1 + 1
+
+
+@pytest.mark.asyncio
+async def test_close(pool, browsers):
+    await pool.close()  # nothing launched yet
+    await open_pages(pool, 1)
+    await pool.close()
+
+    browsers[0].close.assert_awaited_once()
+    browsers.playwright.stop.assert_awaited_once()
+
+
+def test_process_tree_rss_counts_children():
+    before = process_tree_rss_bytes(os.getpid())
+    child = subprocess.Popen(['sleep', '10'])
+    try:
+        assert process_tree_rss_bytes(os.getpid()) > before
+    finally:
+        child.kill()
+        child.wait()
@@ -1,9 +1,37 @@
+import asyncio
 from datetime import datetime
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 
-from scrapers.edintraveldata import poll_edintraveldata
+from engine.keyed_cache import KeyedCache, SQLiteCacheBackend
+from engine.simple_cache import CacheEntry
+from scrapers.edintraveldata import ETD_DAY_TABLES, parse_day_table, poll_edintraveldata, scrape_measurements
+
+
+@pytest.fixture(autouse=True)
+def day_tables(tmp_path, monkeypatch):
+    backend = SQLiteCacheBackend(tmp_path / 'cache.sqlite3', evict_interval_s=60 * 60)
+    day_tables = KeyedCache(ETD_DAY_TABLES.name, ETD_DAY_TABLES.max_age_s, backend=backend)
+    monkeypatch.setattr('scrapers.edintraveldata.ETD_DAY_TABLES', day_tables)
+    yield day_tables
+    backend.close()
+
+
+def fake_stream(htmls, delay_s=0):
+    """Return a mock of stream_urls yielding each of htmls, last first, for the URLs it is called with."""
+
+    async def stream(urls, strategy):
+        await asyncio.sleep(delay_s)
+        for url, html in reversed(list(zip(urls, htmls))):
+            yield url, html
+
+    return MagicMock(side_effect=stream)
+
+
+def day_table_html(rows):
+    cells = ''.join(f'<tr><td>{time}</td><td>{ped}</td></tr>' for time, ped in rows.items())
+    return f'<table class="grid" id="gridTable"><tr><th>Time</th><th>Ped</th></tr>{cells}</table>'
 
 
 @pytest.mark.asyncio
@@ -18,13 +46,13 @@ async def test_poll_edintraveldata_parses_measurement(monkeypatch):
     </body></html>
     """
 
-    # Patch scrape_urls to return our fake HTML
-    monkeypatch.setattr('scrapers.edintraveldata.scrape_urls', AsyncMock(return_value=[fake_html]))
+    # Patch stream_urls to return our fake HTML
+    monkeypatch.setattr('scrapers.edintraveldata.stream_urls', fake_stream([fake_html]))
 
-    # Patch SimpleCache to always miss
+    # Patch the cache to always miss
     mock_cache = MagicMock()
-    mock_cache.read.return_value = None
-    monkeypatch.setattr('scrapers.edintraveldata.SimpleCache', lambda *args, **kwargs: mock_cache)
+    mock_cache.read_entry.return_value = None
+    monkeypatch.setattr('scrapers.edintraveldata.ETD_CACHE', mock_cache)
 
     monkeypatch.setattr(
         'scrapers.edintraveldata.datetime',
@@ -47,3 +75,146 @@ async def test_poll_edintraveldata_parses_measurement(monkeypatch):
     assert result.sensor_name == 'CEC123'
     assert result.flow_pax_per_hour == expected_ped_count
     mock_cache.write.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_cache_misses_scrape_once(monkeypatch):
+    n_requests = 10
+    expected_ped_count = 42
+    fake_html = f"""
+    <table class="grid" id="gridTable">
+        <tr><th>Time</th><th>Ped</th></tr>
+        <tr><td>12:00</td><td>{expected_ped_count}</td></tr>
+    </table>
+    """
+
+    mock_scrape = fake_stream([fake_html], delay_s=0.05)
+    monkeypatch.setattr('scrapers.edintraveldata.stream_urls', mock_scrape)
+
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = None
+    monkeypatch.setattr('scrapers.edintraveldata.ETD_CACHE', mock_cache)
+
+    monkeypatch.setattr(
+        'scrapers.edintraveldata.datetime',
+        type('FakeDatetime', (), {'now': staticmethod(lambda: datetime(2024, 4, 30, 12, 15))}),
+    )
+
+    sensor_descriptions = [{'name': 'CEC123', 'source': 'https://mockurl.com/'}]
+
+    results = await asyncio.gather(*[poll_edintraveldata(sensor_descriptions) for _ in range(n_requests)])
+
+    mock_scrape.assert_called_once()
+    mock_cache.write.assert_called_once()
+    assert all(r[0].flow_pax_per_hour == expected_ped_count for r in results)
+
+
+@pytest.mark.asyncio
+async def test_failed_scrape_falls_back_to_stale_measurements(monkeypatch):
+    stale_measurements = {'CEC123': 42}
+    monkeypatch.setattr('scrapers.edintraveldata.stream_urls', fake_stream(['']))
+
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = CacheEntry(
+        data=stale_measurements, written_at=datetime(2024, 4, 30, 10, 0), is_stale=True
+    )
+    monkeypatch.setattr('scrapers.edintraveldata.ETD_CACHE', mock_cache)
+
+    results = await poll_edintraveldata([{'name': 'CEC123', 'source': 'https://mockurl.com/'}])
+
+    assert {r.sensor_name: r.flow_pax_per_hour for r in results} == stale_measurements
+    mock_cache.write.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_force_refresh_scrapes_despite_current_measurements(monkeypatch):
+    cached, scraped = {'CEC123': 42}, {'CEC123': 43}
+    mock_scrape = AsyncMock(return_value=scraped)
+    monkeypatch.setattr('scrapers.edintraveldata.scrape_measurements', mock_scrape)
+
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = CacheEntry(data=cached, written_at=datetime.now(), is_stale=False)
+    monkeypatch.setattr('scrapers.edintraveldata.ETD_CACHE', mock_cache)
+
+    sensor_descriptions = [{'name': 'CEC123', 'source': 'https://mockurl.com/'}]
+    results = await poll_edintraveldata(sensor_descriptions)
+    assert {r.sensor_name: r.flow_pax_per_hour for r in results} == cached
+    mock_scrape.assert_not_called()
+
+    results = await poll_edintraveldata(sensor_descriptions, force_refresh=True)
+
+    assert {r.sensor_name: r.flow_pax_per_hour for r in results} == scraped
+    mock_scrape.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_each_sensor_page_is_scraped_once_a_day(monkeypatch, day_tables):
+    rows = {'12:00': 42, '13:00': 43}
+    mock_scrape = fake_stream([day_table_html(rows), day_table_html(rows)])
+    monkeypatch.setattr('scrapers.edintraveldata.stream_urls', mock_scrape)
+    sensor_descriptions = [
+        {'name': 'CEC123', 'source': 'https://mockurl.com/'},
+        {'name': 'CEC456', 'source': 'https://mockurl.com/'},
+    ]
+
+    noon = await scrape_measurements(sensor_descriptions, datetime(2024, 4, 30, 12, 15), MagicMock())
+    one_pm = await scrape_measurements(sensor_descriptions, datetime(2024, 4, 30, 13, 15), MagicMock())
+
+    assert noon == {'CEC123': rows['12:00'], 'CEC456': rows['12:00']}
+    assert one_pm == {'CEC123': rows['13:00'], 'CEC456': rows['13:00']}
+    mock_scrape.assert_called_once()
+    assert day_tables.get('CEC123/2024-04-29') == rows
+
+
+@pytest.mark.asyncio
+async def test_sensor_missing_the_hour_is_scraped_again(monkeypatch, day_tables):
+    day_tables.put_many({'CEC123/2024-04-29': {'12:00': 42, '13:00': None}, 'CEC456/2024-04-29': {'13:00': 7}})
+    mock_scrape = fake_stream([day_table_html({'12:00': 42, '13:00': 44})])
+    monkeypatch.setattr('scrapers.edintraveldata.stream_urls', mock_scrape)
+    sensor_descriptions = [
+        {'name': 'CEC123', 'source': 'https://mockurl.com/'},
+        {'name': 'CEC456', 'source': 'https://mockurl.com/'},
+    ]
+
+    measurements = await scrape_measurements(sensor_descriptions, datetime(2024, 4, 30, 13, 15), MagicMock())
+
+    assert measurements == {'CEC123': 44, 'CEC456': 7}
+    assert len(mock_scrape.call_args[0][0]) == 1
+    assert 'cosit=000000000123' in mock_scrape.call_args[0][0][0]
+
+
+@pytest.mark.asyncio
+async def test_pages_are_matched_to_sensors_in_whatever_order_they_arrive(monkeypatch):
+    pages = [day_table_html({'12:00': 42}), day_table_html({'12:00': 7})]
+    monkeypatch.setattr('scrapers.edintraveldata.stream_urls', fake_stream(pages))
+    sensor_descriptions = [
+        {'name': 'CEC123', 'source': 'https://mockurl.com/'},
+        {'name': 'CEC456', 'source': 'https://mockurl.com/'},
+    ]
+
+    measurements = await scrape_measurements(sensor_descriptions, datetime(2024, 4, 30, 12, 15), MagicMock())
+
+    assert measurements == {'CEC123': 42, 'CEC456': 7}
+
+
+@pytest.mark.parametrize('ped', ['', 'n/a', '4.5'])
+def test_unreadable_measurements_are_not_reported(ped, caplog):
+    day_table = parse_day_table(day_table_html({'11:00': 3, '12:00': ped, '13:00': '-'}))
+
+    assert day_table == {'11:00': 3, '12:00': None, '13:00': None}
+    assert any('Could not read the measurement' in record.message for record in caplog.records)
+
+
+@pytest.mark.asyncio
+async def test_unreadable_measurement_does_not_lose_other_pages(monkeypatch, day_tables):
+    pages = [day_table_html({'12:00': 42}), day_table_html({'11:00': '', '12:00': 7})]
+    monkeypatch.setattr('scrapers.edintraveldata.stream_urls', fake_stream(pages))
+    sensor_descriptions = [
+        {'name': 'CEC123', 'source': 'https://mockurl.com/'},
+        {'name': 'CEC456', 'source': 'https://mockurl.com/'},
+    ]
+
+    measurements = await scrape_measurements(sensor_descriptions, datetime(2024, 4, 30, 12, 15), MagicMock())
+
+    assert measurements == {'CEC123': 42, 'CEC456': 7}
+    assert day_tables.get('CEC456/2024-04-29') == {'11:00': None, '12:00': 7}
@@ -1,3 +1,4 @@
+import asyncio
 from datetime import date, datetime
 from pathlib import Path
 from unittest.mock import AsyncMock, MagicMock
@@ -5,6 +6,7 @@ from unittest.mock import AsyncMock, MagicMock
 import numpy as np
 import pytest
 
+from engine.simple_cache import CacheEntry
 from scrapers import essential_edinburgh
 
 
@@ -228,7 +230,7 @@ async def test_scrape_dashboard_extracts_data(monkeypatch):
     <img src="https://mockcdn.com/images/RoseSt-52-Week_Update.png">
     </body></html>
     """
-    monkeypatch.setattr('scrapers.essential_edinburgh.scrape_urls', AsyncMock(return_value=[html]))
+    monkeypatch.setattr('scrapers.essential_edinburgh.fetch_urls', AsyncMock(return_value=[html]))
 
     # Mock requests.get to return fake image bytes
     mock_response = MagicMock()
@@ -275,7 +277,7 @@ async def test_scrape_dashboard_extracts_data(monkeypatch):
 @pytest.mark.asyncio
 async def test_scrape_dashboard_uses_fallback(monkeypatch):
     html = "<html><body><img src='unrelated.png'></body></html>"
-    monkeypatch.setattr('scrapers.essential_edinburgh.scrape_urls', AsyncMock(return_value=[html]))
+    monkeypatch.setattr('scrapers.essential_edinburgh.fetch_urls', AsyncMock(return_value=[html]))
 
     PS_fallback = 123
     RS_fallback = 456
@@ -298,3 +300,58 @@ async def test_scrape_dashboard_uses_fallback(monkeypatch):
 
     assert result['EE001'][0][1][0] == PS_fallback
     assert result['EE002'][0][1][0] == RS_fallback
+
+
+@pytest.mark.asyncio
+async def test_concurrent_cache_misses_scrape_once(monkeypatch):
+    n_requests = 10
+
+    async def slow_scrape():
+        await asyncio.sleep(0.05)
+        return {'EE001': [(np.array([1]), np.array([70_000]))]}
+
+    mock_scrape = AsyncMock(side_effect=slow_scrape)
+    monkeypatch.setattr('scrapers.essential_edinburgh.scrape_dashboard', mock_scrape)
+
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = None
+    monkeypatch.setattr('scrapers.essential_edinburgh.EE_CACHE', mock_cache)
+
+    results = await asyncio.gather(*[essential_edinburgh.poll_essential_edinburgh() for _ in range(n_requests)])
+
+    mock_scrape.assert_awaited_once()
+    mock_cache.write.assert_called_once()
+    assert all(r[0].sensor_name == 'EE001' for r in results)
+
+
+@pytest.mark.asyncio
+async def test_failed_scrape_falls_back_to_stale_measurements(monkeypatch):
+    stale_measurements = {'EE001': 70_000}
+    monkeypatch.setattr(
+        'scrapers.essential_edinburgh.scrape_dashboard', AsyncMock(side_effect=AssertionError('oh no!'))
+    )
+
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = CacheEntry(
+        data=stale_measurements, written_at=datetime(2024, 4, 30, 10, 0), is_stale=True
+    )
+    monkeypatch.setattr('scrapers.essential_edinburgh.EE_CACHE', mock_cache)
+
+    results = await essential_edinburgh.poll_essential_edinburgh()
+
+    assert [r.sensor_name for r in results] == ['EE001']
+    mock_cache.write.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_failed_scrape_without_stale_measurements_raises(monkeypatch):
+    monkeypatch.setattr(
+        'scrapers.essential_edinburgh.scrape_dashboard', AsyncMock(side_effect=AssertionError('oh no!'))
+    )
+
+    mock_cache = MagicMock()
+    mock_cache.read_entry.return_value = None
+    monkeypatch.setattr('scrapers.essential_edinburgh.EE_CACHE', mock_cache)
+
+    with pytest.raises(AssertionError, match='oh no!'):
+        await essential_edinburgh.poll_essential_edinburgh()
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+import pytest
+
+from scrapers.scrape_scheduler import ScrapeScheduler, TokenBucket
+
+FAST = {'requests_per_host_per_s': 1000, 'burst_per_host': 10}
+MAX_CONCURRENT = 2
+
+
+def far_deadline():
+    return time.monotonic() + 60
+
+
+class Flaky(Exception):
+    pass
+
+
+async def fetch_all(scheduler, urls, fetch, deadline, retry_on=()):
+    """Fetch each URL by attempts of fetch, returning the results in order of URL and the order they arrived in."""
+    results, arrived = [''] * len(urls), []
+    async for i, result in scheduler.as_completed(
+        urls, lambda url: scheduler.attempt(url, fetch, '', deadline, retry_on), default='', deadline=deadline
+    ):
+        results[i] = result
+        arrived.append(urls[i])
+    return results, arrived
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_spaces_out_requests_after_a_burst():
+    rate_per_s, burst, requests = 50, 2, 5
+    bucket = TokenBucket(rate_per_s, burst)
+
+    start = time.monotonic()
+    for _ in range(requests):
+        await bucket.acquire()
+
+    # less a little, for the resolution of the clock
+    assert time.monotonic() - start >= (requests - burst - 1) / rate_per_s
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_capped():
+    scheduler = ScrapeScheduler(max_concurrent=MAX_CONCURRENT, max_attempts=1, backoff_s=0, **FAST)
+    in_progress, most_in_progress = 0, 0
+
+    async def fetch(url):
+        nonlocal in_progress, most_in_progress
+        in_progress += 1
+        most_in_progress = max(most_in_progress, in_progress)
+        await asyncio.sleep(0.01)
+        in_progress -= 1
+        return url.upper()
+
+    urls = [f'https://example.com/{i}' for i in range(5)]
+    results, _ = await fetch_all(scheduler, urls, fetch, far_deadline())
+
+    assert results == [url.upper() for url in urls]
+    assert most_in_progress == MAX_CONCURRENT
+
+
+@pytest.mark.asyncio
+async def test_failures_are_retried_then_given_up_on():
+    scheduler = ScrapeScheduler(max_concurrent=MAX_CONCURRENT, max_attempts=3, backoff_s=0.001, **FAST)
+    attempts = {}
+
+    async def fetch(url):
+        attempts[url] = attempts.get(url, 0) + 1
+        if url.endswith('broken') or attempts[url] == 1:
+            raise Flaky
+        return 'ok'
+
+    results, _ = await fetch_all(
+        scheduler, ['https://example.com/flaky', 'https://example.com/broken'], fetch, far_deadline(), (Flaky,)
+    )
+
+    assert results == ['ok', '']
+    assert attempts == {'https://example.com/flaky': 2, 'https://example.com/broken': scheduler.max_attempts}
+
+
+@pytest.mark.asyncio
+async def test_other_exceptions_are_raised():
+    scheduler = ScrapeScheduler(max_concurrent=MAX_CONCURRENT, max_attempts=3, backoff_s=0, **FAST)
+
+    async def fetch(url):
+        raise ValueError(url)
+
+    with pytest.raises(ValueError):
+        await fetch_all(scheduler, ['https://example.com/a'], fetch, far_deadline(), (Flaky,))
+
+
+@pytest.mark.asyncio
+async def test_fetches_still_in_progress_at_the_deadline_are_cancelled():
+    scheduler = ScrapeScheduler(max_concurrent=MAX_CONCURRENT, max_attempts=1, backoff_s=0, **FAST)
+    timeout_s = 0.05
+
+    async def fetch(url):
+        if url.endswith('slow'):
+            await asyncio.sleep(60)
+        return 'ok'
+
+    start = time.monotonic()
+    results, _ = await fetch_all(
+        scheduler, ['https://example.com/slow', 'https://example.com/fast'], fetch, time.monotonic() + timeout_s
+    )
+
+    assert results == ['', 'ok']
+    assert time.monotonic() - start < 1 + timeout_s
+
+
+@pytest.mark.asyncio
+async def test_results_are_yielded_as_they_arrive():
+    scheduler = ScrapeScheduler(max_concurrent=MAX_CONCURRENT, max_attempts=1, backoff_s=0, **FAST)
+    urls = ['https://example.com/slow', 'https://example.com/fast']
+
+    async def fetch(url):
+        await asyncio.sleep(0.05 if url.endswith('slow') else 0)
+        return url
+
+    results, arrived = await fetch_all(scheduler, urls, fetch, far_deadline())
+
+    assert results == urls
+    assert arrived == list(reversed(urls))
@@ -0,0 +1,213 @@
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, MagicMock
+
+import httpx
+import pytest
+from playwright.async_api import TimeoutError
+
+from engine.metrics import BLOCKED_REQUESTS, PAGE_BYTES, PAGE_FETCHES
+from scrapers.http_client import HttpClient
+from scrapers.scrape_scheduler import ScrapeScheduler
+from scrapers.utils import FetchStrategy, ResourcePolicy, fetch_urls, scrape_urls, stream_urls
+
+POLICY = ResourcePolicy(
+    'example',
+    frozenset({'document', 'script'}),
+    (r'^https://example\.com/',),
+    always_allowed_url_patterns=(r'chart\.png$',),
+)
+OVER_HTTP_FIRST = FetchStrategy('#gridTable', POLICY, over_http_first=True)
+RESPONSE_SIZES = {'responseHeadersSize': 100, 'responseBodySize': 900}
+
+
+class FakePool:
+    def __init__(self):
+        self.pages = []
+        self.page_goto = None
+        self.selector_timeouts = 0
+
+    @asynccontextmanager
+    async def page(self):
+        """Open a fake page whose content is the URL it was sent to."""
+        page = AsyncMock()
+        page.on = MagicMock()
+        page.goto.side_effect = self.page_goto or (
+            lambda url, timeout: page.content.configure_mock(return_value=f'<html>{url}</html>')
+        )
+        if self.selector_timeouts:
+            self.selector_timeouts -= 1
+            page.wait_for_selector.side_effect = TimeoutError('timed out')
+        self.pages.append(page)
+        yield page
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr('scrapers.utils.BROWSER_POOL', pool)
+    scheduler = ScrapeScheduler(
+        max_concurrent=4, requests_per_host_per_s=1000, burst_per_host=10, max_attempts=2, backoff_s=0
+    )
+    monkeypatch.setattr('scrapers.utils.SCRAPE_SCHEDULER', scheduler)
+    return pool
+
+
+@pytest.mark.asyncio
+async def test_scrape_urls_loads_each_page_from_the_pool(pool):
+    urls = ['https://example.com/a', 'https://example.com/b']
+
+    htmls = await scrape_urls(urls, '#gridTable', POLICY)
+
+    assert htmls == [f'<html>{url}</html>' for url in urls]
+    assert all(page.wait_for_selector.await_args[0][0] == '#gridTable' for page in pool.pages)
+
+
+@pytest.mark.asyncio
+async def test_pages_that_time_out_are_retried(pool):
+    url = 'https://example.com/a'
+    pool.selector_timeouts = 1
+
+    htmls = await scrape_urls([url], '#gridTable', POLICY)
+
+    assert htmls == [f'<html>{url}</html>']
+    assert len(pool.pages) == 1 + 1
+
+
+@pytest.mark.asyncio
+async def test_pages_that_keep_timing_out_are_empty(pool):
+    pool.selector_timeouts = 2
+
+    assert await scrape_urls(['https://example.com/a'], '#gridTable', POLICY) == ['']
+
+
+@pytest.mark.parametrize(
+    'resource_type, url, allowed',
+    [
+        ('document', 'https://example.com/stats/', True),
+        ('script', 'https://example.com/app.js', True),
+        ('image', 'https://example.com/logo.png', False),
+        ('script', 'https://analytics.example.org/tag.js', False),
+        ('image', 'https://cdn.example.org/chart.png', True),
+    ],
+)
+def test_resource_policy(resource_type, url, allowed):
+    assert POLICY.allows(resource_type, url) == allowed
+
+
+@pytest.mark.asyncio
+async def test_requests_the_policy_does_not_allow_are_blocked(pool):
+    await scrape_urls(['https://example.com/a'], '#gridTable', POLICY)
+    pattern, apply_policy = pool.pages[0].route.await_args[0]
+    blocked = BLOCKED_REQUESTS.labels('example', 'font')
+    count = blocked.value
+
+    allowed_route = AsyncMock(request=MagicMock(resource_type='script', url='https://example.com/app.js'))
+    blocked_route = AsyncMock(request=MagicMock(resource_type='font', url='https://example.com/font.woff2'))
+    await apply_policy(allowed_route)
+    await apply_policy(blocked_route)
+
+    assert pattern == '**/*'
+    allowed_route.continue_.assert_awaited_once()
+    allowed_route.abort.assert_not_awaited()
+    blocked_route.abort.assert_awaited_once()
+    assert blocked.value == count + 1
+
+
+@pytest.mark.asyncio
+async def test_bytes_transferred_are_recorded(pool):
+    page_bytes = PAGE_BYTES.labels('example')
+    count, total = sum(page_bytes.counts), page_bytes.sum
+
+    async def goto(url, timeout):
+        event, record = pool.pages[0].on.call_args[0]
+        assert event == 'requestfinished'
+        for _ in range(2):
+            record(AsyncMock(sizes=AsyncMock(return_value=RESPONSE_SIZES)))
+
+    pool.page_goto = goto
+    await scrape_urls(['https://example.com/a'], '#gridTable', POLICY)
+
+    assert sum(page_bytes.counts) == count + 1
+    assert page_bytes.sum == total + 2 * sum(RESPONSE_SIZES.values())
+
+
+@pytest.fixture
+def http_pages(monkeypatch):
+    """Serve pages over HTTP by URL, with an error for any not served."""
+    pages = {}
+
+    async def get_text(url):
+        if url not in pages:
+            raise httpx.ConnectError('connection refused')
+        return pages[url]
+
+    monkeypatch.setattr('scrapers.utils.HTTP_CLIENT', MagicMock(get_text=AsyncMock(side_effect=get_text)))
+    return pages
+
+
+@pytest.mark.asyncio
+async def test_pages_fetched_over_http_are_not_loaded_in_the_browser(pool, http_pages):
+    served = 'https://example.com/served'
+    http_pages[served] = '<html><table id="gridTable"></table></html>'
+    fetched_over_http = PAGE_FETCHES.labels('example', 'http')
+    count = fetched_over_http.value
+
+    htmls = await fetch_urls([served], OVER_HTTP_FIRST)
+
+    assert htmls == [http_pages[served]]
+    assert pool.pages == []
+    assert fetched_over_http.value == count + 1
+
+
+@pytest.mark.asyncio
+async def test_pages_not_fetched_over_http_are_loaded_in_the_browser(pool, http_pages):
+    served, unrendered, unserved = 'https://example.com/served', 'https://example.com/js', 'https://example.com/down'
+    http_pages[served] = '<html><table id="gridTable"></table></html>'
+    http_pages[unrendered] = '<html><script>render()</script></html>'
+    loaded_in_browser = PAGE_FETCHES.labels('example', 'browser')
+    count = loaded_in_browser.value
+
+    htmls = await fetch_urls([unrendered, served, unserved], OVER_HTTP_FIRST)
+
+    assert htmls == [f'<html>{unrendered}</html>', http_pages[served], f'<html>{unserved}</html>']
+    assert len(pool.pages) == len([unrendered, unserved])
+    assert loaded_in_browser.value == count + len([unrendered, unserved])
+
+
+@pytest.mark.asyncio
+async def test_pages_are_streamed_with_their_urls(pool, http_pages):
+    served, unserved = 'https://example.com/served', 'https://example.com/down'
+    http_pages[served] = '<html><table id="gridTable"></table></html>'
+
+    streamed = [page async for page in stream_urls([unserved, served], OVER_HTTP_FIRST)]
+
+    assert sorted(streamed) == sorted([(served, http_pages[served]), (unserved, f'<html>{unserved}</html>')])
+
+
+@pytest.mark.asyncio
+async def test_pages_are_only_fetched_over_http_if_the_strategy_says_so(pool, http_pages):
+    served = 'https://example.com/served'
+    http_pages[served] = '<html><table id="gridTable"></table></html>'
+
+    htmls = await fetch_urls([served], FetchStrategy('#gridTable', POLICY))
+
+    assert htmls == [f'<html>{served}</html>']
+
+
+@pytest.mark.asyncio
+async def test_http_client_is_kept_open_and_raises_on_errors(monkeypatch):
+    client = HttpClient(max_connections=2, keepalive_expiry_s=60, timeout_s=1)
+    transport = httpx.MockTransport(
+        lambda request: httpx.Response(200 if request.url.path == '/ok' else 404, text=request.url.path)
+    )
+    real_async_client = httpx.AsyncClient
+    monkeypatch.setattr('httpx.AsyncClient', lambda **kwargs: real_async_client(transport=transport, **kwargs))
+
+    assert await client.get_text('https://example.com/ok') == '/ok'
+    first = client._client
+    with pytest.raises(httpx.HTTPStatusError):
+        await client.get_text('https://example.com/missing')
+    assert client._client is first
+
+    await client.close()
+    assert first.is_closed